@@ -0,0 +1,371 @@
+"""
+Offline benchmarks for the Segment Anything bridge.
+
+Replaces the SAM model, predictor and mask generator of the bridge
+strategies with stubs that return synthetic masks, so the bridge's own
+hot paths (mask serialization, image decoding, selection parsing and the
+end-to-end main()) can be timed on any CPU machine without a checkpoint.
+
+Usage: python seganybench.py [--sizes 1,4,12,24,50] [--masks 16]
+                             [--repeat 3] [--output results.json]
+
+Author: Shrinivas Kulkarni
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+import seganybridge
+
+# --- Stub Model ---
+
+
+class FakeModel:
+    def __init__(self, maskCnt, maskFraction, seed=0):
+        self.maskCnt = maskCnt
+        self.maskFraction = maskFraction
+        self.rng = np.random.default_rng(seed)
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def syntheticMasks(self, count, shape):
+        height, width = shape
+        ys, xs = np.ogrid[:height, :width]
+        radius = np.sqrt(self.maskFraction * height * width / np.pi)
+        masks = np.empty((count, height, width), dtype=bool)
+        for i in range(count):
+            cy = self.rng.uniform(0, height)
+            cx = self.rng.uniform(0, width)
+            masks[i] = (ys - cy) ** 2 + (xs - cx) ** 2 <= radius**2
+        return masks
+
+
+class FakePredictor:
+    def __init__(self, sam):
+        self.sam = sam
+        self.shape = None
+
+    def set_image(self, image):
+        self.shape = image.shape[:2]
+
+    def predict(self, multimask_output=True, **kwargs):
+        count = 3 if multimask_output else 1
+        masks = self.sam.syntheticMasks(count, self.shape)
+        scores = np.ones(count, dtype=np.float32)
+        logits = np.zeros((count, 256, 256), dtype=np.float32)
+        return masks, scores, logits
+
+
+class FakeMaskGenerator:
+    def __init__(self, model=None, **kwargs):
+        self.sam = model
+
+    def generate(self, image):
+        masks = self.sam.syntheticMasks(self.sam.maskCnt, image.shape[:2])
+        return [
+            {
+                "segmentation": mask,
+                "area": int(mask.sum()),
+                "predicted_iou": 1.0,
+                "stability_score": 1.0,
+            }
+            for mask in masks
+        ]
+
+
+def makeFakeStrategy(strategyCls):
+    strategy = strategyCls()
+    strategy.predictor_cls = FakePredictor
+    strategy.mask_generator_cls = FakeMaskGenerator
+    return strategy
+
+
+# --- Timing ---
+
+
+def timeIt(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return {
+        "min_s": min(samples),
+        "median_s": statistics.median(samples),
+        "mean_s": statistics.mean(samples),
+        "repeat": repeat,
+    }
+
+
+def syntheticImage(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[..., 0] = gradient
+    image[..., 1] = gradient[::-1]
+    image[..., 2] = rng.integers(0, 256, size=(height, width), dtype=np.uint8)
+    return image
+
+
+def imageDims(megapixels):
+    # 3:2 aspect ratio, like most camera sensors
+    height = int(round(np.sqrt(megapixels * 1e6 * 2 / 3)))
+    width = int(round(megapixels * 1e6 / height))
+    return width, height
+
+
+def writeRawImage(filepath, image):
+    # Same layout the plugin writes for the raw pixel handoff
+    height, width, channels = image.shape
+    offset = 64
+    header = seganybridge.RAW_IMAGE_HEADER.pack(
+        seganybridge.RAW_IMAGE_MAGIC,
+        seganybridge.RAW_IMAGE_VERSION,
+        channels,
+        height,
+        width,
+        offset,
+    )
+    with open(filepath, "wb") as f:
+        f.write(header.ljust(offset, b"\0"))
+        f.write(np.ascontiguousarray(image).tobytes())
+
+
+def writeSelFile(filepath, width, height, ptCnt, rng):
+    with open(filepath, "w") as f:
+        for _ in range(ptCnt):
+            f.write("%d %d\n" % (rng.integers(0, width), rng.integers(0, height)))
+
+
+def runMain(argv):
+    # Output of main() is suppressed, so only the bridge work is timed
+    savedArgv = sys.argv
+    sys.argv = argv
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            seganybridge.main()
+    finally:
+        sys.argv = savedArgv
+
+
+def benchSize(megapixels, args, workDir, strategies):
+    width, height = imageDims(megapixels)
+    rng = np.random.default_rng(int(megapixels * 1000))
+    results = []
+
+    def record(stage, timing, **extra):
+        result = {
+            "megapixels": megapixels,
+            "width": width,
+            "height": height,
+            "stage": stage,
+        }
+        result.update(extra)
+        result.update(timing)
+        results.append(result)
+        print(
+            "%6.1f MP  %-28s %-30s %10.2f ms"
+            % (
+                megapixels,
+                stage,
+                " ".join("%s=%s" % item for item in extra.items()),
+                timing["median_s"] * 1000,
+            ),
+            file=sys.stderr,
+        )
+
+    imagePath = os.path.join(workDir, "image.png")
+    rawImagePath = os.path.join(workDir, "image" + seganybridge.RAW_IMAGE_EXT)
+    image = syntheticImage(width, height)
+    cv2.imwrite(imagePath, image, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+    writeRawImage(rawImagePath, image)
+
+    record(
+        "png_write",
+        timeIt(
+            lambda: cv2.imwrite(
+                os.path.join(workDir, "copy.png"),
+                image,
+                [cv2.IMWRITE_PNG_COMPRESSION, 9],
+            ),
+            args.repeat,
+        ),
+    )
+    del image
+
+    # The sum touches every pixel, so the raw read pays for its page faults
+    for path in (imagePath, rawImagePath):
+        record(
+            "readImage",
+            timeIt(
+                lambda: np.asarray(seganybridge.readImage(path)).sum(),
+                args.repeat,
+            ),
+            format=os.path.splitext(path)[1][1:],
+        )
+
+    fakeModel = FakeModel(args.masks, args.mask_fraction)
+    masks = fakeModel.syntheticMasks(args.masks, (height, width))
+    record(
+        "packBoolArray",
+        timeIt(
+            lambda: seganybridge.packBoolArray(
+                os.path.join(workDir, "single.seg"), masks[0]
+            ),
+            args.repeat,
+        ),
+    )
+    saveFileNoExt = os.path.join(workDir, "mask__")
+    for maskFormat in (
+        seganybridge.MASK_FORMAT_BINARY,
+        seganybridge.MASK_FORMAT_CONTAINER,
+    ):
+        record(
+            "saveMasks",
+            timeIt(
+                lambda: seganybridge.saveMasks(masks, saveFileNoExt, maskFormat),
+                args.repeat,
+            ),
+            format=maskFormat,
+            masks=args.masks,
+        )
+    del masks
+
+    selFile = os.path.join(workDir, "sel.txt")
+    writeSelFile(selFile, width, height, args.sel_points, rng)
+    cvImage = cv2.cvtColor(cv2.imread(imagePath), cv2.COLOR_BGR2RGB)
+    for name, strategyCls in strategies:
+        strategy = makeFakeStrategy(strategyCls)
+        record(
+            "segment_sel",
+            timeIt(
+                lambda: strategy.segment_sel(
+                    fakeModel,
+                    cvImage,
+                    "Single",
+                    selFile,
+                    None,
+                    saveFileNoExt,
+                    seganybridge.MASK_FORMAT_CONTAINER,
+                ),
+                args.repeat,
+            ),
+            strategy=name,
+            points=args.sel_points,
+        )
+
+        checkPtName = "sam_vit_b_01ec64.pth" if name == "sam1" else "sam2_hiera_tiny.pt"
+        seganybridge.loadModel = lambda *_: (strategy, fakeModel)
+        for segType, extraArgs in (
+            ("Auto", []),
+            ("Box", ["sel_place_holder", "10,10,%d,%d" % (width // 2, height // 2)]),
+            ("Selection", [selFile]),
+        ):
+            argv = [
+                "seganybridge.py",
+                "auto",
+                checkPtName,
+                imagePath,
+                segType,
+                "Multiple",
+                saveFileNoExt,
+                seganybridge.MASK_FORMAT_CONTAINER,
+            ] + extraArgs
+            record(
+                "main",
+                timeIt(lambda: runMain(argv), args.repeat),
+                strategy=name,
+                segType=segType,
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument(
+        "--sizes", default="1,4,12,24,50", help="Comma separated image megapixels"
+    )
+    parser.add_argument("--masks", type=int, default=16, help="Masks per Auto run")
+    parser.add_argument(
+        "--mask-fraction",
+        type=float,
+        default=0.02,
+        help="Fraction of the image covered by each synthetic mask",
+    )
+    parser.add_argument("--sel-points", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--strategies", default="sam1,sam2", help="Comma separated: sam1,sam2"
+    )
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    allStrategies = {
+        "sam1": seganybridge.SAM1Strategy,
+        "sam2": seganybridge.SAM2Strategy,
+    }
+    strategies = [(name, allStrategies[name]) for name in args.strategies.split(",")]
+    originalLoadModel = seganybridge.loadModel
+
+    results = []
+    workDir = tempfile.mkdtemp(prefix="segany-bench-")
+    # Stage and mask events of the timed calls stay out of the JSON report
+    devNull = open(os.devnull, "w")
+    previousStream = seganybridge.setEventStream(devNull)
+    try:
+        for size in args.sizes.split(","):
+            results.extend(benchSize(float(size), args, workDir, strategies))
+    finally:
+        seganybridge.setEventStream(previousStream)
+        devNull.close()
+        seganybridge.loadModel = originalLoadModel
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "cv2": cv2.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
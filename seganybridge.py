@@ -22,50 +22,148 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """
 
-import torch
 import numpy as np
 import cv2
 import sys
 import os
+import struct
+import json
+import hashlib
+import importlib
+import inspect
+import select
+import socket
+import contextlib
+import glob
+import re
+import queue
+import threading
+import time
+import traceback
 
-# SAM2 imports
-from sam2.build_sam import build_sam2
-from sam2.sam2_image_predictor import SAM2ImagePredictor
-from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+# torch and the SAM packages are imported by the selected strategy in
+# import_backend, so only the model family in use is loaded
 
-# SAM1 imports
-from segment_anything import (
-    sam_model_registry,
-    SamAutomaticMaskGenerator as SamAutomaticMaskGenerator_SAM1,
-    SamPredictor,
+# Seconds without a request before a bridge server exits and frees the model
+DEFAULT_SERVER_IDLE_TIMEOUT = 30 * 60
+# Models kept resident by the bridge server, e.g. a preview and a full model
+SERVER_MAX_MODELS = 2
+# Seconds between checks whether the client of the running job went away
+SERVER_CANCEL_POLL_INTERVAL = 0.25
+
+# Image embedding cache location and size cap, overridable from the environment
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "segany",
+    "embeddings",
 )
+DEFAULT_CACHE_SIZE_MB = 1024
+
+# Stream of the structured events, None for the current sys.stdout
+eventStream = None
+# Set by the bridge server when the client of the running job goes away
+jobCancelled = threading.Event()
 
 # --- Utility Functions ---
 
 
+def setEventStream(stream):
+    # Returns the previous stream, so callers can restore it
+    global eventStream
+    previous, eventStream = eventStream, stream
+    return previous
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def checkCancelled():
+    # Called between stages, the work of a single stage is never interrupted
+    if jobCancelled.is_set():
+        raise JobCancelled("Job cancelled by the client")
+
+
+def emitEvent(event, **fields):
+    # Structured events are single JSON lines on stdout among the free text
+    print(json.dumps(dict(event=event, **fields)), file=eventStream, flush=True)
+
+
+@contextlib.contextmanager
+def stageTimer(stage):
+    checkCancelled()
+    fields = {}
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield fields
+    finally:
+        emitEvent(
+            "stage",
+            stage=stage,
+            wall=round(time.perf_counter() - wall, 4),
+            cpu=round(time.process_time() - cpu, 4),
+            **fields,
+        )
+
+
+# Binary masks hold the row and column counts as big-endian uint32 values
+# followed by the mask bits packed LSB-first in row-major order. A trailer
+# with the format version comes after the payload, so readers that stop at
+# the last payload byte are unaffected by it.
+MASK_FILE_MAGIC = b"SEGM"
+MASK_FILE_VERSION = 1
+
+
+MASK_FORMAT_TEXT = "Text"
+MASK_FORMAT_BINARY = "Binary"
+MASK_FORMAT_CONTAINER = "Container"
+MASK_FORMAT_LABEL_MAP = "LabelMap"
+MASK_FORMAT_STREAM = "Stream"
+
+# Mask containers hold every mask of a run in one file: a header, a table
+# with the payload offset, length, bounding box and encoding of each mask,
+# then the payloads cropped to their bounding boxes. Payloads are either
+# LSB-first packed bits or big-endian uint32 run lengths alternating between
+# unset and set pixels. Version 2 tags each mask with the index of the prompt
+# (box or selection component) it was predicted for, version 1 left it zero.
+CONTAINER_FILE_NAME = "all.segc"
+CONTAINER_MAGIC = b"SEGC"
+CONTAINER_VERSION = 2
+# magic, version, flags, rows, cols, mask count
+CONTAINER_HEADER = struct.Struct(">4sHHIII")
+# payload offset, payload length, x, y, width, height, encoding, prompt
+CONTAINER_ENTRY = struct.Struct(">QIIIIIBxH")
+CONTAINER_ENCODING_BITS = 0
+CONTAINER_ENCODING_RLE = 1
+CONTAINER_RUN_SIZE = 4
+# Streamed masks are single mask containers named <saveFileNoExt><index>.segc,
+# each announced with a "mask" event once it is complete
+STREAM_FILE_EXT = ".segc"
+
+# Label maps store, for every pixel of the canvas, 1 + the container index of
+# the first (top ranked) mask covering it, 0 where no mask does. They are
+# written next to the container as big-endian (label, run length) pairs over
+# the row-major canvas, the container remains the table of overlapping masks.
+LABEL_MAP_FILE_NAME = "all.segl"
+LABEL_MAP_MAGIC = b"SEGL"
+LABEL_MAP_VERSION = 1
+# magic, version, flags, rows, cols, run count
+LABEL_MAP_HEADER = struct.Struct(">4sHHIII")
+LABEL_MAP_RUN = np.dtype([("label", ">u2"), ("length", ">u4")])
+LABEL_MAP_MAX_LABEL = 65535
+
+
+def packMask(mask):
+    mask = np.asarray(mask, dtype=bool)
+    num_rows, num_cols = mask.shape
+    header = struct.pack(">II", num_rows, num_cols)
+    payload = np.packbits(mask, axis=None, bitorder="little")
+    trailer = struct.pack(">4sH", MASK_FILE_MAGIC, MASK_FILE_VERSION)
+    return header + payload.tobytes() + trailer
+
+
 def packBoolArray(filepath, arr):
-    packed_data = bytearray()
-    num_rows = len(arr)
-    num_cols = len(arr[0])
-    packed_data.extend(
-        [num_rows >> 24, (num_rows >> 16) & 255, (num_rows >> 8) & 255, num_rows & 255]
-    )
-    packed_data.extend(
-        [num_cols >> 24, (num_cols >> 16) & 255, (num_cols >> 8) & 255, num_cols & 255]
-    )
-    current_byte = 0
-    bit_position = 0
-    for row in arr:
-        for boolean_value in row:
-            if boolean_value:
-                current_byte |= 1 << bit_position
-            bit_position += 1
-            if bit_position == 8:
-                packed_data.append(current_byte)
-                current_byte = 0
-                bit_position = 0
-    if bit_position > 0:
-        packed_data.append(current_byte)
+    packed_data = packMask(arr)
     with open(filepath, "wb") as f:
         f.write(packed_data)
     return packed_data
@@ -75,53 +173,1154 @@ def saveMask(filepath, maskArr, formatBinary):
     if formatBinary:
         packBoolArray(filepath, maskArr)
     else:
-        with open(filepath, "w") as f:
-            for row in maskArr:
-                f.write("".join(str(int(val)) for val in row) + "\n")
+        digits = np.asarray(maskArr, dtype=np.uint8) + ord("0")
+        with open(filepath, "wb") as f:
+            for row in digits:
+                f.write(row.tobytes() + b"\n")
+
+
+def cropMask(mask):
+    mask = np.asarray(mask, dtype=bool)
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return 0, 0, mask[:0, :0]
+    cols = np.flatnonzero(mask.any(axis=0))
+    y1, y2, x1, x2 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    return int(x1), int(y1), mask[y1:y2, x1:x2]
+
+
+def encodeMaskPayload(crop):
+    flat = crop.ravel()
+    packed = np.packbits(flat, bitorder="little")
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    # Runs alternate unset / set starting with unset, so a leading zero-length
+    # run is needed when the first pixel is set
+    runCnt = len(changes) + 2
+    if runCnt * CONTAINER_RUN_SIZE < len(packed):
+        bounds = np.concatenate(([0], changes, [flat.size]))
+        runs = np.diff(bounds)
+        if flat[0]:
+            runs = np.concatenate(([0], runs))
+        return CONTAINER_ENCODING_RLE, runs.astype(">u4").tobytes()
+    return CONTAINER_ENCODING_BITS, packed.tobytes()
+
+
+def writeMaskContainer(filepath, shape, crops, promptIds=None):
+    num_rows, num_cols = shape
+    entries = []
+    payloads = []
+    offset = CONTAINER_HEADER.size + CONTAINER_ENTRY.size * len(crops)
+    for i, (x, y, crop) in enumerate(crops):
+        h, w = crop.shape
+        encoding, payload = encodeMaskPayload(crop)
+        promptId = promptIds[i] if promptIds is not None else 0
+        entries.append(
+            CONTAINER_ENTRY.pack(offset, len(payload), x, y, w, h, encoding, promptId)
+        )
+        payloads.append(payload)
+        offset += len(payload)
+
+    tmpFilepath = filepath + ".tmp"
+    with open(tmpFilepath, "wb") as f:
+        f.write(
+            CONTAINER_HEADER.pack(
+                CONTAINER_MAGIC, CONTAINER_VERSION, 0, num_rows, num_cols, len(crops)
+            )
+        )
+        f.writelines(entries)
+        f.writelines(payloads)
+    os.replace(tmpFilepath, filepath)
+
+
+def writeLabelMap(filepath, shape, crops):
+    labels = np.zeros(shape, dtype=np.uint16)
+    # Painting in reverse leaves the top ranked mask on every pixel
+    for i in reversed(range(min(len(crops), LABEL_MAP_MAX_LABEL))):
+        x, y, crop = crops[i]
+        h, w = crop.shape
+        labels[y : y + h, x : x + w][crop] = i + 1
+
+    flat = labels.ravel()
+    starts = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate(([0], starts)) if flat.size > 0 else starts
+    runs = np.empty(len(starts), dtype=LABEL_MAP_RUN)
+    runs["label"] = flat[starts]
+    runs["length"] = np.diff(np.append(starts, flat.size))
+
+    tmpFilepath = filepath + ".tmp"
+    with open(tmpFilepath, "wb") as f:
+        f.write(
+            LABEL_MAP_HEADER.pack(
+                LABEL_MAP_MAGIC, LABEL_MAP_VERSION, 0, shape[0], shape[1], len(runs)
+            )
+        )
+        f.write(runs.tobytes())
+    os.replace(tmpFilepath, filepath)
+
+
+def streamMaskCrops(shape, crops, saveFileNoExt, promptIds=None, total=None):
+    # crops may be a generator, so cropping and encoding the next mask overlap
+    # with the plugin building the layer of the previous one
+    count = 0
+    for i, crop in enumerate(crops):
+        promptId = promptIds[i] if promptIds is not None else 0
+        filepath = saveFileNoExt + str(i) + STREAM_FILE_EXT
+        writeMaskContainer(filepath, shape, [crop], [promptId])
+        emitEvent("mask", index=i, file=filepath, prompt=promptId, total=total)
+        checkCancelled()
+        count += 1
+    return count
+
+
+def writeMaskCrops(shape, crops, saveFileNoExt, maskFormat, promptIds=None):
+    writeMaskContainer(saveFileNoExt + CONTAINER_FILE_NAME, shape, crops, promptIds)
+    if maskFormat == MASK_FORMAT_LABEL_MAP:
+        writeLabelMap(saveFileNoExt + LABEL_MAP_FILE_NAME, shape, crops)
+
+
+def saveMaskCrops(shape, crops, saveFileNoExt, maskFormat, promptIds=None):
+    with stageTimer("serialize") as stage:
+        stage["masks"] = len(crops)
+        if maskFormat == MASK_FORMAT_STREAM:
+            streamMaskCrops(shape, crops, saveFileNoExt, promptIds, len(crops))
+            return
+        if maskFormat in {MASK_FORMAT_CONTAINER, MASK_FORMAT_LABEL_MAP}:
+            writeMaskCrops(shape, crops, saveFileNoExt, maskFormat, promptIds)
+            return
+        for i, (x, y, crop) in enumerate(crops):
+            mask = np.zeros(shape, dtype=bool)
+            mask[y : y + crop.shape[0], x : x + crop.shape[1]] = crop
+            filepath = saveFileNoExt + str(i) + ".seg"
+            saveMask(filepath, mask, maskFormat == MASK_FORMAT_BINARY)
+
+
+def parseMaskFormat(value):
+    # Older plugins pass the binary flag as "True" / "False"
+    return {"True": MASK_FORMAT_BINARY, "False": MASK_FORMAT_TEXT}.get(value, value)
+
+
+def saveMasks(masks, saveFileNoExt, maskFormat):
+    with stageTimer("serialize") as stage:
+        stage["masks"] = len(masks)
+        shape = masks[0].shape if len(masks) > 0 else (0, 0)
+        if maskFormat == MASK_FORMAT_STREAM:
+            crops = (cropMask(mask) for mask in masks)
+            streamMaskCrops(shape, crops, saveFileNoExt, total=len(masks))
+            return
+        if maskFormat in {MASK_FORMAT_CONTAINER, MASK_FORMAT_LABEL_MAP}:
+            crops = [cropMask(mask) for mask in masks]
+            writeMaskCrops(shape, crops, saveFileNoExt, maskFormat)
+            return
+        for i, mask in enumerate(masks):
+            filepath = saveFileNoExt + str(i) + ".seg"
+            saveMask(filepath, mask, maskFormat == MASK_FORMAT_BINARY)
+
+
+def splitOptions(argv):
+    # Optional settings are passed as trailing --name=value arguments
+    args, options = [], {}
+    for arg in argv:
+        if arg.startswith("--") and "=" in arg:
+            name, value = arg[2:].split("=", 1)
+            options[name] = value
+        else:
+            args.append(arg)
+    return args, options
+
+
+# Raw pixel handoff from the plugin: a fixed header followed by the rows of
+# 8-bit RGB(A) pixels, read in place instead of decoding a PNG
+RAW_IMAGE_EXT = ".segr"
+RAW_IMAGE_MAGIC = b"SEGR"
+RAW_IMAGE_VERSION = 1
+# magic, version, channels, rows, cols, pixel data offset
+RAW_IMAGE_HEADER = struct.Struct(">4sHHIII")
+
+
+def readRawImage(filepath):
+    with open(filepath, "rb") as f:
+        header = f.read(RAW_IMAGE_HEADER.size)
+    magic, version, channels, rows, cols, offset = RAW_IMAGE_HEADER.unpack(header)
+    if magic != RAW_IMAGE_MAGIC or version > RAW_IMAGE_VERSION:
+        raise ValueError(f"Not a raw image file: {filepath}")
+    # Copy-on-write mapping: no copy unless a consumer writes to the pixels
+    pixels = np.memmap(
+        filepath, dtype=np.uint8, mode="c", offset=offset, shape=(rows, cols, channels)
+    )
+    return np.ascontiguousarray(pixels[..., :3]) if channels == 4 else pixels
+
+
+def readImage(filepath):
+    if filepath.endswith(RAW_IMAGE_EXT):
+        return readRawImage(filepath)
+    cvImage = cv2.imread(filepath)
+    return cv2.cvtColor(cvImage, cv2.COLOR_BGR2RGB)
+
+
+def readSelFile(selFile):
+    # Points of separate selection components are separated by blank lines,
+    # returns a list of point lists, one per component
+    components = [[]]
+    with open(selFile, "r") as f:
+        lines = f.readlines()
+        for line in lines:
+            if not line.strip():
+                if components[-1]:
+                    components.append([])
+                continue
+            cos = line.split(" ")
+            components[-1].append([int(cos[0]), int(cos[1])])
+    return [pts for pts in components if pts]
+
+
+def readClicksFile(clicksFile):
+    # One "x y label" line per click, label 1 for positive and 0 for negative
+    points, labels = [], []
+    with open(clicksFile, "r") as f:
+        for line in f:
+            cos = line.split()
+            if len(cos) < 2:
+                continue
+            points.append([int(float(cos[0])), int(float(cos[1]))])
+            labels.append(int(cos[2]) if len(cos) > 2 else 1)
+    return points, labels
+
+
+def parseBoxes(value):
+    # Boxes are separated by ";", each given as x1,y1,x2,y2
+    return [
+        [float(val.strip()) for val in box.split(",")]
+        for box in value.split(";")
+        if box.strip()
+    ]
+
+
+# Upper bound for the full resolution mask logits of one batched decoder pass
+PROMPT_BATCH_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def batchPrompts(prompts):
+    """
+    Stacks prompts of the same kind into batched arrays. Point prompts are
+    padded to the longest one with label -1, which the SAM prompt encoders
+    treat as "not a point". Returns (coords, labels, boxes), where coords and
+    labels or boxes are None when the prompts have no points or boxes.
+    """
+    coords = labels = boxes = None
+    if "points" in prompts[0]:
+        ptCnt = max(len(prompt["points"]) for prompt in prompts)
+        coords = np.zeros((len(prompts), ptCnt, 2), dtype=np.float32)
+        labels = np.full((len(prompts), ptCnt), -1, dtype=np.int32)
+        for i, prompt in enumerate(prompts):
+            pts = prompt["points"]
+            coords[i, : len(pts)] = pts
+            labels[i, : len(pts)] = prompt.get("labels", [1] * len(pts))
+    if "box" in prompts[0]:
+        boxes = np.array([prompt["box"] for prompt in prompts], dtype=np.float32)
+    return coords, labels, boxes
+
+
+def getModelId(modelType, checkPtFilePath):
+    stat = os.stat(checkPtFilePath)
+    return "%s:%s:%d:%d" % (
+        modelType,
+        os.path.abspath(checkPtFilePath),
+        stat.st_size,
+        int(stat.st_mtime),
+    )
+
+
+def importModule(name, importTimes):
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    importTimes.append((name, time.perf_counter() - start))
+    return module
+
+
+def loadStateDict(checkPtFilePath):
+    import torch
+
+    if checkPtFilePath.endswith(".safetensors"):
+        from safetensors.torch import load_file
+
+        return load_file(checkPtFilePath, device="cpu")
+    try:
+        checkpoint = torch.load(
+            checkPtFilePath, map_location="cpu", mmap=True, weights_only=True
+        )
+    except Exception as e:
+        # Older torch versions and legacy checkpoint files cannot be mmapped
+        print(f"Memory-mapped load failed ({e}), loading checkpoint into memory")
+        checkpoint = torch.load(checkPtFilePath, map_location="cpu")
+    return checkpoint.get("model", checkpoint)
+
+
+def supportsAssignLoad():
+    # load_state_dict(..., assign=True) came with torch 2.1
+    import torch
+
+    return "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+
+@contextlib.contextmanager
+def metaParameters():
+    # Models built in this context get their parameters on the meta device,
+    # so no memory or time goes into random weights the checkpoint replaces.
+    # Buffers stay real, since a checkpoint need not hold all of them.
+    import torch
+
+    register = torch.nn.Module.register_parameter
+
+    def registerOnMeta(module, name, param):
+        if param is not None:
+            param = torch.nn.Parameter(param.to("meta"), param.requires_grad)
+        register(module, name, param)
+
+    torch.nn.Module.register_parameter = registerOnMeta
+    try:
+        yield
+    finally:
+        torch.nn.Module.register_parameter = register
+
+
+# --- Tiled Auto Segmentation ---
+
+DEFAULT_TILE_OVERLAP = 128
+DEFAULT_TILE_MAX_MEMORY_MB = 4096
+# Rough working memory per tile pixel: the RGB tile plus the full-tile boolean
+# masks returned by the mask generator (typically up to ~100 per tile)
+TILE_BYTES_PER_PIXEL = 128
+TILE_SEAM_IOU_THRESHOLD = 0.5
+
+
+def tileOrigins(length, tileSize, overlap):
+    if length <= tileSize:
+        return [0]
+    step = max(tileSize - overlap, 1)
+    origins = list(range(0, length - tileSize, step))
+    return origins + [length - tileSize]
+
+
+def intersectRects(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    return (x1, y1, x2, y2) if x1 < x2 and y1 < y2 else None
+
+
+class PackedCrop:
+    # Bit-packed bbox crop of a mask in image coordinates, so masks collected
+    # across tiles cost area / 8 bytes until they are stitched and written
+    def __init__(self, x, y, crop, score=(1.0, 1.0)):
+        self.x, self.y = x, y
+        self.h, self.w = crop.shape
+        self.area = int(np.count_nonzero(crop))
+        self.bits = np.packbits(crop, axis=None)
+        self.score = score
+
+    @property
+    def rect(self):
+        return (self.x, self.y, self.x + self.w, self.y + self.h)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def unpack(self):
+        flat = np.unpackbits(self.bits, count=self.w * self.h)
+        return flat.reshape(self.h, self.w).astype(bool)
+
+    def region(self, rect):
+        # Returns this mask over rect (in image coordinates)
+        out = np.zeros((rect[3] - rect[1], rect[2] - rect[0]), dtype=bool)
+        overlap = intersectRects(self.rect, rect)
+        if overlap is not None:
+            crop = self.unpack()
+            out[
+                overlap[1] - rect[1] : overlap[3] - rect[1],
+                overlap[0] - rect[0] : overlap[2] - rect[0],
+            ] = crop[
+                overlap[1] - self.y : overlap[3] - self.y,
+                overlap[0] - self.x : overlap[2] - self.x,
+            ]
+        return out
+
+
+def seamIoU(a, b, seamRect):
+    # IoU of two masks over the whole seam (tile overlap), so a small mask
+    # nested in a larger one is not mistaken for its continuation
+    maskA, maskB = a.region(seamRect), b.region(seamRect)
+    union = np.count_nonzero(maskA | maskB)
+    return np.count_nonzero(maskA & maskB) / union if union else 0.0
+
+
+def stitchTileMasks(tiles, iouThreshold=TILE_SEAM_IOU_THRESHOLD):
+    """
+    Merges masks that continue across tile seams. tiles is a list of
+    (tileRect, [PackedCrop]); masks from neighbouring tiles are paired up
+    when their IoU over the shared overlap region reaches iouThreshold. Returns
+    the stitched masks as (x, y, crop) tuples and their scores, the best score
+    of each stitched piece.
+    """
+    pieces = [piece for _, tilePieces in tiles for piece in tilePieces]
+    parent = list(range(len(pieces)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    starts = np.cumsum([0] + [len(tilePieces) for _, tilePieces in tiles])
+    for i, (rectA, piecesA) in enumerate(tiles):
+        for j in range(i + 1, len(tiles)):
+            rectB, piecesB = tiles[j]
+            # Only compare edge neighbours (same tile row or column), the
+            # corner shared by diagonal neighbours is too small to judge and
+            # is covered transitively through the edge seams
+            if rectA[0::2] != rectB[0::2] and rectA[1::2] != rectB[1::2]:
+                continue
+            seamRect = intersectRects(rectA, rectB)
+            if seamRect is None:
+                continue
+            candA = [
+                (starts[i] + k, p)
+                for k, p in enumerate(piecesA)
+                if intersectRects(p.rect, seamRect)
+            ]
+            candB = [
+                (starts[j] + k, p)
+                for k, p in enumerate(piecesB)
+                if intersectRects(p.rect, seamRect)
+            ]
+            # Pieces are matched one to one across a seam, best IoU first, so
+            # a mask nested in a larger one stays with its own continuation
+            matches = []
+            for idxA, a in candA:
+                for idxB, b in candB:
+                    if not intersectRects(a.rect, b.rect):
+                        continue
+                    iou = seamIoU(a, b, seamRect)
+                    if iou >= iouThreshold:
+                        matches.append((iou, idxA, idxB))
+            matched = set()
+            for _, idxA, idxB in sorted(matches, reverse=True):
+                if idxA in matched or idxB in matched:
+                    continue
+                matched.update((idxA, idxB))
+                parent[find(idxB)] = find(idxA)
+
+    groups = {}
+    for idx in range(len(pieces)):
+        groups.setdefault(find(idx), []).append(pieces[idx])
+
+    stitched = []
+    scores = []
+    for group in groups.values():
+        x1 = min(p.x for p in group)
+        y1 = min(p.y for p in group)
+        x2 = max(p.x + p.w for p in group)
+        y2 = max(p.y + p.h for p in group)
+        crop = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+        for p in group:
+            crop[p.y - y1 : p.y - y1 + p.h, p.x - x1 : p.x - x1 + p.w] |= p.unpack()
+        stitched.append((x1, y1, crop))
+        scores.append(tuple(max(values) for values in zip(*(p.score for p in group))))
+    return stitched, scores
+
+
+# --- Mask Filtering ---
+
+MASK_FILTER_KEYS = ("minScore", "minStability", "minArea", "maxArea", "nmsIoU", "topK")
+
+
+def maskScore(record):
+    # (predicted IoU, stability score) of a mask generator record
+    return (
+        float(record.get("predicted_iou", 1.0)),
+        float(record.get("stability_score", 1.0)),
+    )
+
+
+def cropIntersection(a, b):
+    # Overlapping pixels of two (x, y, crop) masks, only their boxes can overlap
+    (ax, ay, cropA), (bx, by, cropB) = a, b
+    overlap = intersectRects(
+        (ax, ay, ax + cropA.shape[1], ay + cropA.shape[0]),
+        (bx, by, bx + cropB.shape[1], by + cropB.shape[0]),
+    )
+    if overlap is None:
+        return 0
+    x1, y1, x2, y2 = overlap
+    return int(
+        np.count_nonzero(
+            cropA[y1 - ay : y2 - ay, x1 - ax : x2 - ax]
+            & cropB[y1 - by : y2 - by, x1 - bx : x2 - bx]
+        )
+    )
+
+
+def suppressOverlaps(crops, areas, order, iouThreshold):
+    # Greedy non-maximum suppression over masks sorted best first. The box
+    # overlap bounds the mask overlap, so the exact mask IoU is only computed
+    # for pairs that could reach the threshold.
+    rects = np.array(
+        [(x, y, x + crop.shape[1], y + crop.shape[0]) for x, y, crop in crops]
+    ).reshape(-1, 4)
+    areas = np.asarray(areas)
+    kept = []
+    for i in order:
+        if kept:
+            others = np.array(kept)
+            w = np.minimum(rects[others, 2], rects[i, 2])
+            w -= np.maximum(rects[others, 0], rects[i, 0])
+            h = np.minimum(rects[others, 3], rects[i, 3])
+            h -= np.maximum(rects[others, 1], rects[i, 1])
+            bound = np.minimum(
+                np.clip(w, 0, None) * np.clip(h, 0, None),
+                np.minimum(areas[others], areas[i]),
+            )
+            candidates = others[
+                bound >= iouThreshold * (areas[others] + areas[i] - bound)
+            ]
+            if any(
+                cropIntersection(crops[i], crops[j])
+                >= iouThreshold * (areas[i] + areas[j]) / (1 + iouThreshold)
+                for j in candidates
+            ):
+                continue
+        kept.append(i)
+    return kept
+
+
+def filterMasks(
+    crops,
+    scores,
+    minScore=0.0,
+    minStability=0.0,
+    minArea=0,
+    maxArea=0,
+    nmsIoU=0.0,
+    topK=0,
+):
+    """
+    Drops masks scoring below minScore (predicted IoU) or minStability, masks
+    outside [minArea, maxArea] pixels, masks overlapping a better one by
+    nmsIoU or more and all but the topK best. Zero disables a filter. Returns
+    the kept (x, y, crop) masks best first and reports the masks removed by
+    each filter. With every filter disabled the masks keep their order.
+    """
+    filters = (minScore, minStability, minArea, maxArea, nmsIoU, topK)
+    if not any(value > 0 for value in filters):
+        return list(crops)
+    with stageTimer("filter") as stage:
+        areas = [int(np.count_nonzero(crop)) for _, _, crop in crops]
+        kept = sorted(range(len(crops)), key=lambda i: -scores[i][0])
 
+        count = len(kept)
+        kept = [
+            i for i in kept if scores[i][0] >= minScore and scores[i][1] >= minStability
+        ]
+        stage["removed_score"] = count - len(kept)
 
-def saveMasks(masks, saveFileNoExt, formatBinary):
-    for i, mask in enumerate(masks):
-        filepath = saveFileNoExt + str(i) + ".seg"
-        arr = [[val for val in row] for row in mask]
-        saveMask(filepath, arr, formatBinary)
+        count = len(kept)
+        kept = [
+            i
+            for i in kept
+            if areas[i] >= minArea and (maxArea <= 0 or areas[i] <= maxArea)
+        ]
+        stage["removed_area"] = count - len(kept)
+
+        count = len(kept)
+        if nmsIoU > 0:
+            kept = suppressOverlaps(crops, areas, kept, nmsIoU)
+        stage["removed_nms"] = count - len(kept)
+
+        count = len(kept)
+        if topK > 0:
+            kept = kept[:topK]
+        stage["removed_top_k"] = count - len(kept)
+        stage["masks"] = len(kept)
+    return [crops[i] for i in kept]
+
+
+# --- Image Embedding Cache ---
+
+
+class EmbeddingCache:
+    """
+    Persists predictor image features keyed by the image pixels and model
+    identity, evicting the least recently used entries above maxBytes.
+    """
+
+    SUFFIX = ".emb"
+    # Entries of every format share the size cap
+    CACHE_SUFFIXES = (".emb", ".npz")
+
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+
+    @classmethod
+    def fromEnvironment(cls):
+        sizeMB = float(os.environ.get("SEGANY_CACHE_SIZE_MB", DEFAULT_CACHE_SIZE_MB))
+        if sizeMB <= 0:
+            return None
+        cacheDir = os.environ.get("SEGANY_CACHE_DIR", DEFAULT_CACHE_DIR)
+        return cls(cacheDir, int(sizeMB * 1024 * 1024))
+
+    @staticmethod
+    def key(modelId, cvImage):
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(modelId.encode("utf-8"))
+        digest.update(str((cvImage.shape, cvImage.dtype.str)).encode("utf-8"))
+        digest.update(np.ascontiguousarray(cvImage).data)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cacheDir, key + self.SUFFIX)
+
+    def load(self, key):
+        filepath = self.path(key)
+        if not os.path.exists(filepath):
+            return None
+        try:
+            state = self.read(filepath)
+        except Exception as e:
+            print(f"Discarding unreadable cache entry {filepath}: {e}")
+            os.remove(filepath)
+            return None
+        os.utime(filepath)  # Mark as recently used
+        return state
+
+    def store(self, key, state):
+        os.makedirs(self.cacheDir, exist_ok=True)
+        filepath = self.path(key)
+        tmpFilepath = filepath + ".%d.tmp" % os.getpid()
+        self.write(tmpFilepath, state)
+        os.replace(tmpFilepath, filepath)
+        self.evict()
+
+    def read(self, filepath):
+        import torch
+
+        return torch.load(filepath, map_location="cpu", weights_only=True)
+
+    def write(self, filepath, state):
+        import torch
+
+        torch.save(state, filepath)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if name.endswith(self.CACHE_SUFFIXES):
+                stat = os.stat(os.path.join(self.cacheDir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        totalBytes = sum(entry[1] for entry in entries)
+        for _, size, name in sorted(entries):
+            if totalBytes <= self.maxBytes:
+                break
+            os.remove(os.path.join(self.cacheDir, name))
+            totalBytes -= size
+
+
+class NumpyEmbeddingCache(EmbeddingCache):
+    # For backends without torch, the image state is a flat dict of arrays
+    SUFFIX = ".npz"
+
+    def read(self, filepath):
+        with np.load(filepath) as data:
+            return dict(data)
+
+    def write(self, filepath, state):
+        with open(filepath, "wb") as f:
+            np.savez(f, **state)
 
 
 # --- Strategy Pattern Implementation ---
 
 
+class RefineSession:
+    """
+    Click-to-refine state for one image: a predictor with the image embedding
+    set, the clicks so far and the low-res logits of the last prediction. The
+    logits are fed back as mask_input, so each refinement step is a single
+    decoder run.
+    """
+
+    def __init__(self, predictor, imageKey):
+        self.predictor = predictor
+        self.imageKey = imageKey
+        self.clicks = set()
+        self.logits = None
+
+    def update(self, points, labels):
+        # Clicks that extend the previous ones refine the last mask, anything
+        # else (a click was moved or removed) starts over on the same image
+        clicks = {(x, y, label) for (x, y), label in zip(points, labels)}
+        if not self.clicks <= clicks:
+            self.logits = None
+        self.clicks = clicks
+
+
+# --- CPU Performance Mode ---
+
+CPU_PERF_REPEAT = 3
+
+
+def cpuThreadCount():
+    # Cores this process may run on, fewer than os.cpu_count() under affinity
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def cpuSupportsBfloat16():
+    # Only native bfloat16 (AVX512-BF16 or AMX) beats float32, emulated is slower
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def castToFloat(value):
+    import torch
+
+    if isinstance(value, torch.Tensor):
+        return value.float() if value.is_floating_point() else value
+    if isinstance(value, dict):
+        return {key: castToFloat(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(castToFloat(item) for item in value)
+    return value
+
+
+def optimizeEncoderForCpu(encoder, useBfloat16):
+    """
+    Switches the image encoder, where nearly all of the CPU time goes, to
+    channels-last layout and optionally bfloat16 autocast. The outputs are cast
+    back to float32 so the prompt and mask decoders run unchanged.
+    """
+    import torch
+
+    encoder.to(memory_format=torch.channels_last)
+    forward = encoder.forward
+
+    def cpuForward(x, *args, **kwargs):
+        if x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if not useBfloat16:
+            return forward(x, *args, **kwargs)
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            out = forward(x, *args, **kwargs)
+        return castToFloat(out)
+
+    encoder.forward = cpuForward
+
+
 class SegmentationStrategy:
+    embedding_cache_cls = EmbeddingCache
+    # "sam1" or "sam2", the auto segmentation settings differ between them
+    family = None
+
+    def __init__(self):
+        self.embedding_cache = None
+        self.model_id = None
+        self.cpu_perf = False
+        self.cpu_bfloat16 = False
+        self.cpu_threads = None
+        self.import_times = []
+        # Kept across jobs while the model stays loaded in a bridge server
+        self.refine_session = None
+
+    def import_backend(self):
+        raise NotImplementedError
+
     def get_model_type_from_filename(self, model_filename):
         raise NotImplementedError
 
     def load_model(self, checkPtFilePath, modelType):
         raise NotImplementedError
 
-    def segment_auto(self, sam, cvImage, saveFileNoExt, formatBinary, **kwargs):
+    def model_family(self, sam):
+        return self.family
+
+    def load_weights(self, model, checkPtFilePath):
+        if not supportsAssignLoad():
+            state_dict = loadStateDict(checkPtFilePath)
+            model.load_state_dict(state_dict)
+            del state_dict
+            return model
+        # The checkpoint tensors replace the model's instead of being copied
+        # into them, and any real weights are dropped before the checkpoint
+        # is read, so only one copy of the weights is ever in memory. Buffers
+        # the checkpoint does not hold keep their values.
+        persistent = set(model.state_dict())
+        kept = [
+            (name, buffer)
+            for name, buffer in model.named_buffers()
+            if name not in persistent
+        ]
+        model.to("meta")
+        state_dict = loadStateDict(checkPtFilePath)
+        model.load_state_dict(state_dict, assign=True)
+        del state_dict
+        for name, buffer in kept:
+            moduleName, _, bufferName = name.rpartition(".")
+            setattr(model.get_submodule(moduleName), bufferName, buffer)
+        return model
+
+    def predict_auto(self, sam, cvImage, **kwargs):
+        # Returns the mask generator records (segmentation, predicted_iou,
+        # stability_score, ...)
         raise NotImplementedError
 
-    def segment_box(self, sam, cvImage, maskType, boxCos, saveFileNoExt, formatBinary):
+    def predict_box(self, sam, cvImage, maskType, boxCos):
+        predictor = self.predictor_cls(sam)
+        self.set_image(predictor, cvImage)
+        input_box = np.array(boxCos)
+        with stageTimer("predict"):
+            masks, _, _ = predictor.predict(
+                point_coords=None,
+                point_labels=None,
+                box=input_box,
+                multimask_output=(maskType == "Multiple"),
+            )
+        return masks
+
+    def predict_sel(self, sam, cvImage, maskType, pts, boxCos):
+        predictor = self.predictor_cls(sam)
+        self.set_image(predictor, cvImage)
+        input_point = np.array(pts)
+        input_label = np.array([1] * len(input_point))
+        input_box = np.array(boxCos) if boxCos else None
+        with stageTimer("predict"):
+            masks, _, _ = predictor.predict(
+                point_coords=input_point,
+                point_labels=input_label,
+                box=input_box,
+                multimask_output=(maskType == "Multiple"),
+            )
+        return masks
+
+    def predict_prompts(self, sam, cvImage, maskType, prompts):
+        """
+        Predicts masks for many prompts on a single image embedding. prompts
+        is a list of dicts with "points" and / or "box"; prompts of the same
+        kind run as batched decoder passes. Returns (promptId, mask) pairs in
+        prompt order.
+        """
+        predictor = self.predictor_cls(sam)
+        self.set_image(predictor, cvImage)
+        multimask = maskType == "Multiple"
+        height, width = cvImage.shape[:2]
+        # The decoders upsample float logits to full size before thresholding
+        maskBytes = (3 if multimask else 1) * height * width * 4
+        batchSize = max(1, PROMPT_BATCH_MAX_BYTES // maskBytes)
+
+        groups = {}
+        for promptId, prompt in enumerate(prompts):
+            groups.setdefault(tuple(sorted(prompt)), []).append(promptId)
+
+        results = []
+        done = 0
+        with stageTimer("predict") as stage:
+            stage["prompts"] = len(prompts)
+            for promptIds in groups.values():
+                for start in range(0, len(promptIds), batchSize):
+                    batchIds = promptIds[start : start + batchSize]
+                    coords, labels, boxes = batchPrompts(
+                        [prompts[promptId] for promptId in batchIds]
+                    )
+                    masks = self.predict_batch(
+                        predictor, coords, labels, boxes, multimask
+                    )
+                    for promptId, promptMasks in zip(batchIds, masks):
+                        results.extend((promptId, mask) for mask in promptMasks)
+                    done += len(batchIds)
+                    emitEvent(
+                        "progress", stage="predict", done=done, total=len(prompts)
+                    )
+                    checkCancelled()
+        results.sort(key=lambda result: result[0])
+        return results
+
+    def predict_batch(self, predictor, coords, labels, boxes, multimask):
+        # Returns masks of shape (prompts, masks per prompt, height, width)
         raise NotImplementedError
 
+    def predict_auto_tiled(
+        self,
+        sam,
+        cvImage,
+        tileSize,
+        tileOverlap=DEFAULT_TILE_OVERLAP,
+        maxMemoryMB=DEFAULT_TILE_MAX_MEMORY_MB,
+        **kwargs,
+    ):
+        height, width = cvImage.shape[:2]
+        maxBytes = maxMemoryMB * 1024 * 1024
+        # Half of the ceiling goes to the tile being segmented, the other half
+        # to the packed masks collected so far
+        maxTileSize = int(np.sqrt(maxBytes / 2 / TILE_BYTES_PER_PIXEL))
+        if tileSize > maxTileSize:
+            print(f"Reducing tile size from {tileSize} to {maxTileSize} px")
+            tileSize = maxTileSize
+        tileOverlap = min(tileOverlap, tileSize // 2)
+
+        tiles = []
+        storedBytes = 0
+        ys = tileOrigins(height, tileSize, tileOverlap)
+        xs = tileOrigins(width, tileSize, tileOverlap)
+        for ty in ys:
+            for tx in xs:
+                rect = (tx, ty, min(tx + tileSize, width), min(ty + tileSize, height))
+                tile = np.ascontiguousarray(
+                    cvImage[rect[1] : rect[3], rect[0] : rect[2]]
+                )
+                pieces = []
+                for record in self.predict_auto(sam, tile, **kwargs):
+                    x, y, crop = cropMask(record["segmentation"])
+                    if crop.size > 0:
+                        score = maskScore(record)
+                        pieces.append(PackedCrop(tx + x, ty + y, crop, score))
+                del tile
+                storedBytes += sum(piece.nbytes for piece in pieces)
+                tiles.append((rect, pieces))
+                print(f"Tile {len(tiles)}/{len(xs) * len(ys)}: {len(pieces)} masks")
+                emitEvent(
+                    "progress", stage="tiles", done=len(tiles), total=len(xs) * len(ys)
+                )
+                checkCancelled()
+
+                if storedBytes > maxBytes / 2:
+                    storedBytes = self.drop_smallest(tiles, maxBytes / 2)
+
+        with stageTimer("stitch") as stage:
+            crops, scores = stitchTileMasks(tiles)
+            stage["masks"] = len(crops)
+        return crops, scores
+
+    def drop_smallest(self, tiles, maxBytes):
+        pieces = sorted(
+            (piece for _, tilePieces in tiles for piece in tilePieces),
+            key=lambda piece: piece.area,
+            reverse=True,
+        )
+        kept, storedBytes = set(), 0
+        for piece in pieces:
+            if storedBytes + piece.nbytes > maxBytes:
+                break
+            kept.add(id(piece))
+            storedBytes += piece.nbytes
+        print(
+            f"Mask memory ceiling reached, dropping {len(pieces) - len(kept)} "
+            "smallest masks"
+        )
+        for i, (rect, tilePieces) in enumerate(tiles):
+            tiles[i] = (rect, [piece for piece in tilePieces if id(piece) in kept])
+        return storedBytes
+
+    def predict_auto_crops(self, sam, cvImage, tileSize=0, **kwargs):
+        # Returns filtered (x, y, crop) tuples best first, tiling images
+        # larger than tileSize
+        filters = {key: kwargs.pop(key) for key in MASK_FILTER_KEYS if key in kwargs}
+        if tileSize > 0 and max(cvImage.shape[:2]) > tileSize:
+            crops, scores = self.predict_auto_tiled(sam, cvImage, tileSize, **kwargs)
+        else:
+            kwargs.pop("tileOverlap", None)
+            kwargs.pop("maxMemoryMB", None)
+            records = self.predict_auto(sam, cvImage, **kwargs)
+            crops = [cropMask(record["segmentation"]) for record in records]
+            scores = [maskScore(record) for record in records]
+        return filterMasks(crops, scores, **filters)
+
+    def segment_auto(self, sam, cvImage, saveFileNoExt, maskFormat, **kwargs):
+        crops = self.predict_auto_crops(sam, cvImage, **kwargs)
+        saveMaskCrops(cvImage.shape[:2], crops, saveFileNoExt, maskFormat)
+
+    def segment_box(self, sam, cvImage, maskType, boxes, saveFileNoExt, maskFormat):
+        if len(boxes) == 1:
+            masks = self.predict_box(sam, cvImage, maskType, boxes[0])
+            saveMasks(masks, saveFileNoExt, maskFormat)
+            return
+        prompts = [{"box": box} for box in boxes]
+        self.segment_prompts(sam, cvImage, maskType, prompts, saveFileNoExt, maskFormat)
+
     def segment_sel(
-        self, sam, cvImage, maskType, selFile, boxCos, saveFileNoExt, formatBinary
+        self, sam, cvImage, maskType, selFile, boxCos, saveFileNoExt, maskFormat
     ):
-        raise NotImplementedError
+        components = readSelFile(selFile)
+        if len(components) == 1:
+            masks = self.predict_sel(sam, cvImage, maskType, components[0], boxCos)
+            saveMasks(masks, saveFileNoExt, maskFormat)
+            return
+        prompts = [{"points": pts} for pts in components]
+        if boxCos:
+            for prompt in prompts:
+                prompt["box"] = boxCos
+        self.segment_prompts(sam, cvImage, maskType, prompts, saveFileNoExt, maskFormat)
+
+    def segment_refine(
+        self, sam, cvImage, maskType, clicksFile, saveFileNoExt, maskFormat
+    ):
+        points, labels = readClicksFile(clicksFile)
+        if not points:
+            print("No clicks to segment")
+            return
+        imageKey = EmbeddingCache.key(self.model_id or "", cvImage)
+        session = self.refine_session
+        if session is None or session.imageKey != imageKey:
+            predictor = self.predictor_cls(sam)
+            self.set_image(predictor, cvImage)
+            session = self.refine_session = RefineSession(predictor, imageKey)
+        session.update(points, labels)
+
+        # The first prediction resolves ambiguity with multiple masks, later
+        # ones refine the best of them
+        multimask = session.logits is None
+        with stageTimer("predict") as stage:
+            stage["clicks"] = len(points)
+            stage["refined"] = not multimask
+            masks, scores, logits = session.predictor.predict(
+                point_coords=np.array(points),
+                point_labels=np.array(labels),
+                mask_input=session.logits,
+                multimask_output=multimask,
+            )
+        best = int(np.argmax(scores))
+        session.logits = logits[best : best + 1]
+        if not (multimask and maskType == "Multiple"):
+            masks = masks[best : best + 1]
+        saveMasks(masks, saveFileNoExt, maskFormat)
+
+    def precompute_embedding(self, sam, cvImage):
+        # Fills the embedding cache for a later job on the same image
+        if self.embedding_cache is None:
+            print("Embedding cache disabled, nothing to precompute")
+            return
+        self.set_image(self.predictor_cls(sam), cvImage)
+
+    def segment_prompts(
+        self, sam, cvImage, maskType, prompts, saveFileNoExt, maskFormat
+    ):
+        results = self.predict_prompts(sam, cvImage, maskType, prompts)
+        crops = [cropMask(mask) for _, mask in results]
+        promptIds = [promptId for promptId, _ in results]
+        saveMaskCrops(cvImage.shape[:2], crops, saveFileNoExt, maskFormat, promptIds)
 
     def run_test(self, sam):
-        raise NotImplementedError
+        npArr = np.zeros((50, 50), np.uint8)
+        cvImage = cv2.cvtColor(npArr, cv2.COLOR_GRAY2BGR)
+        predictor = self.predictor_cls(sam)
+        predictor.set_image(cvImage)
+        input_box = np.array([10, 10, 20, 20])
+        predictor.predict(
+            point_coords=None, point_labels=None, box=input_box, multimask_output=False
+        )
 
     def cleanup(self):
         pass
 
+    def move_to_device(self, sam):
+        import torch
+
+        if torch.cuda.is_available():
+            with stageTimer("device_move"):
+                sam.to(device="cuda")
+            print("Model moved to CUDA")
+
+    def on_cpu(self, sam):
+        return next(sam.parameters()).device.type == "cpu"
+
+    def enable_cpu_perf(self, sam):
+        # Changes the model in place, so it stays on for as long as it is loaded
+        # and the bridge server keeps such a model apart from the default one
+        if self.cpu_perf:
+            return
+        import torch
+
+        threads = self.cpu_threads = cpuThreadCount()
+        # The intra-op thread count is set per job in inference(). The inter-op
+        # one can only be set once, before any parallel work in the process,
+        # so in a bridge server that already ran a job it stays unchanged.
+        try:
+            torch.set_num_interop_threads(max(1, threads // 4))
+        except RuntimeError:
+            pass
+        self.cpu_bfloat16 = cpuSupportsBfloat16()
+        optimizeEncoderForCpu(sam.image_encoder, self.cpu_bfloat16)
+        self.cpu_perf = True
+        # The optimized encoder's embeddings differ slightly, so they are cached
+        # under their own key
+        if self.model_id is not None:
+            self.model_id += ":cpu-perf"
+        print(
+            f"CPU performance mode: {threads} threads, "
+            f"bfloat16 {'on' if self.cpu_bfloat16 else 'off'}"
+        )
+
+    @contextlib.contextmanager
+    def inference(self):
+        if not self.cpu_perf:
+            yield
+            return
+        import torch
+
+        # The thread count applies to the whole process, so it is restored
+        # for the default mode jobs a bridge server runs next
+        threads = torch.get_num_threads()
+        torch.set_num_threads(self.cpu_threads)
+        try:
+            with torch.inference_mode():
+                yield
+        finally:
+            torch.set_num_threads(threads)
+
+    def get_image_state(self, predictor):
+        raise NotImplementedError
+
+    def set_image_state(self, predictor, state):
+        raise NotImplementedError
+
+    def set_image(self, predictor, cvImage):
+        cache = self.embedding_cache
+        key = None
+        with stageTimer("set_image") as stage:
+            stage["cached"] = False
+            if cache is not None and self.model_id is not None:
+                key = cache.key(self.model_id, cvImage)
+                state = cache.load(key)
+                if state is not None:
+                    self.set_image_state(predictor, state)
+                    stage["cached"] = True
+                    print("Image embedding restored from cache")
+                    return
+            predictor.set_image(cvImage)
+        if key is not None:
+            try:
+                cache.store(key, self.get_image_state(predictor))
+            except OSError as e:
+                print(f"Could not cache image embedding: {e}")
+
 
 class SAM1Strategy(SegmentationStrategy):
+    family = "sam1"
     MODEL_TYPE_LOOKUP = {
         "sam_vit_h_4b8939": "vit_h",
         "sam_vit_l_0b3195": "vit_l",
         "sam_vit_b_01ec64": "vit_b",
     }
 
+    def import_backend(self):
+        importModule("torch", self.import_times)
+        segment_anything = importModule("segment_anything", self.import_times)
+        self.sam_model_registry = segment_anything.sam_model_registry
+        self.predictor_cls = segment_anything.SamPredictor
+        self.mask_generator_cls = segment_anything.SamAutomaticMaskGenerator
+
     def get_model_type_from_filename(self, model_filename):
         filename_stem = os.path.splitext(model_filename)[0]
         model_type = self.MODEL_TYPE_LOOKUP.get(filename_stem)
@@ -139,65 +1338,63 @@ class SAM1Strategy(SegmentationStrategy):
 
     def load_model(self, checkPtFilePath, modelType):
         try:
-            sam = sam_model_registry[modelType](checkpoint=checkPtFilePath)
+            buildContext = (
+                metaParameters() if supportsAssignLoad() else contextlib.nullcontext()
+            )
+            with buildContext:
+                model = self.sam_model_registry[modelType]()
+            sam = self.load_weights(model, checkPtFilePath)
             print("SAM1 Model loaded successfully!")
             return sam
         except Exception as e:
             print(f"Error loading SAM1 model: {e}")
-            return None
-
-    def segment_auto(self, sam, cvImage, saveFileNoExt, formatBinary, **kwargs):
-        mask_generator = SamAutomaticMaskGenerator_SAM1(sam)
-        masks = mask_generator.generate(cvImage)
-        masks = [mask["segmentation"] for mask in masks]
-        saveMasks(masks, saveFileNoExt, formatBinary)
-
-    def segment_box(self, sam, cvImage, maskType, boxCos, saveFileNoExt, formatBinary):
-        predictor = SamPredictor(sam)
-        predictor.set_image(cvImage)
-        input_box = np.array(boxCos)
-        masks, _, _ = predictor.predict(
-            point_coords=None,
-            point_labels=None,
-            box=input_box,
-            multimask_output=(maskType == "Multiple"),
-        )
-        saveMasks(masks, saveFileNoExt, formatBinary)
-
-    def segment_sel(
-        self, sam, cvImage, maskType, selFile, boxCos, saveFileNoExt, formatBinary
-    ):
-        pts = []
-        with open(selFile, "r") as f:
-            lines = f.readlines()
-            for line in lines:
-                cos = line.split(" ")
-                pts.append([int(cos[0]), int(cos[1])])
-        predictor = SamPredictor(sam)
-        predictor.set_image(cvImage)
-        input_point = np.array(pts)
-        input_label = np.array([1] * len(input_point))
-        input_box = np.array(boxCos) if boxCos else None
-        masks, _, _ = predictor.predict(
-            point_coords=input_point,
-            point_labels=input_label,
-            box=input_box,
-            multimask_output=(maskType == "Multiple"),
+            return None
+
+    def get_image_state(self, predictor):
+        return {
+            "features": predictor.features.cpu(),
+            "original_size": list(predictor.original_size),
+            "input_size": list(predictor.input_size),
+        }
+
+    def set_image_state(self, predictor, state):
+        predictor.reset_image()
+        predictor.features = state["features"].to(predictor.device)
+        predictor.original_size = tuple(state["original_size"])
+        predictor.input_size = tuple(state["input_size"])
+        predictor.is_image_set = True
+
+    def predict_batch(self, predictor, coords, labels, boxes, multimask):
+        import torch
+
+        device = predictor.device
+        coordsTorch = labelsTorch = boxesTorch = None
+        if coords is not None:
+            coords = predictor.transform.apply_coords(coords, predictor.original_size)
+            coordsTorch = torch.as_tensor(coords, dtype=torch.float, device=device)
+            labelsTorch = torch.as_tensor(labels, dtype=torch.int, device=device)
+        if boxes is not None:
+            boxes = predictor.transform.apply_boxes(boxes, predictor.original_size)
+            boxesTorch = torch.as_tensor(boxes, dtype=torch.float, device=device)
+        masks, _, _ = predictor.predict_torch(
+            coordsTorch, labelsTorch, boxesTorch, multimask_output=multimask
         )
-        saveMasks(masks, saveFileNoExt, formatBinary)
+        return masks.cpu().numpy()
 
-    def run_test(self, sam):
-        npArr = np.zeros((50, 50), np.uint8)
-        cvImage = cv2.cvtColor(npArr, cv2.COLOR_GRAY2BGR)
-        predictor = SamPredictor(sam)
-        predictor.set_image(cvImage)
-        input_box = np.array([10, 10, 20, 20])
-        predictor.predict(
-            point_coords=None, point_labels=None, box=input_box, multimask_output=False
+    def predict_auto(self, sam, cvImage, **kwargs):
+        mask_generator = self.mask_generator_cls(
+            sam, points_per_side=kwargs.get("pointsPerSide", 32)
         )
+        with stageTimer("generate"):
+            return mask_generator.generate(cvImage)
+
+
+# Auto mode point grid for the SAM2 segmentation resolution setting
+SEG_RES_POINTS_PER_SIDE = {"Low": 16, "Medium": 32, "High": 64}
 
 
 class SAM2Strategy(SegmentationStrategy):
+    family = "sam2"
     MODEL_TYPE_LOOKUP = {
         "sam2_hiera_large": "sam2_hiera_large",
         "sam2_hiera_base_plus": "sam2_hiera_base_plus",
@@ -209,8 +1406,16 @@ class SAM2Strategy(SegmentationStrategy):
         "sam2.1_hiera_tiny": "sam2_hiera_tiny",
     }
 
-    def __init__(self):
-        self._temp_pth_path = None
+    def import_backend(self):
+        importModule("torch", self.import_times)
+        build_sam = importModule("sam2.build_sam", self.import_times)
+        image_predictor = importModule("sam2.sam2_image_predictor", self.import_times)
+        mask_generator = importModule(
+            "sam2.automatic_mask_generator", self.import_times
+        )
+        self.build_sam2 = build_sam.build_sam2
+        self.predictor_cls = image_predictor.SAM2ImagePredictor
+        self.mask_generator_cls = mask_generator.SAM2AutomaticMaskGenerator
 
     def get_model_type_from_filename(self, model_filename):
         filename_stem = os.path.splitext(model_filename)[0]
@@ -227,18 +1432,6 @@ class SAM2Strategy(SegmentationStrategy):
             )
             return None
 
-    def _convert_safetensors_to_pth(self, safetensors_path, pth_path):
-        try:
-            from safetensors.torch import load_file
-
-            state_dict = load_file(safetensors_path)
-            checkpoint = {"model": state_dict}
-            torch.save(checkpoint, pth_path)
-            return True
-        except Exception as e:
-            print(f"Error converting safetensors to pth: {e}")
-            return False
-
     def load_model(self, checkPtFilePath, modelType):
         model_configs = {
             "sam2_hiera_tiny": "sam2_hiera_t.yaml",
@@ -247,180 +1440,1101 @@ class SAM2Strategy(SegmentationStrategy):
             "sam2_hiera_large": "sam2_hiera_l.yaml",
         }
         config_file = model_configs.get(modelType, "sam2_hiera_l.yaml")
-        actual_checkpoint_path = checkPtFilePath
-        if checkPtFilePath.endswith(".safetensors"):
-            print("Converting safetensors to pth format...")
-            self._temp_pth_path = checkPtFilePath.replace(".safetensors", "_temp.pth")
-            if self._convert_safetensors_to_pth(checkPtFilePath, self._temp_pth_path):
-                actual_checkpoint_path = self._temp_pth_path
-                print(f"Converted to: {self._temp_pth_path}")
-            else:
-                print("Failed to convert safetensors file")
-                return None
         try:
-            sam = build_sam2(config_file, actual_checkpoint_path)
+            # Build without a checkpoint and load the weights directly, so
+            # .safetensors files need no temporary .pth copy. build_sam2 moves
+            # the model to the device, which meta parameters cannot take, so
+            # load_weights drops the random weights before the load instead.
+            sam = self.build_sam2(config_file, None, device="cpu")
+            self.load_weights(sam, checkPtFilePath)
             print("SAM2 Model loaded successfully!")
             return sam
         except Exception as e:
             print(f"Error loading SAM2 model: {e}")
-            self.cleanup()
             return None
 
-    def segment_auto(self, sam, cvImage, saveFileNoExt, formatBinary, **kwargs):
-        points_per_side = 32
-        if kwargs.get("segRes") == "Low":
-            points_per_side = 16
-        elif kwargs.get("segRes") == "High":
-            points_per_side = 64
-        mask_generator = SAM2AutomaticMaskGenerator(
+    def get_image_state(self, predictor):
+        features = predictor._features
+        return {
+            "image_embed": features["image_embed"].cpu(),
+            "high_res_feats": [feat.cpu() for feat in features["high_res_feats"]],
+            "orig_hw": [list(hw) for hw in predictor._orig_hw],
+        }
+
+    def set_image_state(self, predictor, state):
+        predictor.reset_predictor()
+        device = predictor.device
+        predictor._features = {
+            "image_embed": state["image_embed"].to(device),
+            "high_res_feats": [feat.to(device) for feat in state["high_res_feats"]],
+        }
+        predictor._orig_hw = [tuple(hw) for hw in state["orig_hw"]]
+        predictor._is_image_set = True
+        predictor._is_batch = False
+
+    def predict_batch(self, predictor, coords, labels, boxes, multimask):
+        # SAM2ImagePredictor.predict batches prompts natively, but squeezes
+        # the prompt axis away when there is a single prompt
+        masks, _, _ = predictor.predict(
+            point_coords=coords,
+            point_labels=labels,
+            box=boxes,
+            multimask_output=multimask,
+        )
+        return masks[None] if masks.ndim == 3 else masks
+
+    def predict_auto(self, sam, cvImage, **kwargs):
+        points_per_side = kwargs.get(
+            "pointsPerSide", SEG_RES_POINTS_PER_SIDE.get(kwargs.get("segRes"), 32)
+        )
+        mask_generator = self.mask_generator_cls(
             model=sam,
             points_per_side=points_per_side,
             crop_n_layers=kwargs.get("cropNLayers", 0),
             min_mask_region_area=kwargs.get("minMaskArea", 0),
         )
-        masks = mask_generator.generate(cvImage)
-        masks = [mask["segmentation"] for mask in masks]
-        saveMasks(masks, saveFileNoExt, formatBinary)
+        with stageTimer("generate"):
+            return mask_generator.generate(cvImage)
 
-    def segment_box(self, sam, cvImage, maskType, boxCos, saveFileNoExt, formatBinary):
-        predictor = SAM2ImagePredictor(sam)
-        predictor.set_image(cvImage)
-        input_box = np.array(boxCos)
-        masks, _, _ = predictor.predict(
-            point_coords=None,
-            point_labels=None,
-            box=input_box,
-            multimask_output=(maskType == "Multiple"),
+
+# --- ONNX Runtime Backend ---
+
+ONNX_ENCODER_SUFFIX = ".encoder.onnx"
+ONNX_DECODER_SUFFIX = ".decoder.onnx"
+# Side of the square encoder input and of the low resolution decoder masks
+ONNX_IMAGE_SIZE = 1024
+ONNX_LOW_RES_SIZE = 256
+SAM1_PIXEL_MEAN = np.array([123.675, 116.28, 103.53], dtype=np.float32)
+SAM1_PIXEL_STD = np.array([58.395, 57.12, 57.375], dtype=np.float32)
+SAM2_PIXEL_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+SAM2_PIXEL_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+# SAM2 replaces an unstable single mask with the best of the multimask outputs
+SAM2_STABILITY_DELTA = 0.05
+SAM2_STABILITY_THRESHOLD = 0.98
+
+
+def onnxModelStem(filepath):
+    # sam_vit_b_01ec64.encoder.onnx -> sam_vit_b_01ec64, the decoder works too
+    filename = os.path.basename(filepath)
+    for suffix in (ONNX_ENCODER_SUFFIX, ONNX_DECODER_SUFFIX):
+        if filename.endswith(suffix):
+            return filename[: -len(suffix)]
+    return os.path.splitext(filename)[0]
+
+
+def makeOnnxSession(ort, filepath):
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # One graph at a time, every core on the operators inside it
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = cpuThreadCount()
+    options.inter_op_num_threads = 1
+    return ort.InferenceSession(
+        filepath, sess_options=options, providers=["CPUExecutionProvider"]
+    )
+
+
+def resizeImage(image, width, height):
+    # Area averaging is the closest match to the antialiased downscaling of
+    # the PyTorch transforms
+    shrinking = width < image.shape[1] or height < image.shape[0]
+    interpolation = cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR
+    return cv2.resize(image, (width, height), interpolation=interpolation)
+
+
+def stabilityScore(logits, threshold, offset):
+    # IoU of the masks thresholded above and below threshold, per mask
+    intersections = (logits > threshold + offset).sum(axis=(-1, -2))
+    unions = (logits > threshold - offset).sum(axis=(-1, -2))
+    return np.where(unions > 0, intersections / np.maximum(unions, 1), 1.0)
+
+
+def maskBox(mask):
+    # Inclusive XYXY box, or None for an empty mask
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return [int(cols[0]), int(rows[0]), int(cols[-1]), int(rows[-1])]
+
+
+def suppressBoxes(boxes, scores, iouThreshold):
+    # Greedy non-maximum suppression, returns the kept indices best first
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    keep = []
+    while order.size > 0:
+        i, rest = order[0], order[1:]
+        keep.append(int(i))
+        x0 = np.maximum(boxes[i, 0], boxes[rest, 0])
+        y0 = np.maximum(boxes[i, 1], boxes[rest, 1])
+        x1 = np.minimum(boxes[i, 2], boxes[rest, 2])
+        y1 = np.minimum(boxes[i, 3], boxes[rest, 3])
+        inter = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+        union = areas[i] + areas[rest] - inter
+        ious = np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+        order = rest[ious <= iouThreshold]
+    return keep
+
+
+class ONNXModel:
+    """
+    Encoder and decoder sessions of an exported SAM1 or SAM2 model, with the
+    image and prompt transforms of the matching PyTorch predictor.
+    """
+
+    def __init__(self, family, encoder, decoder):
+        self.family = family
+        self.encoder = encoder
+        self.decoder = decoder
+        self.feature_names = [output.name for output in encoder.get_outputs()]
+
+    def preprocess(self, image):
+        # Returns the encoder input and the size of the image inside it
+        height, width = image.shape[:2]
+        size = ONNX_IMAGE_SIZE
+        if self.family == "sam1":
+            # Longest side resized to the input size, padded at bottom right
+            scale = size / max(height, width)
+            inputSize = (int(height * scale + 0.5), int(width * scale + 0.5))
+            resized = resizeImage(image, inputSize[1], inputSize[0])
+            pixels = np.zeros((size, size, 3), dtype=np.float32)
+            pixels[: inputSize[0], : inputSize[1]] = (
+                resized.astype(np.float32) - SAM1_PIXEL_MEAN
+            ) / SAM1_PIXEL_STD
+        else:
+            inputSize = (size, size)
+            resized = resizeImage(image, size, size)
+            pixels = resized.astype(np.float32) / 255
+            pixels = (pixels - SAM2_PIXEL_MEAN) / SAM2_PIXEL_STD
+        return np.ascontiguousarray(pixels.transpose(2, 0, 1)[None]), inputSize
+
+    def transform_coords(self, coords, originalSize, inputSize):
+        scale = np.array(
+            [inputSize[1] / originalSize[1], inputSize[0] / originalSize[0]],
+            dtype=np.float32,
         )
-        saveMasks(masks, saveFileNoExt, formatBinary)
+        return np.asarray(coords, dtype=np.float32) * scale
 
-    def segment_sel(
-        self, sam, cvImage, maskType, selFile, boxCos, saveFileNoExt, formatBinary
+    def decode(self, features, coords, labels, maskInput=None):
+        # Returns the low resolution logits and the predicted IoUs of all four
+        # mask tokens for a batch of prompts
+        count = coords.shape[0]
+        if maskInput is None:
+            maskInput = np.zeros(
+                (count, 1, ONNX_LOW_RES_SIZE, ONNX_LOW_RES_SIZE), dtype=np.float32
+            )
+            hasMaskInput = np.zeros(count, dtype=np.float32)
+        else:
+            hasMaskInput = np.ones(count, dtype=np.float32)
+        feeds = dict(features)
+        feeds.update(
+            point_coords=coords.astype(np.float32),
+            point_labels=labels.astype(np.float32),
+            mask_input=maskInput.astype(np.float32),
+            has_mask_input=hasMaskInput,
+        )
+        lowRes, ious = self.decoder.run(None, feeds)
+        return lowRes, ious
+
+    def select_masks(self, lowRes, ious, multimask):
+        # Token 0 is the single mask output, tokens 1-3 the multimask outputs
+        if multimask:
+            return lowRes[:, 1:], ious[:, 1:]
+        if self.family == "sam1":
+            return lowRes[:, :1], ious[:, :1]
+        stability = stabilityScore(lowRes[:, 0], 0.0, SAM2_STABILITY_DELTA)
+        best = np.argmax(ious[:, 1:], axis=1) + 1
+        index = np.where(stability >= SAM2_STABILITY_THRESHOLD, 0, best)
+        rows = np.arange(len(index))
+        return lowRes[rows, index][:, None], ious[rows, index][:, None]
+
+    def upscale_mask(self, logits, inputSize, originalSize):
+        if self.family == "sam1":
+            size = ONNX_IMAGE_SIZE
+            logits = cv2.resize(logits, (size, size), interpolation=cv2.INTER_LINEAR)
+            logits = logits[: inputSize[0], : inputSize[1]]
+        return cv2.resize(
+            logits,
+            (originalSize[1], originalSize[0]),
+            interpolation=cv2.INTER_LINEAR,
+        )
+
+
+class ONNXPredictor:
+    """
+    The part of the SamPredictor interface the strategies use, on top of an
+    ONNXModel.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.reset_image()
+
+    def reset_image(self):
+        self.features = None
+        self.original_size = None
+        self.input_size = None
+
+    def set_image(self, image):
+        pixels, self.input_size = self.model.preprocess(image)
+        self.original_size = tuple(image.shape[:2])
+        outputs = self.model.encoder.run(None, {"image": pixels})
+        self.features = dict(zip(self.model.feature_names, outputs))
+
+    def prompt_arrays(self, coords, labels, boxes):
+        # Boxes become two corner points labelled 2 and 3. Without a box SAM1
+        # adds a padding point, SAM2 always does.
+        count = len(coords) if coords is not None else len(boxes)
+        parts, partLabels = [], []
+        if coords is not None:
+            parts.append(
+                self.model.transform_coords(coords, self.original_size, self.input_size)
+            )
+            partLabels.append(np.asarray(labels, dtype=np.float32))
+        if boxes is not None:
+            corners = np.asarray(boxes, dtype=np.float32).reshape(count, 2, 2)
+            parts.append(
+                self.model.transform_coords(
+                    corners, self.original_size, self.input_size
+                )
+            )
+            partLabels.append(np.tile(np.float32([2, 3]), (count, 1)))
+        if boxes is None or self.model.family == "sam2":
+            parts.append(np.zeros((count, 1, 2), dtype=np.float32))
+            partLabels.append(np.full((count, 1), -1, dtype=np.float32))
+        return np.concatenate(parts, axis=1), np.concatenate(partLabels, axis=1)
+
+    def predict_batch(self, coords, labels, boxes, multimask, maskInput=None):
+        pointCoords, pointLabels = self.prompt_arrays(coords, labels, boxes)
+        lowRes, ious = self.model.decode(
+            self.features, pointCoords, pointLabels, maskInput
+        )
+        lowRes, ious = self.model.select_masks(lowRes, ious, multimask)
+        height, width = self.original_size
+        masks = np.empty(lowRes.shape[:2] + (height, width), dtype=bool)
+        for i in range(lowRes.shape[0]):
+            for j in range(lowRes.shape[1]):
+                logits = self.model.upscale_mask(
+                    lowRes[i, j], self.input_size, self.original_size
+                )
+                masks[i, j] = logits > 0
+        return masks, ious, lowRes
+
+    def predict(
+        self,
+        point_coords=None,
+        point_labels=None,
+        box=None,
+        mask_input=None,
+        multimask_output=True,
     ):
-        pts = []
-        with open(selFile, "r") as f:
-            lines = f.readlines()
-            for line in lines:
-                cos = line.split(" ")
-                pts.append([int(cos[0]), int(cos[1])])
-        predictor = SAM2ImagePredictor(sam)
-        predictor.set_image(cvImage)
-        input_point = np.array(pts)
-        input_label = np.array([1] * len(input_point))
-        input_box = np.array(boxCos) if boxCos else None
-        masks, _, _ = predictor.predict(
-            point_coords=input_point,
-            point_labels=input_label,
-            box=input_box,
-            multimask_output=(maskType == "Multiple"),
+        coords = labels = boxes = maskInput = None
+        if point_coords is not None:
+            coords = np.asarray(point_coords, dtype=np.float32)[None]
+            labels = np.asarray(point_labels, dtype=np.float32)[None]
+        if box is not None:
+            boxes = np.asarray(box, dtype=np.float32).reshape(1, 4)
+        if mask_input is not None:
+            maskInput = np.asarray(mask_input, dtype=np.float32)[None]
+        masks, ious, lowRes = self.predict_batch(
+            coords, labels, boxes, multimask_output, maskInput
         )
-        saveMasks(masks, saveFileNoExt, formatBinary)
+        return masks[0], ious[0], lowRes[0]
 
-    def run_test(self, sam):
-        npArr = np.zeros((50, 50), np.uint8)
-        cvImage = cv2.cvtColor(npArr, cv2.COLOR_GRAY2BGR)
-        predictor = SAM2ImagePredictor(sam)
-        predictor.set_image(cvImage)
-        input_box = np.array([10, 10, 20, 20])
-        predictor.predict(
-            point_coords=None, point_labels=None, box=input_box, multimask_output=False
+
+class ONNXMaskGenerator:
+    """
+    Auto mode of SamAutomaticMaskGenerator without crop layers: decodes a grid
+    of single point prompts, keeps the confident and stable masks and removes
+    duplicates by box overlap. Returns records in the same format.
+    """
+
+    def __init__(
+        self,
+        model,
+        points_per_side=32,
+        points_per_batch=64,
+        pred_iou_thresh=None,
+        stability_score_thresh=0.95,
+        stability_score_offset=1.0,
+        box_nms_thresh=0.7,
+    ):
+        self.model = model
+        self.points_per_side = points_per_side
+        self.points_per_batch = points_per_batch
+        if pred_iou_thresh is None:
+            pred_iou_thresh = 0.88 if model.family == "sam1" else 0.8
+        self.pred_iou_thresh = pred_iou_thresh
+        self.stability_score_thresh = stability_score_thresh
+        self.stability_score_offset = stability_score_offset
+        self.box_nms_thresh = box_nms_thresh
+
+    def point_grid(self, width, height):
+        offsets = (np.arange(self.points_per_side) + 0.5) / self.points_per_side
+        xs, ys = np.meshgrid(offsets * width, offsets * height)
+        return np.stack([xs.ravel(), ys.ravel()], axis=1).astype(np.float32)
+
+    def generate(self, image):
+        predictor = ONNXPredictor(self.model)
+        predictor.set_image(image)
+        height, width = image.shape[:2]
+        points = self.point_grid(width, height)
+
+        records, boxes = [], []
+        for start in range(0, len(points), self.points_per_batch):
+            batch = points[start : start + self.points_per_batch]
+            coords, labels = predictor.prompt_arrays(
+                batch[:, None], np.ones((len(batch), 1), dtype=np.float32), None
+            )
+            lowRes, ious = self.model.decode(predictor.features, coords, labels)
+            lowRes, ious = self.model.select_masks(lowRes, ious, True)
+            for i, j in zip(*np.nonzero(ious > self.pred_iou_thresh)):
+                logits = self.model.upscale_mask(
+                    lowRes[i, j], predictor.input_size, predictor.original_size
+                )
+                stability = float(
+                    stabilityScore(logits, 0.0, self.stability_score_offset)
+                )
+                if stability < self.stability_score_thresh:
+                    continue
+                mask = logits > 0
+                box = maskBox(mask)
+                if box is None:
+                    continue
+                boxes.append(box)
+                records.append(
+                    {
+                        "segmentation": mask,
+                        "area": int(mask.sum()),
+                        "bbox": [box[0], box[1], box[2] - box[0], box[3] - box[1]],
+                        "predicted_iou": float(ious[i, j]),
+                        "point_coords": [batch[i].tolist()],
+                        "stability_score": stability,
+                        "crop_box": [0, 0, width, height],
+                    }
+                )
+        keep = suppressBoxes(
+            boxes, [record["predicted_iou"] for record in records], self.box_nms_thresh
         )
+        return [records[i] for i in keep]
 
-    def cleanup(self):
-        if self._temp_pth_path and os.path.exists(self._temp_pth_path):
-            os.remove(self._temp_pth_path)
-            print(f"Removed temporary file: {self._temp_pth_path}")
 
+class ONNXStrategy(SegmentationStrategy):
+    """
+    Runs encoder and decoder graphs exported by seganyexport.py through ONNX
+    Runtime on the CPU, without torch or the SAM packages. The checkpoint path
+    is the .encoder.onnx file, its .decoder.onnx file must sit next to it.
+    """
 
-def main():
-    if len(sys.argv) < 3:
+    embedding_cache_cls = NumpyEmbeddingCache
+
+    def import_backend(self):
+        self.ort = importModule("onnxruntime", self.import_times)
+        self.predictor_cls = ONNXPredictor
+        self.mask_generator_cls = ONNXMaskGenerator
+
+    def get_model_type_from_filename(self, model_filename):
+        stem = onnxModelStem(model_filename)
+        for strategyCls in (SAM1Strategy, SAM2Strategy):
+            model_type = strategyCls.MODEL_TYPE_LOOKUP.get(stem)
+            if model_type:
+                print(f"Auto-detected ONNX model type: {model_type}")
+                return model_type
         print(
-            "Usage: python seganybridge.py <model_type|auto> <checkpoint_path> [options]"
+            f"Error: Could not auto-detect model type from ONNX filename: {model_filename}"
         )
-        return
+        print(
+            "Please export the model from a checkpoint with one of the SAM1 or "
+            "SAM2 file names"
+        )
+        return None
 
-    modelType = sys.argv[1]
-    checkPtFilePath = sys.argv[2]
-    model_filename = os.path.basename(checkPtFilePath)
+    def load_model(self, checkPtFilePath, modelType):
+        prefix = os.path.join(
+            os.path.dirname(checkPtFilePath), onnxModelStem(checkPtFilePath)
+        )
+        family = "sam2" if modelType.startswith("sam2") else "sam1"
+        try:
+            encoder = makeOnnxSession(self.ort, prefix + ONNX_ENCODER_SUFFIX)
+            decoder = makeOnnxSession(self.ort, prefix + ONNX_DECODER_SUFFIX)
+            print("ONNX Model loaded successfully!")
+            return ONNXModel(family, encoder, decoder)
+        except Exception as e:
+            print(f"Error loading ONNX model: {e}")
+            return None
+
+    def model_family(self, sam):
+        # Exported from either family, the graphs tell which
+        return sam.family
+
+    def move_to_device(self, sam):
+        pass  # The sessions only use the CPU provider
+
+    def on_cpu(self, sam):
+        return True
+
+    def enable_cpu_perf(self, sam):
+        print("CPU performance mode ignored, ONNX sessions are tuned for the CPU")
+
+    def get_image_state(self, predictor):
+        state = dict(predictor.features)
+        state["original_size"] = np.array(predictor.original_size)
+        state["input_size"] = np.array(predictor.input_size)
+        return state
 
+    def set_image_state(self, predictor, state):
+        predictor.reset_image()
+        predictor.features = {
+            name: state[name] for name in predictor.model.feature_names
+        }
+        predictor.original_size = tuple(int(v) for v in state["original_size"])
+        predictor.input_size = tuple(int(v) for v in state["input_size"])
+
+    def predict_batch(self, predictor, coords, labels, boxes, multimask):
+        masks, _, _ = predictor.predict_batch(coords, labels, boxes, multimask)
+        return masks
+
+    def predict_auto(self, sam, cvImage, **kwargs):
+        if kwargs.get("cropNLayers") or kwargs.get("minMaskArea"):
+            print("The ONNX backend ignores crop layers and the minimum mask area")
+        points_per_side = kwargs.get(
+            "pointsPerSide", SEG_RES_POINTS_PER_SIDE.get(kwargs.get("segRes"), 32)
+        )
+        mask_generator = self.mask_generator_cls(sam, points_per_side=points_per_side)
+        with stageTimer("generate"):
+            return mask_generator.generate(cvImage)
+
+
+def makeStrategy(checkPtFilePath):
+    model_filename = os.path.basename(checkPtFilePath)
+    if model_filename.lower().endswith(".onnx"):
+        return ONNXStrategy()
     if model_filename.lower().startswith("sam_"):
-        strategy = SAM1Strategy()
+        return SAM1Strategy()
     elif model_filename.lower().startswith("sam2"):
-        strategy = SAM2Strategy()
-    else:
-        print(
-            f"Error: Could not determine model family from filename: {model_filename}"
-        )
-        print("Filename must start with 'sam_' for SAM1 or 'sam2' for SAM2.")
-        return
+        return SAM2Strategy()
+    print(f"Error: Could not determine model family from filename: {model_filename}")
+    print("Filename must start with 'sam_' for SAM1 or 'sam2' for SAM2.")
+    return None
+
+
+def importBackend(strategy):
+    try:
+        with stageTimer("imports"):
+            strategy.import_backend()
+    except ImportError as e:
+        print(f"Error: Could not import the model backend: {e}")
+        return False
+    return True
+
+
+def loadModel(modelType, checkPtFilePath):
+    strategy = makeStrategy(checkPtFilePath)
+    if strategy is None or not importBackend(strategy):
+        return None, None
 
     if modelType.lower() == "auto":
-        modelType = strategy.get_model_type_from_filename(model_filename)
+        modelType = strategy.get_model_type_from_filename(
+            os.path.basename(checkPtFilePath)
+        )
         if not modelType:
-            return
+            return None, None
 
     if not os.path.exists(checkPtFilePath):
         print(f"Error: Checkpoint file not found: {checkPtFilePath}")
-        return
+        return None, None
 
-    sam = strategy.load_model(checkPtFilePath, modelType)
+    with stageTimer("checkpoint_load"):
+        sam = strategy.load_model(checkPtFilePath, modelType)
     if sam is None:
-        return
+        return None, None
 
-    if torch.cuda.is_available():
-        sam.to(device="cuda")
-        print("Model moved to CUDA")
+    strategy.model_id = getModelId(modelType, checkPtFilePath)
+    strategy.embedding_cache = strategy.embedding_cache_cls.fromEnvironment()
+    strategy.move_to_device(sam)
+    return strategy, sam
 
-    if len(sys.argv) == 3:
-        strategy.run_test(sam)
-        print("Success!!")
-        strategy.cleanup()
+
+def enableCpuPerf(strategy, sam):
+    if not strategy.on_cpu(sam):
+        print("CPU performance mode ignored, the model runs on the GPU")
         return
+    strategy.enable_cpu_perf(sam)
+
+
+AUTO_OPTIONS = {
+    "tile-size": ("tileSize", int),
+    "tile-overlap": ("tileOverlap", int),
+    "max-memory-mb": ("maxMemoryMB", int),
+    "min-score": ("minScore", float),
+    "min-stability": ("minStability", float),
+    "min-area": ("minArea", int),
+    "max-area": ("maxArea", int),
+    "nms-iou": ("nmsIoU", float),
+    "top-k": ("topK", int),
+    "points-per-side": ("pointsPerSide", int),
+    "crop-n-layers": ("cropNLayers", int),
+}
+
 
-    ipFile = sys.argv[3]
-    segType = sys.argv[4]
-    maskType = sys.argv[5]
-    saveFileNoExt = sys.argv[6]
-    formatBinary = sys.argv[7] == "True" if len(sys.argv) > 7 else True
+def getAutoKwargs(options):
+    auto_kwargs = {}
+    for name, (key, parse) in AUTO_OPTIONS.items():
+        if name in options:
+            auto_kwargs[key] = parse(options[name])
+    return auto_kwargs
 
-    cvImage = cv2.imread(ipFile)
-    cvImage = cv2.cvtColor(cvImage, cv2.COLOR_BGR2RGB)
+
+def runJob(strategy, sam, argv):
+    argv, options = splitOptions(argv)
+    ipFile = argv[3]
+    saveFileNoExt = argv[6]
+    maskFormat = parseMaskFormat(argv[7]) if len(argv) > 7 else MASK_FORMAT_BINARY
+
+    if options.get("cpu-perf") == "1":
+        enableCpuPerf(strategy, sam)
+
+    with stageTimer("image_read"):
+        cvImage = readImage(ipFile)
 
     try:
-        if segType == "Auto":
-            auto_kwargs = {}
-            if isinstance(strategy, SAM2Strategy):
-                if len(sys.argv) > 8:
-                    auto_kwargs["segRes"] = sys.argv[8]
-                if len(sys.argv) > 9:
-                    auto_kwargs["cropNLayers"] = int(sys.argv[9])
-                if len(sys.argv) > 10:
-                    auto_kwargs["minMaskArea"] = int(sys.argv[10])
-            strategy.segment_auto(
-                sam, cvImage, saveFileNoExt, formatBinary, **auto_kwargs
-            )
-        elif segType in {"Selection", "Box-Selection"}:
-            selFile = sys.argv[8]
-            boxCos = (
-                [float(val.strip()) for val in sys.argv[9].split(",")]
-                if len(sys.argv) > 9
-                else None
+        with strategy.inference():
+            runSegmentation(
+                strategy, sam, cvImage, argv, options, saveFileNoExt, maskFormat
             )
-            strategy.segment_sel(
-                sam, cvImage, maskType, selFile, boxCos, saveFileNoExt, formatBinary
-            )
-        elif segType == "Box":
-            boxCos = [float(val.strip()) for val in sys.argv[9].split(",")]
-            strategy.segment_box(
-                sam, cvImage, maskType, boxCos, saveFileNoExt, formatBinary
-            )
-        else:
-            print(f"Unknown segmentation type: {segType}")
     finally:
+        # Cleanup comes first, printing fails if the client went away
+        strategy.cleanup()
         print("Done!")
+
+
+def runSegmentation(strategy, sam, cvImage, argv, options, saveFileNoExt, maskFormat):
+    segType = argv[4]
+    maskType = argv[5]
+    if segType == "Auto":
+        auto_kwargs = {}
+        # SAM2 settings, also for SAM2 models exported to ONNX
+        if strategy.model_family(sam) == "sam2":
+            if len(argv) > 8:
+                auto_kwargs["segRes"] = argv[8]
+            if len(argv) > 9:
+                auto_kwargs["cropNLayers"] = int(argv[9])
+            if len(argv) > 10:
+                auto_kwargs["minMaskArea"] = int(argv[10])
+        # Options override the positional settings
+        auto_kwargs.update(getAutoKwargs(options))
+        strategy.segment_auto(sam, cvImage, saveFileNoExt, maskFormat, **auto_kwargs)
+    elif segType in {"Selection", "Box-Selection"}:
+        selFile = argv[8]
+        boxCos = (
+            [float(val.strip()) for val in argv[9].split(",")]
+            if len(argv) > 9
+            else None
+        )
+        strategy.segment_sel(
+            sam, cvImage, maskType, selFile, boxCos, saveFileNoExt, maskFormat
+        )
+    elif segType == "Refine":
+        clicksFile = argv[8]
+        strategy.segment_refine(
+            sam, cvImage, maskType, clicksFile, saveFileNoExt, maskFormat
+        )
+    elif segType == "Box":
+        boxes = parseBoxes(argv[9])
+        strategy.segment_box(sam, cvImage, maskType, boxes, saveFileNoExt, maskFormat)
+    elif segType == "Embed":
+        strategy.precompute_embedding(sam, cvImage)
+    else:
+        print(f"Unknown segmentation type: {segType}")
+
+
+# --- Batch Mode ---
+
+BATCH_IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".webp"}
+BATCH_MANIFEST_NAME = "manifest.jsonl"
+BATCH_QUEUE_SIZE = 2
+
+
+def listBatchImages(inputSpec):
+    if os.path.isdir(inputSpec):
+        filepaths = [os.path.join(inputSpec, name) for name in os.listdir(inputSpec)]
+    else:
+        filepaths = glob.glob(inputSpec, recursive=True)
+    return sorted(
+        filepath
+        for filepath in filepaths
+        if os.path.isfile(filepath)
+        and os.path.splitext(filepath)[1].lower() in BATCH_IMAGE_EXTENSIONS
+    )
+
+
+def batchInputRoot(inputSpec):
+    # Directory the output names are relative to, the glob's fixed prefix
+    if os.path.isdir(inputSpec):
+        return inputSpec
+    match = re.search(r"[*?[]", inputSpec)
+    prefix = inputSpec if match is None else inputSpec[: match.start()]
+    return os.path.dirname(prefix) or os.curdir
+
+
+def batchOutputNoExt(outputDir, inputRoot, filepath):
+    # The path below the input root, extension included, keeps x.png and x.jpg
+    # or the same name in two folders of a recursive glob apart
+    relPath = os.path.relpath(filepath, inputRoot)
+    if relPath.startswith(os.pardir):
+        relPath = os.path.basename(filepath)
+    saveFileNoExt = os.path.join(outputDir, relPath + "__")
+    os.makedirs(os.path.dirname(saveFileNoExt), exist_ok=True)
+    return saveFileNoExt
+
+
+def readBatchManifest(manifestPath):
+    done = set()
+    if os.path.exists(manifestPath):
+        with open(manifestPath, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Partial line from an interrupted batch
+                if entry.get("status") == "ok":
+                    done.add(entry["image"])
+    return done
+
+
+class BatchStage(threading.Thread):
+    def __init__(self, target):
+        super().__init__(target=self.run_target, daemon=True)
+        self.target_fn = target
+        self.error = None
+
+    def run_target(self):
+        try:
+            self.target_fn()
+        except BaseException as e:
+            self.error = e
+
+    def put(self, itemQueue, item):
+        # Hands an item to this stage unless it has died
+        while self.is_alive():
+            try:
+                itemQueue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+def runBatch(strategy, sam, inputSpec, outputDir, jobSpec):
+    """
+    Segments every image matching inputSpec with decoding, inference and mask
+    writing running as overlapping stages connected by bounded queues. Each
+    finished image is appended to the manifest so a rerun resumes the batch.
+    """
+    segType = jobSpec.get("segType", "Auto")
+    maskType = jobSpec.get("maskType", "Multiple")
+    maskFormat = jobSpec.get("maskFormat", MASK_FORMAT_CONTAINER)
+    autoKwargs = jobSpec.get("auto", {})
+    prompts = jobSpec.get("prompts", {})
+
+    os.makedirs(outputDir, exist_ok=True)
+    inputRoot = batchInputRoot(inputSpec)
+    manifestPath = os.path.join(outputDir, BATCH_MANIFEST_NAME)
+    done = readBatchManifest(manifestPath)
+    images = [
+        filepath
+        for filepath in listBatchImages(inputSpec)
+        if os.path.abspath(filepath) not in done
+    ]
+    if segType != "Auto":
+        images = [filepath for filepath in images if getPrompt(prompts, filepath)]
+    total = len(images)
+    print(f"Batch: {total} images to process, {len(done)} already done")
+
+    # Every image is encoded once, so caching embeddings only costs disk I/O
+    strategy.embedding_cache = None
+    if jobSpec.get("cpuPerf"):
+        enableCpuPerf(strategy, sam)
+
+    decoded = queue.Queue(maxsize=BATCH_QUEUE_SIZE)
+    segmented = queue.Queue(maxsize=BATCH_QUEUE_SIZE)
+    start = time.perf_counter()
+
+    def decode():
+        # The end marker is queued even if decoding fails, so the inference
+        # loop never waits for it forever; the error is raised after the loop
+        try:
+            for filepath in images:
+                try:
+                    cvImage = cv2.imread(filepath)
+                    if cvImage is not None:
+                        cvImage = cv2.cvtColor(cvImage, cv2.COLOR_BGR2RGB)
+                except cv2.error:
+                    cvImage = None  # Recorded as unreadable
+                decoded.put((filepath, cvImage))
+        finally:
+            decoded.put(None)
+
+    def write():
+        processed = 0
+        with open(manifestPath, "a") as manifest:
+            while True:
+                item = segmented.get()
+                if item is None:
+                    break
+                filepath, shape, masks, crops, error = item
+                entry = {"image": os.path.abspath(filepath)}
+                if error is None:
+                    if crops is None:
+                        crops = [cropMask(mask) for mask in masks]
+                    saveFileNoExt = batchOutputNoExt(outputDir, inputRoot, filepath)
+                    saveMaskCrops(shape, crops, saveFileNoExt, maskFormat)
+                    entry.update(status="ok", masks=len(crops), output=saveFileNoExt)
+                else:
+                    entry.update(status="error", error=error)
+                manifest.write(json.dumps(entry) + "\n")
+                manifest.flush()
+                os.fsync(manifest.fileno())
+                processed += 1
+                elapsed = time.perf_counter() - start
+                emitEvent(
+                    "batch_progress",
+                    done=processed,
+                    total=total,
+                    image=filepath,
+                    images_per_sec=round(processed / elapsed, 3),
+                )
+
+    decoder, writer = BatchStage(decode), BatchStage(write)
+    decoder.start()
+    writer.start()
+    try:
+        while True:
+            item = decoded.get()
+            if item is None:
+                break
+            filepath, cvImage = item
+            shape, masks, crops, error = None, None, None, None
+            try:
+                with strategy.inference():
+                    if cvImage is None:
+                        error = "Could not read image"
+                    elif segType == "Auto":
+                        crops = strategy.predict_auto_crops(sam, cvImage, **autoKwargs)
+                    else:
+                        prompt = getPrompt(prompts, filepath)
+                        promptKey = "box" if segType == "Box" else "points"
+                        if promptKey not in prompt:
+                            raise ValueError(
+                                f"{segType} prompt needs '{promptKey}',"
+                                f" got {sorted(prompt)}"
+                            )
+                        if segType == "Box":
+                            masks = strategy.predict_box(
+                                sam, cvImage, maskType, prompt["box"]
+                            )
+                        else:
+                            masks = strategy.predict_sel(
+                                sam,
+                                cvImage,
+                                maskType,
+                                prompt["points"],
+                                prompt.get("box"),
+                            )
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            if cvImage is not None:
+                shape = cvImage.shape[:2]
+            if not writer.put(segmented, (filepath, shape, masks, crops, error)):
+                break
+    finally:
+        writer.put(segmented, None)
+        writer.join()
+        decoder.join(timeout=1)
+
+    for stage in (decoder, writer):
+        if stage.error is not None:
+            raise stage.error
+    elapsed = time.perf_counter() - start
+    print(f"Batch done: {total} images in {elapsed:.1f}s")
+
+
+def getPrompt(prompts, filepath):
+    return prompts.get(os.path.basename(filepath)) or prompts.get(filepath)
+
+
+# --- Bridge Server ---
+
+
+def isConnectionClosed(conn):
+    # The client sends nothing after its request, so a readable connection
+    # means the client closed or shut down its end
+    try:
+        readable, _, _ = select.select([conn], [], [], 0)
+        return bool(readable) and not conn.recv(1, socket.MSG_PEEK)
+    except OSError:
+        return True
+
+
+class BridgeServer:
+    """
+    Keeps loaded models resident and serves segmentation jobs over a local
+    Unix socket. Each request is a single JSON line: {"argv": [...]} with the
+    same arguments as the command line, or {"command": "shutdown"}. Job
+    output is streamed back line by line and terminated with a JSON status
+    line.
+    """
+
+    def __init__(self, socketPath, idleTimeout=DEFAULT_SERVER_IDLE_TIMEOUT):
+        self.socketPath = socketPath
+        self.idleTimeout = idleTimeout
+        # (modelType, checkpoint, cpuPerf) -> (strategy, sam), least recently
+        # used first
+        self.models = {}
+
+    def bind(self):
+        if os.path.exists(self.socketPath):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socketPath)
+                print(f"Bridge server already running at: {self.socketPath}")
+                return None
+            except OSError:
+                os.remove(self.socketPath)  # Stale socket from a dead server
+            finally:
+                probe.close()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        oldMask = os.umask(0o177)
+        try:
+            server.bind(self.socketPath)
+        finally:
+            os.umask(oldMask)
+        server.listen(1)
+        server.settimeout(self.idleTimeout)
+        return server
+
+    def getModel(self, modelType, checkPtFilePath, cpuPerf=False):
+        modelKey = (modelType, os.path.abspath(checkPtFilePath), cpuPerf)
+        if modelKey in self.models:
+            self.models[modelKey] = self.models.pop(modelKey)
+            return self.models[modelKey]
+        while len(self.models) >= SERVER_MAX_MODELS:
+            self.releaseModel(next(iter(self.models)))
+        strategy, sam = loadModel(modelType, checkPtFilePath)
+        if sam is None:
+            return None, None
+        strategy.cleanup()
+        if cpuPerf:
+            enableCpuPerf(strategy, sam)
+        self.models[modelKey] = (strategy, sam)
+        return strategy, sam
+
+    def releaseModel(self, modelKey=None):
+        # Releases one model, or all of them without a key
+        modelKeys = list(self.models) if modelKey is None else [modelKey]
+        for key in modelKeys:
+            strategy, _ = self.models.pop(key)
+            strategy.cleanup()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def handle(self, conn):
+        reader = conn.makefile("r", encoding="utf-8")
+        writer = conn.makefile("w", encoding="utf-8", buffering=1)
+        try:
+            request = json.loads(reader.readline())
+            if request.get("command") == "shutdown":
+                writer.write(json.dumps({"status": "ok"}) + "\n")
+                return False
+            with contextlib.redirect_stdout(writer):
+                status = self.runRequest(conn, request["argv"])
+            writer.write(json.dumps(status) + "\n")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Bridge server request failed: {e}")
+        finally:
+            reader.close()
+            try:
+                writer.close()
+            except OSError:
+                pass  # The plugin closed the connection to cancel the job
+        return True
+
+    def runRequest(self, conn, argv):
+        """
+        Runs the job on a worker thread while watching the connection. A
+        client that goes away cancels the job at its next stage, instead of
+        the job running to the end ahead of the requests waiting behind it.
+        """
+        status = {"status": "ok"}
+
+        def run():
+            try:
+                cpuPerf = splitOptions(argv)[1].get("cpu-perf") == "1"
+                strategy, sam = self.getModel(argv[1], argv[2], cpuPerf)
+                if sam is None:
+                    status.update(status="error", message="Model not loaded")
+                elif len(argv) == 3:
+                    strategy.run_test(sam)
+                    print("Success!!")
+                else:
+                    runJob(strategy, sam, argv)
+            except JobCancelled as e:
+                status.update(status="cancelled", message=str(e))
+            except Exception as e:
+                status.update(status="error", message=str(e))
+                try:
+                    traceback.print_exc(file=sys.stdout)
+                except OSError:
+                    pass  # The client went away
+
+        jobCancelled.clear()
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+        while worker.is_alive():
+            worker.join(timeout=SERVER_CANCEL_POLL_INTERVAL)
+            if not jobCancelled.is_set() and isConnectionClosed(conn):
+                jobCancelled.set()
+        return status
+
+    def serve(self):
+        server = self.bind()
+        if server is None:
+            return
+        print(f"Bridge server listening at: {self.socketPath}", flush=True)
+        try:
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    print("Bridge server idle, shutting down")
+                    break
+                with conn:
+                    conn.settimeout(None)
+                    if not self.handle(conn):
+                        break
+        finally:
+            server.close()
+            if os.path.exists(self.socketPath):
+                os.remove(self.socketPath)
+            self.releaseModel()
+
+
+def reportImportTimes(checkPtFilePath):
+    strategy = makeStrategy(checkPtFilePath)
+    if strategy is None or not importBackend(strategy):
+        return
+    for name, secs in strategy.import_times:
+        print(f"{name:<40} {secs * 1000:10.1f} ms")
+    total = sum(secs for _, secs in strategy.import_times)
+    print(f"{'total':<40} {total * 1000:10.1f} ms")
+
+
+def reportCpuPerf(modelType, checkPtFilePath, ipFile, repeat=CPU_PERF_REPEAT):
+    """
+    Times the image encoder on the same image with the default path and with
+    CPU performance mode, the best of repeat runs each after a warm-up run.
+    """
+    strategy, sam = loadModel(modelType, checkPtFilePath)
+    if sam is None:
+        return
+    if not strategy.on_cpu(sam):
+        print("CPU performance mode only applies when the model runs on the CPU")
+        return
+    cvImage = readImage(ipFile)
+
+    def timeEncoder():
+        predictor = strategy.predictor_cls(sam)
+        samples = []
+        for _ in range(repeat + 1):
+            start = time.perf_counter()
+            with strategy.inference():
+                predictor.set_image(cvImage)
+            samples.append(time.perf_counter() - start)
+        return min(samples[1:])
+
+    defaultSecs = timeEncoder()
+    strategy.enable_cpu_perf(sam)
+    perfSecs = timeEncoder()
+    speedup = defaultSecs / perfSecs
+    emitEvent(
+        "cpu_perf",
+        default_s=round(defaultSecs, 4),
+        perf_s=round(perfSecs, 4),
+        speedup=round(speedup, 2),
+        bfloat16=strategy.cpu_bfloat16,
+    )
+    print(
+        f"Image encoder: default {defaultSecs * 1000:.1f} ms, "
+        f"CPU performance mode {perfSecs * 1000:.1f} ms, {speedup:.2f}x"
+    )
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        if len(sys.argv) < 6:
+            print(
+                "Usage: python seganybridge.py --batch <model_type|auto> "
+                "<checkpoint_path> <input_dir|glob> <output_dir> [job_spec.json]"
+            )
+            return
+        jobSpec = {}
+        if len(sys.argv) > 6:
+            with open(sys.argv[6], "r") as f:
+                jobSpec = json.load(f)
+        strategy, sam = loadModel(sys.argv[2], sys.argv[3])
+        if sam is not None:
+            runBatch(strategy, sam, sys.argv[4], sys.argv[5], jobSpec)
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--import-times":
+        if len(sys.argv) < 3:
+            print("Usage: python seganybridge.py --import-times <checkpoint_path>")
+            return
+        reportImportTimes(sys.argv[2])
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--cpu-perf-bench":
+        if len(sys.argv) < 5:
+            print(
+                "Usage: python seganybridge.py --cpu-perf-bench <model_type|auto> "
+                "<checkpoint_path> <image_path>"
+            )
+            return
+        reportCpuPerf(sys.argv[2], sys.argv[3], sys.argv[4])
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        if len(sys.argv) < 3:
+            print("Usage: python seganybridge.py --serve <socket_path> [idle_secs]")
+            return
+        idleTimeout = (
+            float(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_SERVER_IDLE_TIMEOUT
+        )
+        BridgeServer(sys.argv[2], idleTimeout).serve()
+        return
+
+    if len(sys.argv) < 3:
+        print(
+            "Usage: python seganybridge.py <model_type|auto> <checkpoint_path> [options]"
+        )
+        return
+
+    strategy, sam = loadModel(sys.argv[1], sys.argv[2])
+    if sam is None:
+        return
+
+    if len(sys.argv) == 3:
+        strategy.run_test(sam)
+        print("Success!!")
         strategy.cleanup()
+        return
+
+    runJob(strategy, sam, sys.argv)
 
 
 if __name__ == "__main__":
     main()
-
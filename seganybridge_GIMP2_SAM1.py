@@ -27,35 +27,26 @@ import cv2
 from segment_anything import sam_model_registry, \
     SamAutomaticMaskGenerator, SamPredictor
 import sys
+import struct
 
 
-def packBoolArray(filepath, arr):
-    packed_data = bytearray()
-    num_rows = len(arr)
-    num_cols = len(arr[0])
-
-    # Add num_rows and num_cols as 32-bit integers at the beginning
-    packed_data.extend([num_rows >> 24, (num_rows >> 16) & 255, (num_rows >> 8)
-                        & 255, num_rows & 255])
-    packed_data.extend([num_cols >> 24, (num_cols >> 16) & 255, (num_cols >> 8)
-                        & 255, num_cols & 255])
+# Same layout as seganybridge.py: big-endian uint32 row and column counts,
+# LSB-first packed mask bits and a version trailer after the payload
+MASK_FILE_MAGIC = b'SEGM'
+MASK_FILE_VERSION = 1
 
-    current_byte = 0
-    bit_position = 0
 
-    for row in arr:
-        for boolean_value in row:
-            if boolean_value:
-                current_byte |= (1 << bit_position)
-            bit_position += 1
+def packMask(mask):
+    mask = np.asarray(mask, dtype=bool)
+    num_rows, num_cols = mask.shape
+    header = struct.pack('>II', num_rows, num_cols)
+    payload = np.packbits(mask, axis=None, bitorder='little')
+    trailer = struct.pack('>4sH', MASK_FILE_MAGIC, MASK_FILE_VERSION)
+    return header + payload.tobytes() + trailer
 
-            if bit_position == 8:
-                packed_data.append(current_byte)
-                current_byte = 0
-                bit_position = 0
 
-    if bit_position > 0:
-        packed_data.append(current_byte)
+def packBoolArray(filepath, arr):
+    packed_data = packMask(arr)
 
     with open(filepath, 'wb') as f:
         f.write(packed_data)
@@ -67,16 +58,16 @@ def saveMask(filepath, maskArr, formatBinary):
     if formatBinary:
         packBoolArray(filepath, maskArr)
     else:
-        with open(filepath, 'w') as f:
-            for row in maskArr:
-                f.write(''.join(str(int(val)) for val in row) + '\n')
+        digits = np.asarray(maskArr, dtype=np.uint8) + ord('0')
+        with open(filepath, 'wb') as f:
+            for row in digits:
+                f.write(row.tobytes() + b'\n')
 
 
 def saveMasks(masks, saveFileNoExt, formatBinary):
     for i, mask in enumerate(masks):
         filepath = saveFileNoExt + str(i) + '.seg'
-        arr = [[val for val in row] for row in mask]
-        saveMask(filepath, arr, formatBinary)
+        saveMask(filepath, mask, formatBinary)
 
 
 def segmentAuto(sam, cvImage, saveFileNoExt, formatBinary):
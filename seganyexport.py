@@ -0,0 +1,243 @@
+"""
+One-time export of a Segment Anything checkpoint to ONNX.
+
+Writes the image encoder and the prompt and mask decoder of a SAM1 or SAM2
+.pth, .pt or .safetensors checkpoint as two ONNX graphs next to each other,
+<checkpoint name>.encoder.onnx and <checkpoint name>.decoder.onnx. Selecting
+the .encoder.onnx file as the checkpoint runs the bridge on ONNX Runtime,
+without torch or the SAM packages.
+
+Usage: python seganyexport.py <model_type|auto> <checkpoint_path>
+                              [--output-dir DIR] [--opset 17]
+
+Author: Shrinivas Kulkarni
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import argparse
+import os
+import sys
+
+import torch
+
+import seganybridge
+
+# Backbone feature map sizes of SAM2 for a 1024 px input, highest first
+SAM2_FEATURE_SIZES = [(256, 256), (128, 128), (64, 64)]
+
+# --- Export Wrappers ---
+
+
+class EncoderExport(torch.nn.Module):
+    """
+    Image encoder on a preprocessed 1024 x 1024 image. SAM2 also returns the
+    high resolution features its mask decoder uses, as SAM2ImagePredictor
+    computes them in set_image.
+    """
+
+    def __init__(self, sam, family):
+        super().__init__()
+        self.sam = sam
+        self.family = family
+
+    def forward(self, image):
+        if self.family == "sam1":
+            return self.sam.image_encoder(image)
+        backbone_out = self.sam.forward_image(image)
+        _, vision_feats, _, _ = self.sam._prepare_backbone_features(backbone_out)
+        if self.sam.directly_add_no_mem_embed:
+            vision_feats[-1] = vision_feats[-1] + self.sam.no_mem_embed
+        feats = [
+            feat.permute(1, 2, 0).reshape(1, -1, *size)
+            for feat, size in zip(vision_feats, SAM2_FEATURE_SIZES)
+        ]
+        return feats[-1], feats[0], feats[1]
+
+
+class DecoderExport(torch.nn.Module):
+    """
+    Prompt encoder and mask decoder for a batch of prompts on one image
+    embedding. Returns the low resolution logits and predicted IoUs of all
+    four mask tokens, the bridge selects and upscales them.
+    """
+
+    def __init__(self, sam, family):
+        super().__init__()
+        if family == "sam1":
+            self.prompt_encoder = sam.prompt_encoder
+            self.mask_decoder = sam.mask_decoder
+        else:
+            self.prompt_encoder = sam.sam_prompt_encoder
+            self.mask_decoder = sam.sam_mask_decoder
+        self.family = family
+
+    def embed_points(self, point_coords, point_labels):
+        # PromptEncoder._embed_points with arithmetic in place of the boolean
+        # indexing, which does not export
+        encoder = self.prompt_encoder
+        embedding = encoder.pe_layer.forward_with_coords(
+            point_coords + 0.5, encoder.input_image_size
+        )
+        labels = point_labels.unsqueeze(-1)
+        embedding = embedding * (labels != -1)
+        embedding = embedding + encoder.not_a_point_embed.weight * (labels == -1)
+        for i, point_embed in enumerate(encoder.point_embeddings):
+            embedding = embedding + point_embed.weight * (labels == i)
+        return embedding
+
+    def embed_masks(self, mask_input, has_mask_input):
+        encoder = self.prompt_encoder
+        has_mask = has_mask_input.reshape(-1, 1, 1, 1)
+        no_mask = encoder.no_mask_embed.weight.reshape(1, -1, 1, 1)
+        masks = encoder.mask_downscaling(mask_input)
+        return has_mask * masks + (1 - has_mask) * no_mask
+
+    def decode(
+        self,
+        image_embed,
+        point_coords,
+        point_labels,
+        mask_input,
+        has_mask_input,
+        high_res_feats=None,
+    ):
+        kwargs = {}
+        if high_res_feats is not None:
+            kwargs = {"repeat_image": True, "high_res_features": high_res_feats}
+        outputs = self.mask_decoder.predict_masks(
+            image_embeddings=image_embed,
+            image_pe=self.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=self.embed_points(point_coords, point_labels),
+            dense_prompt_embeddings=self.embed_masks(mask_input, has_mask_input),
+            **kwargs,
+        )
+        return outputs[0], outputs[1]
+
+
+class SAM1DecoderExport(DecoderExport):
+    def forward(
+        self, image_embed, point_coords, point_labels, mask_input, has_mask_input
+    ):
+        return self.decode(
+            image_embed, point_coords, point_labels, mask_input, has_mask_input
+        )
+
+
+class SAM2DecoderExport(DecoderExport):
+    def forward(
+        self,
+        image_embed,
+        high_res_feats_0,
+        high_res_feats_1,
+        point_coords,
+        point_labels,
+        mask_input,
+        has_mask_input,
+    ):
+        return self.decode(
+            image_embed,
+            point_coords,
+            point_labels,
+            mask_input,
+            has_mask_input,
+            [high_res_feats_0, high_res_feats_1],
+        )
+
+
+# --- Export ---
+
+
+def exportOnnx(modelType, checkPtFilePath, outputDir, opset):
+    strategy, sam = seganybridge.loadModel(modelType, checkPtFilePath)
+    if sam is None:
+        return False
+    sam.to(device="cpu").eval()
+    family = strategy.model_family(sam)
+
+    stem = os.path.splitext(os.path.basename(checkPtFilePath))[0]
+    prefix = os.path.join(outputDir, stem)
+    size = seganybridge.ONNX_IMAGE_SIZE
+    lowResSize = seganybridge.ONNX_LOW_RES_SIZE
+
+    encoder = EncoderExport(sam, family)
+    image = torch.randn(1, 3, size, size)
+    featureNames = ["image_embed"]
+    if family == "sam2":
+        featureNames += ["high_res_feats_0", "high_res_feats_1"]
+    with torch.no_grad():
+        features = encoder(image)
+        if family == "sam1":
+            features = (features,)
+        with seganybridge.stageTimer("export_encoder"):
+            torch.onnx.export(
+                encoder,
+                (image,),
+                prefix + seganybridge.ONNX_ENCODER_SUFFIX,
+                input_names=["image"],
+                output_names=featureNames,
+                opset_version=opset,
+                do_constant_folding=True,
+            )
+
+        decoderCls = SAM2DecoderExport if family == "sam2" else SAM1DecoderExport
+        decoder = decoderCls(sam, family)
+        pointCoords = torch.randint(0, size, (1, 2, 2), dtype=torch.float)
+        pointLabels = torch.tensor([[1.0, -1.0]])
+        maskInput = torch.zeros(1, 1, lowResSize, lowResSize)
+        hasMaskInput = torch.zeros(1)
+        promptAxes = {0: "prompts", 1: "points"}
+        with seganybridge.stageTimer("export_decoder"):
+            torch.onnx.export(
+                decoder,
+                tuple(features) + (pointCoords, pointLabels, maskInput, hasMaskInput),
+                prefix + seganybridge.ONNX_DECODER_SUFFIX,
+                input_names=featureNames
+                + ["point_coords", "point_labels", "mask_input", "has_mask_input"],
+                output_names=["low_res_masks", "iou_predictions"],
+                dynamic_axes={
+                    "point_coords": promptAxes,
+                    "point_labels": promptAxes,
+                    "mask_input": {0: "prompts"},
+                    "has_mask_input": {0: "prompts"},
+                    "low_res_masks": {0: "prompts"},
+                    "iou_predictions": {0: "prompts"},
+                },
+                opset_version=opset,
+                do_constant_folding=True,
+            )
+    print(f"Exported {prefix + seganybridge.ONNX_ENCODER_SUFFIX}")
+    print(f"Exported {prefix + seganybridge.ONNX_DECODER_SUFFIX}")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("model_type", help="Model type, or auto for the file name")
+    parser.add_argument("checkpoint", help=".pth, .pt or .safetensors checkpoint")
+    parser.add_argument(
+        "--output-dir", help="Directory for the graphs, the checkpoint's by default"
+    )
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    outputDir = args.output_dir or os.path.dirname(os.path.abspath(args.checkpoint))
+    os.makedirs(outputDir, exist_ok=True)
+    if not exportOnnx(args.model_type, args.checkpoint, outputDir, args.opset):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,19 +19,92 @@ from gi.repository import GLib
 
 import tempfile
 import subprocess
+import shutil
 from os.path import exists
-from array import array
 import random
+import re
+import bisect
+import itertools
 import os
 import sys
-import glob
+import stat
 import struct
 import json
 import logging
+import socket
+import getpass
+import time
+import contextlib
+import functools
+import mmap
+import queue
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # GIMP's bundled Python does not always ship NumPy
+    np = None
 
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk
 
+# Seconds to wait for a freshly started bridge server to load and listen
+BRIDGE_START_TIMEOUT = 60
+# Seconds between UI updates (and cancel checks) while the bridge runs
+BRIDGE_POLL_INTERVAL = 0.1
+# Seconds the bridge gets to exit after a cancel before it is killed
+BRIDGE_TERMINATE_TIMEOUT = 5
+
+# Mask container layout, must match seganybridge.py
+MASK_FORMAT_CONTAINER = "Container"
+MASK_FORMAT_STREAM = "Stream"
+STREAM_FILE_EXT = ".segc"
+CONTAINER_FILE_NAME = "all.segc"
+CONTAINER_MAGIC = b"SEGC"
+CONTAINER_VERSION = 2
+CONTAINER_HEADER = struct.Struct(">4sHHIII")
+CONTAINER_ENTRY = struct.Struct(">QIIIIIBxH")
+CONTAINER_ENCODING_BITS = 0
+CONTAINER_ENCODING_RLE = 1
+CONTAINER_RUN_SIZE = 4
+
+# Same layout as seganybridge.py
+MASK_FORMAT_LABEL_MAP = "LabelMap"
+LABEL_MAP_FILE_NAME = "all.segl"
+LABEL_MAP_MAGIC = b"SEGL"
+LABEL_MAP_VERSION = 1
+LABEL_MAP_HEADER = struct.Struct(">4sHHIII")
+LABEL_MAP_RUN = struct.Struct(">HI")
+# The mask container of a label map layer, to materialize single labels later
+LABEL_MASKS_PARASITE = "segany-label-masks"
+LABEL_LAYER_SUFFIX = " Labels"
+
+# Selection values above this count as selected
+SELECTION_THRESHOLD = 200
+SELECTED_RUN = re.compile(b"[\\x%02x-\\xff]+" % (SELECTION_THRESHOLD + 1))
+# Selection components smaller than this (in pixels) are left out as specks
+SELECTION_MIN_COMPONENT_AREA = 64
+# Longest side of the grid the distance transform for interior points runs on
+SELECTION_GRID_SIZE = 256
+
+# Refine clicks are the anchors of paths with these (lower case) names
+REFINE_POSITIVE_PATH_NAMES = {"+", "positive"}
+REFINE_NEGATIVE_PATH_NAMES = {"-", "negative"}
+REFINE_GROUP_NAME = "Segment Anything - Refine"
+
+# Preview passes trade quality for speed with a coarser Auto point grid
+PREVIEW_AUTO_OPTIONS = ["--points-per-side=16", "--crop-n-layers=0"]
+PREVIEW_SUFFIX = " (Preview)"
+
+# Raw pixel handoff layout, must match seganybridge.py
+RAW_IMAGE_EXT = ".segr"
+RAW_IMAGE_MAGIC = b"SEGR"
+RAW_IMAGE_VERSION = 1
+RAW_IMAGE_HEADER = struct.Struct(">4sHHIII")
+RAW_IMAGE_DATA_OFFSET = 64
+# Rows read from the layer buffer per write, bounds the plugin's peak memory
+RAW_IMAGE_STRIP_ROWS = 256
+
 
 class DialogValue:
     def __init__(self, filepath):
@@ -44,10 +117,28 @@ class DialogValue:
         self.isRandomColor = False
         self.maskColor = [255, 0, 0, 255]
         self.selPtCnt = 10
+        self.selPtPlacement = "Uniform"
         self.selBoxPathName = None
         self.segRes = "Medium"
         self.cropNLayers = 0
         self.minMaskArea = 0
+        self.useBridgeServer = True
+        self.useTiling = False
+        self.tileSize = 1024
+        self.tileOverlap = 128
+        self.maxMemoryMB = 4096
+        self.outputMode = "Layers"
+        self.useMaskFilters = False
+        self.filterMinScore = 0.0
+        self.filterMinStability = 0.0
+        self.filterMinArea = 0
+        self.filterMaxArea = 0
+        self.filterNmsIoU = 0.9
+        self.filterTopK = 0
+        self.usePreview = False
+        self.previewCheckPtPath = None
+        self.useCpuPerf = False
+        self.usePrecompute = True
 
         try:
             with open(filepath, "r") as f:
@@ -60,9 +151,31 @@ class DialogValue:
                 self.isRandomColor = data.get("isRandomColor", self.isRandomColor)
                 self.maskColor = data.get("maskColor", self.maskColor)
                 self.selPtCnt = data.get("selPtCnt", self.selPtCnt)
+                self.selPtPlacement = data.get("selPtPlacement", self.selPtPlacement)
                 self.segRes = data.get("segRes", self.segRes)
                 self.cropNLayers = data.get("cropNLayers", self.cropNLayers)
                 self.minMaskArea = data.get("minMaskArea", self.minMaskArea)
+                self.useBridgeServer = data.get("useBridgeServer", self.useBridgeServer)
+                self.useTiling = data.get("useTiling", self.useTiling)
+                self.tileSize = data.get("tileSize", self.tileSize)
+                self.tileOverlap = data.get("tileOverlap", self.tileOverlap)
+                self.maxMemoryMB = data.get("maxMemoryMB", self.maxMemoryMB)
+                self.outputMode = data.get("outputMode", self.outputMode)
+                self.useMaskFilters = data.get("useMaskFilters", self.useMaskFilters)
+                self.filterMinScore = data.get("filterMinScore", self.filterMinScore)
+                self.filterMinStability = data.get(
+                    "filterMinStability", self.filterMinStability
+                )
+                self.filterMinArea = data.get("filterMinArea", self.filterMinArea)
+                self.filterMaxArea = data.get("filterMaxArea", self.filterMaxArea)
+                self.filterNmsIoU = data.get("filterNmsIoU", self.filterNmsIoU)
+                self.filterTopK = data.get("filterTopK", self.filterTopK)
+                self.usePreview = data.get("usePreview", self.usePreview)
+                self.previewCheckPtPath = data.get(
+                    "previewCheckPtPath", self.previewCheckPtPath
+                )
+                self.useCpuPerf = data.get("useCpuPerf", self.useCpuPerf)
+                self.usePrecompute = data.get("usePrecompute", self.usePrecompute)
         except Exception as e:
             logging.info("Error reading json : %s" % e)
 
@@ -76,9 +189,27 @@ class DialogValue:
             "isRandomColor": self.isRandomColor,
             "maskColor": self.maskColor,
             "selPtCnt": self.selPtCnt,
+            "selPtPlacement": self.selPtPlacement,
             "segRes": self.segRes,
             "cropNLayers": self.cropNLayers,
             "minMaskArea": self.minMaskArea,
+            "useBridgeServer": self.useBridgeServer,
+            "useTiling": self.useTiling,
+            "tileSize": self.tileSize,
+            "tileOverlap": self.tileOverlap,
+            "maxMemoryMB": self.maxMemoryMB,
+            "outputMode": self.outputMode,
+            "useMaskFilters": self.useMaskFilters,
+            "filterMinScore": self.filterMinScore,
+            "filterMinStability": self.filterMinStability,
+            "filterMinArea": self.filterMinArea,
+            "filterMaxArea": self.filterMaxArea,
+            "filterNmsIoU": self.filterNmsIoU,
+            "filterTopK": self.filterTopK,
+            "usePreview": self.usePreview,
+            "previewCheckPtPath": self.previewCheckPtPath,
+            "useCpuPerf": self.useCpuPerf,
+            "usePrecompute": self.usePrecompute,
         }
         with open(filepath, "w") as f:
             json.dump(data, f)
@@ -145,7 +276,7 @@ class OptionsDialog(Gtk.Dialog):
 
         # Checkpoint Path
         checkPtFileLbl = Gtk.Label(
-            label="Model Checkpoint (.pth/.safetensors):", xalign=1
+            label="Model Checkpoint (.pth/.safetensors/.onnx):", xalign=1
         )
         self.checkPtFileBtn = Gtk.FileChooserButton(
             title="Select Model Checkpoint Path"
@@ -158,7 +289,7 @@ class OptionsDialog(Gtk.Dialog):
         # Segmentation Type
         segTypeLbl = Gtk.Label(label="Segmentation Type:", xalign=1)
         self.segTypeDropDown = Gtk.ComboBoxText()
-        self.segTypeVals = ["Auto", "Box", "Selection"]
+        self.segTypeVals = ["Auto", "Box", "Selection", "Refine"]
         for value in self.segTypeVals:
             self.segTypeDropDown.append_text(value)
         self.segTypeDropDown.set_active(self.segTypeVals.index(self.values.segType))
@@ -179,8 +310,18 @@ class OptionsDialog(Gtk.Dialog):
         self.selPtsLbl = Gtk.Label(label="Selection Points:", xalign=1)
         self.selPtsEntry = Gtk.Entry()
         self.selPtsEntry.set_text(str(self.values.selPtCnt))
+        self.selPtPlacementDropDown = Gtk.ComboBoxText()
+        self.selPtPlacementVals = ["Uniform", "Interior"]
+        for value in self.selPtPlacementVals:
+            self.selPtPlacementDropDown.append_text(value)
+        self.selPtPlacementDropDown.set_active(
+            self.selPtPlacementVals.index(self.values.selPtPlacement)
+        )
+        self.selPtsBox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        self.selPtsBox.pack_start(self.selPtsEntry, True, True, 0)
+        self.selPtsBox.pack_start(self.selPtPlacementDropDown, False, False, 0)
         grid.attach(self.selPtsLbl, 0, 5, 1, 1)
-        grid.attach(self.selPtsEntry, 1, 5, 1, 1)
+        grid.attach(self.selPtsBox, 1, 5, 1, 1)
 
         # SAM2 Specific Auto-Segmentation Options
         self.segResLbl = Gtk.Label(label="Segmentation Resolution:", xalign=1)
@@ -220,10 +361,127 @@ class OptionsDialog(Gtk.Dialog):
             grid.attach(self.maskColorLbl, 0, 10, 1, 1)
             grid.attach(self.maskColorBtn, 1, 10, 1, 1)
 
+        # Bridge Server
+        self.bridgeServerChk = Gtk.CheckButton(label="Keep Model Loaded")
+        self.bridgeServerChk.set_active(self.values.useBridgeServer)
+        grid.attach(self.bridgeServerChk, 1, 11, 1, 1)
+
+        # Tiled Auto Segmentation
+        self.tilingChk = Gtk.CheckButton(label="Segment in Tiles")
+        self.tilingChk.set_active(self.values.useTiling)
+        grid.attach(self.tilingChk, 1, 12, 1, 1)
+
+        self.tileSizeLbl = Gtk.Label(label="Tile Size:", xalign=1)
+        self.tileSizeEntry = Gtk.Entry()
+        self.tileSizeEntry.set_text(str(self.values.tileSize))
+        grid.attach(self.tileSizeLbl, 0, 13, 1, 1)
+        grid.attach(self.tileSizeEntry, 1, 13, 1, 1)
+
+        self.tileOverlapLbl = Gtk.Label(label="Tile Overlap:", xalign=1)
+        self.tileOverlapEntry = Gtk.Entry()
+        self.tileOverlapEntry.set_text(str(self.values.tileOverlap))
+        grid.attach(self.tileOverlapLbl, 0, 14, 1, 1)
+        grid.attach(self.tileOverlapEntry, 1, 14, 1, 1)
+
+        self.maxMemoryLbl = Gtk.Label(label="Max Memory (MB):", xalign=1)
+        self.maxMemoryEntry = Gtk.Entry()
+        self.maxMemoryEntry.set_text(str(self.values.maxMemoryMB))
+        grid.attach(self.maxMemoryLbl, 0, 15, 1, 1)
+        grid.attach(self.maxMemoryEntry, 1, 15, 1, 1)
+
+        # Output
+        outputModeLbl = Gtk.Label(label="Output:", xalign=1)
+        self.outputModeDropDown = Gtk.ComboBoxText()
+        self.outputModeVals = ["Layers", "Label Map"]
+        for value in self.outputModeVals:
+            self.outputModeDropDown.append_text(value)
+        self.outputModeDropDown.set_active(
+            self.outputModeVals.index(self.values.outputMode)
+        )
+        grid.attach(outputModeLbl, 0, 16, 1, 1)
+        grid.attach(self.outputModeDropDown, 1, 16, 1, 1)
+
+        # Auto Mask Filters
+        self.maskFiltersChk = Gtk.CheckButton(label="Filter Masks")
+        self.maskFiltersChk.set_active(self.values.useMaskFilters)
+        grid.attach(self.maskFiltersChk, 1, 17, 1, 1)
+
+        self.filterMinScoreLbl = Gtk.Label(label="Min Predicted IoU:", xalign=1)
+        self.filterMinScoreEntry = Gtk.Entry()
+        self.filterMinScoreEntry.set_text(str(self.values.filterMinScore))
+        grid.attach(self.filterMinScoreLbl, 0, 18, 1, 1)
+        grid.attach(self.filterMinScoreEntry, 1, 18, 1, 1)
+
+        self.filterMinStabilityLbl = Gtk.Label(label="Min Stability Score:", xalign=1)
+        self.filterMinStabilityEntry = Gtk.Entry()
+        self.filterMinStabilityEntry.set_text(str(self.values.filterMinStability))
+        grid.attach(self.filterMinStabilityLbl, 0, 19, 1, 1)
+        grid.attach(self.filterMinStabilityEntry, 1, 19, 1, 1)
+
+        self.filterMinAreaLbl = Gtk.Label(label="Min Area (px):", xalign=1)
+        self.filterMinAreaEntry = Gtk.Entry()
+        self.filterMinAreaEntry.set_text(str(self.values.filterMinArea))
+        grid.attach(self.filterMinAreaLbl, 0, 20, 1, 1)
+        grid.attach(self.filterMinAreaEntry, 1, 20, 1, 1)
+
+        self.filterMaxAreaLbl = Gtk.Label(label="Max Area (px):", xalign=1)
+        self.filterMaxAreaEntry = Gtk.Entry()
+        self.filterMaxAreaEntry.set_text(str(self.values.filterMaxArea))
+        grid.attach(self.filterMaxAreaLbl, 0, 21, 1, 1)
+        grid.attach(self.filterMaxAreaEntry, 1, 21, 1, 1)
+
+        self.filterNmsIoULbl = Gtk.Label(label="Max Overlap (IoU):", xalign=1)
+        self.filterNmsIoUEntry = Gtk.Entry()
+        self.filterNmsIoUEntry.set_text(str(self.values.filterNmsIoU))
+        grid.attach(self.filterNmsIoULbl, 0, 22, 1, 1)
+        grid.attach(self.filterNmsIoUEntry, 1, 22, 1, 1)
+
+        self.filterTopKLbl = Gtk.Label(label="Max Masks:", xalign=1)
+        self.filterTopKEntry = Gtk.Entry()
+        self.filterTopKEntry.set_text(str(self.values.filterTopK))
+        grid.attach(self.filterTopKLbl, 0, 23, 1, 1)
+        grid.attach(self.filterTopKEntry, 1, 23, 1, 1)
+
+        # Preview Pass
+        self.previewChk = Gtk.CheckButton(label="Preview with a Fast Model First")
+        self.previewChk.set_active(self.values.usePreview)
+        grid.attach(self.previewChk, 1, 24, 1, 1)
+
+        self.previewCheckPtLbl = Gtk.Label(label="Preview Model Checkpoint:", xalign=1)
+        self.previewCheckPtBtn = Gtk.FileChooserButton(
+            title="Select Preview Model Checkpoint Path"
+        )
+        if self.values.previewCheckPtPath is not None:
+            self.previewCheckPtBtn.set_filename(self.values.previewCheckPtPath)
+        grid.attach(self.previewCheckPtLbl, 0, 25, 1, 1)
+        grid.attach(self.previewCheckPtBtn, 1, 25, 1, 1)
+
+        self.cpuPerfChk = Gtk.CheckButton(label="CPU Performance Mode")
+        self.cpuPerfChk.set_active(self.values.useCpuPerf)
+        grid.attach(self.cpuPerfChk, 1, 26, 1, 1)
+
+        self.precomputeChk = Gtk.CheckButton(
+            label="Compute the Image Embedding While Choosing Options"
+        )
+        self.precomputeChk.set_active(self.values.usePrecompute)
+        grid.attach(self.precomputeChk, 1, 27, 1, 1)
+
+        # Speculative embedding with the persisted model, see EmbeddingPrecompute
+        self.image = image
+        self.precompute = None
+        self.modelChanged = False
+
         self.connect("map-event", self.on_map_event)
         self.segTypeDropDown.connect("changed", self.update_options_visibility)
         self.modelTypeDropDown.connect("changed", self.update_options_visibility)
         self.checkPtFileBtn.connect("file-set", self.update_options_visibility)
+        self.tilingChk.connect("toggled", self.update_options_visibility)
+        self.maskFiltersChk.connect("toggled", self.update_options_visibility)
+        self.previewChk.connect("toggled", self.update_options_visibility)
+        self.segTypeDropDown.connect("changed", self.start_precompute)
+        self.modelTypeDropDown.connect("changed", self.on_model_changed)
+        self.checkPtFileBtn.connect("file-set", self.on_model_changed)
+        self.precomputeChk.connect("toggled", self.on_precompute_toggled)
         if not self.isGrayScale:
             self.randColBtn.connect("toggled", self.on_random_toggled)
 
@@ -246,7 +504,7 @@ class OptionsDialog(Gtk.Dialog):
         isSam1 = isSam1_by_filename or isSam1_by_type
 
         self.selPtsLbl.set_visible(segType in ["Selection"])
-        self.selPtsEntry.set_visible(segType in ["Selection"])
+        self.selPtsBox.set_visible(segType in ["Selection"])
         self.maskTypeLbl.set_visible(segType not in ["Auto"])
         self.maskTypeDropDown.set_visible(segType not in ["Auto"])
 
@@ -259,6 +517,38 @@ class OptionsDialog(Gtk.Dialog):
         self.minMaskAreaLbl.set_visible(show_sam2_options)
         self.minMaskAreaEntry.set_visible(show_sam2_options)
 
+        # Tiling works with either model family
+        show_tile_options = isAuto and self.tilingChk.get_active()
+        self.tilingChk.set_visible(isAuto)
+        self.tileSizeLbl.set_visible(show_tile_options)
+        self.tileSizeEntry.set_visible(show_tile_options)
+        self.tileOverlapLbl.set_visible(show_tile_options)
+        self.tileOverlapEntry.set_visible(show_tile_options)
+        self.maxMemoryLbl.set_visible(show_tile_options)
+        self.maxMemoryEntry.set_visible(show_tile_options)
+
+        show_filter_options = isAuto and self.maskFiltersChk.get_active()
+        self.maskFiltersChk.set_visible(isAuto)
+        for widget in (
+            self.filterMinScoreLbl,
+            self.filterMinScoreEntry,
+            self.filterMinStabilityLbl,
+            self.filterMinStabilityEntry,
+            self.filterMinAreaLbl,
+            self.filterMinAreaEntry,
+            self.filterMaxAreaLbl,
+            self.filterMaxAreaEntry,
+            self.filterNmsIoULbl,
+            self.filterNmsIoUEntry,
+            self.filterTopKLbl,
+            self.filterTopKEntry,
+        ):
+            widget.set_visible(show_filter_options)
+
+        show_preview_options = self.previewChk.get_active()
+        self.previewCheckPtLbl.set_visible(show_preview_options)
+        self.previewCheckPtBtn.set_visible(show_preview_options)
+
     def on_random_toggled(self, widget):
         is_random = self.randColBtn.get_active()
         self.maskColorLbl.set_visible(not is_random)
@@ -266,9 +556,38 @@ class OptionsDialog(Gtk.Dialog):
 
     def on_map_event(self, widget, event):
         self.update_options_visibility(None)
+        self.start_precompute(None)
         if not self.isGrayScale:
             self.on_random_toggled(self.randColBtn)
 
+    def start_precompute(self, widget):
+        # Auto mode does not reuse an image embedding
+        segType = self.segTypeVals[self.segTypeDropDown.get_active()]
+        if (
+            self.precompute is None
+            and not self.modelChanged
+            and self.precomputeChk.get_active()
+            and self.values.checkPtPath
+            and segType != "Auto"
+        ):
+            self.precompute = EmbeddingPrecompute(self.image, self.values)
+
+    def discard_precompute(self):
+        if self.precompute is not None:
+            self.precompute.discard()
+            self.precompute = None
+
+    def on_model_changed(self, widget):
+        # The embedding is only valid for the model it was computed with
+        self.modelChanged = True
+        self.discard_precompute()
+
+    def on_precompute_toggled(self, widget):
+        if widget.get_active():
+            self.start_precompute(widget)
+        else:
+            self.discard_precompute()
+
     def get_values(self):
         self.values.pythonPath = self.pythonFileBtn.get_filename()
 
@@ -288,26 +607,302 @@ class OptionsDialog(Gtk.Dialog):
                 255,
             ]
         self.values.selPtCnt = int(self.selPtsEntry.get_text())
+        self.values.selPtPlacement = self.selPtPlacementVals[
+            self.selPtPlacementDropDown.get_active()
+        ]
         self.values.segRes = self.segResVals[self.segResDropDown.get_active()]
         self.values.cropNLayers = 1 if self.cropNLayersChk.get_active() else 0
         self.values.minMaskArea = int(self.minMaskAreaEntry.get_text())
+        self.values.useBridgeServer = self.bridgeServerChk.get_active()
+        self.values.useTiling = self.tilingChk.get_active()
+        self.values.tileSize = int(self.tileSizeEntry.get_text())
+        self.values.tileOverlap = int(self.tileOverlapEntry.get_text())
+        self.values.maxMemoryMB = int(self.maxMemoryEntry.get_text())
+        self.values.useMaskFilters = self.maskFiltersChk.get_active()
+        self.values.filterMinScore = float(self.filterMinScoreEntry.get_text())
+        self.values.filterMinStability = float(self.filterMinStabilityEntry.get_text())
+        self.values.filterMinArea = int(self.filterMinAreaEntry.get_text())
+        self.values.filterMaxArea = int(self.filterMaxAreaEntry.get_text())
+        self.values.filterNmsIoU = float(self.filterNmsIoUEntry.get_text())
+        self.values.filterTopK = int(self.filterTopKEntry.get_text())
+        self.values.usePreview = self.previewChk.get_active()
+        self.values.previewCheckPtPath = self.previewCheckPtBtn.get_filename()
+        self.values.useCpuPerf = self.cpuPerfChk.get_active()
+        self.values.usePrecompute = self.precomputeChk.get_active()
+        self.values.outputMode = self.outputModeVals[
+            self.outputModeDropDown.get_active()
+        ]
         self.values.persist(self.configFilePath)
 
         # Return a copy with the parsed model type for the bridge script
         run_values = self.values
-        if run_values.modelType == "Auto":
-            run_values.modelType = "auto"
-        else:
-            run_values.modelType = run_values.modelType.split(" ")[0]
+        run_values.modelType = bridgeModelType(run_values.modelType)
 
         return run_values
 
 
+def bridgeModelType(modelType):
+    # "vit_b (SAM1)" -> "vit_b", as the bridge script expects it
+    if modelType == "Auto":
+        return "auto"
+    return modelType.split(" ")[0]
+
+
 def getPathDict(image):
-    return {}
+    return {path.get_name(): path for path in image.get_paths()}
+
+
+def getPathBox(path):
+    # Returns [x1, y1, x2, y2] if the path is a single closed rectangle
+    strokes = path.get_strokes()
+    if len(strokes) != 1:
+        return None
+    _, points, closed = path.stroke_get_points(strokes[0])
+    # Each anchor is stored as in-handle, anchor, out-handle x, y pairs
+    anchors = list(zip(points[2::6], points[3::6]))
+    xs = {x for x, _ in anchors}
+    ys = {y for _, y in anchors}
+    if not closed or len(anchors) != 4 or len(xs) != 2 or len(ys) != 2:
+        return None
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def getPathAnchors(path):
+    anchors = []
+    for stroke in path.get_strokes():
+        _, points, _ = path.stroke_get_points(stroke)
+        anchors.extend(zip(points[2::6], points[3::6]))
+    return anchors
+
+
+def getRefineClicks(image):
+    # Returns (x, y, label) clicks, positive ones first
+    positives, negatives = [], []
+    for name, path in getPathDict(image).items():
+        if name.strip().lower() in REFINE_POSITIVE_PATH_NAMES:
+            positives.extend((x, y, 1) for x, y in getPathAnchors(path))
+        elif name.strip().lower() in REFINE_NEGATIVE_PATH_NAMES:
+            negatives.extend((x, y, 0) for x, y in getPathAnchors(path))
+    return positives + negatives
+
+
+def exportClicks(clicks, expfile):
+    with open(expfile, "w") as f:
+        for x, y, label in clicks:
+            f.write("%d %d %d\n" % (int(x), int(y), label))
+
+
+def removeRefineLayers(image, keep=None):
+    # Each refinement replaces the result of the previous one
+    for layer in image.get_layers():
+        if layer == keep:
+            continue
+        if layer.get_name() in {
+            REFINE_GROUP_NAME,
+            REFINE_GROUP_NAME + LABEL_LAYER_SUFFIX,
+        }:
+            image.remove_layer(layer)
+
+
+def getPathBoxes(image):
+    boxes = []
+    for path in getPathDict(image).values():
+        box = getPathBox(path) if path.get_visible() else None
+        if box is not None:
+            boxes.append(box)
+    return boxes
+
+
+def parseBridgeEvent(line):
+    # The bridge reports stages and job status as single JSON object lines
+    if not line.startswith("{"):
+        return None
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+    return event if isinstance(event, dict) else None
+
+
+class RunTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        self.removed = {}
+
+    def onEvent(self, event):
+        if event.get("event") == "stage":
+            self.stages.append(
+                ("bridge", event["stage"], event.get("wall", 0), event.get("cpu", 0))
+            )
+            for key, value in event.items():
+                if key.startswith("removed_"):
+                    self.removed[key[len("removed_") :]] = value
 
+    @contextlib.contextmanager
+    def measure(self, stage):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.stages.append(
+                (
+                    "plugin",
+                    stage,
+                    time.perf_counter() - wall,
+                    time.process_time() - cpu,
+                )
+            )
 
-def shellRun(cmdArgs, stdoutFile=None, env_vars=None, useos=False):
+    def log(self):
+        lines = [
+            "Segmentation timings:",
+            "  %-8s %-18s %10s %10s" % ("", "", "wall", "cpu"),
+        ]
+        for source, stage, wall, cpu in self.stages:
+            lines.append("  %-8s %-18s %9.3fs %9.3fs" % (source, stage, wall, cpu))
+        if self.removed:
+            lines.append(
+                "Masks removed by filter: "
+                + ", ".join("%s=%d" % item for item in self.removed.items())
+            )
+        logging.info("\n".join(lines))
+
+
+class BridgeProgress(Gtk.Dialog):
+    """
+    Shows the progress events of a running bridge job in a small dialog and
+    in the GIMP progress bar, and lets the user cancel the job.
+    """
+
+    def __init__(self, title):
+        Gtk.Dialog.__init__(self, title=title, transient_for=None, flags=0)
+        self.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        self.set_default_size(360, 80)
+        self.cancelled = False
+        self.fraction = None
+
+        box = self.get_content_area()
+        box.set_spacing(10)
+        box.set_margin_start(10)
+        box.set_margin_end(10)
+        box.set_margin_top(10)
+        self.statusLbl = Gtk.Label(label="Starting...", xalign=0)
+        self.progressBar = Gtk.ProgressBar()
+        box.add(self.statusLbl)
+        box.add(self.progressBar)
+
+        self.connect("response", self.on_response)
+        self.show_all()
+        Gimp.progress_init(title)
+
+    def on_response(self, widget, response):
+        if response in {Gtk.ResponseType.CANCEL, Gtk.ResponseType.DELETE_EVENT}:
+            self.cancelled = True
+            self.setStatus("Cancelling...", None)
+
+    def setStatus(self, text, fraction):
+        self.statusLbl.set_text(text)
+        Gimp.progress_set_text(text)
+        self.fraction = fraction
+        if fraction is None:
+            self.pulse()
+        else:
+            self.progressBar.set_fraction(fraction)
+            Gimp.progress_update(fraction)
+
+    def pulse(self):
+        self.progressBar.pulse()
+        Gimp.progress_pulse()
+
+    def onEvent(self, event):
+        kind = event.get("event")
+        if kind == "stage":
+            self.setStatus("Finished %s" % event["stage"], None)
+        elif kind == "progress":
+            done, total = event["done"], event["total"]
+            self.setStatus(
+                "%s: %d / %d" % (event["stage"].capitalize(), done, total),
+                done / total if total else None,
+            )
+        elif kind == "mask":
+            total = event.get("total")
+            if total:
+                text = "Creating layer %d / %d" % (event["index"] + 1, total)
+                self.setStatus(text, (event["index"] + 1) / total)
+            else:
+                self.setStatus("Creating layer %d" % (event["index"] + 1), None)
+
+    def poll(self, idle=False):
+        # Keeps the UI responsive, returns False once the job was cancelled
+        if idle and self.fraction is None:
+            self.pulse()
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+        return not self.cancelled
+
+    def close(self):
+        Gimp.progress_end()
+        self.destroy()
+
+
+def startLineReader(readline, sentinel):
+    # Reads lines on a thread, so a pipe is drained even while the caller
+    # is busy; None marks the end of the stream
+    lines = queue.Queue()
+
+    def read():
+        try:
+            for line in iter(readline, sentinel):
+                lines.put(line)
+        except (OSError, ValueError):
+            pass
+        finally:
+            lines.put(None)
+
+    threading.Thread(target=read, daemon=True).start()
+    return lines
+
+
+def pollLines(lines, progress=None):
+    # Yields lines as they arrive and polls progress in between, stopping
+    # early when the job is cancelled
+    lastPoll = time.perf_counter()
+    while True:
+        try:
+            line = lines.get(timeout=BRIDGE_POLL_INTERVAL)
+        except queue.Empty:
+            line = ""
+        if line is None:
+            return
+        if progress is not None:
+            now = time.perf_counter()
+            if not line or now - lastPoll >= BRIDGE_POLL_INTERVAL:
+                lastPoll = now
+                if not progress.poll(idle=not line):
+                    return
+        if line:
+            yield line
+
+
+def terminateProcess(process):
+    process.terminate()
+    try:
+        process.wait(timeout=BRIDGE_TERMINATE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def shellRun(
+    cmdArgs,
+    stdoutFile=None,
+    env_vars=None,
+    useos=False,
+    onEvent=None,
+    progress=None,
+    onStart=None,
+):
     if env_vars is None:
         env_vars = os.environ.copy()
 
@@ -322,21 +917,38 @@ def shellRun(cmdArgs, stdoutFile=None, env_vars=None, useos=False):
             stdout=subprocess.PIPE if not stdoutFile else stdoutFile,
             stderr=subprocess.PIPE,
         )
+        if onStart is not None:
+            onStart(process.terminate)
+        # Both pipes are drained concurrently, a chatty stderr (e.g. torch
+        # warnings) would otherwise fill up and stall the bridge
+        errLines = startLineReader(process.stderr.readline, b"")
         try:
             # Processing stdout
             if process.stdout:
-                for line in iter(process.stdout.readline, b""):
+                lines = startLineReader(process.stdout.readline, b"")
+                for line in pollLines(lines, progress):
                     # Decode the line if necessary (Python 3 reads bytes from PIPE)
                     line = line.decode("utf-8")
+                    event = parseBridgeEvent(line)
+                    if event is not None and onEvent is not None:
+                        onEvent(event)
+                        continue
                     print(
                         line,
                     )
+            if progress is not None:
+                while process.poll() is None and progress.poll(idle=True):
+                    time.sleep(BRIDGE_POLL_INTERVAL)
+                if progress.cancelled:
+                    logging.info("Segmentation cancelled, stopping the bridge")
+                    terminateProcess(process)
+                    return False
             process.wait()
 
             if process.returncode != 0:
                 error_message = "Command failed with the following error:\n "
                 error_lines = [
-                    line.decode("utf-8") for line in iter(process.stderr.readline, b"")
+                    line.decode("utf-8") for line in iter(errLines.get, None)
                 ]
                 logging.error(error_message + "".join(error_lines))
                 return False
@@ -349,86 +961,447 @@ def shellRun(cmdArgs, stdoutFile=None, env_vars=None, useos=False):
     return True
 
 
-def unpackBoolArray(filepath):
-    with open(filepath, "rb") as file:
-        packed_data = bytearray(file.read())
-
-    byte_index = 8  # Skip the first 8 bytes for num_rows and num_cols
+def isOwnedByUser(path, fileType, privateDir=False):
+    # lstat, so a symlink planted by another user is never followed
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    if stat.S_IFMT(info.st_mode) != fileType or info.st_uid != os.getuid():
+        return False
+    return not (privateDir and info.st_mode & 0o077)
+
+
+def getBridgeSocketDir():
+    # The socket must live where no other user can create it first
+    if not hasattr(os, "getuid"):
+        return None
+    runtimeDir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtimeDir and isOwnedByUser(runtimeDir, stat.S_IFDIR, privateDir=True):
+        return runtimeDir
+    socketDir = os.path.join(tempfile.gettempdir(), "segany-%s" % getpass.getuser())
+    try:
+        os.mkdir(socketDir, 0o700)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        logging.warning("Could not create the bridge socket directory: %s" % e)
+        return None
+    if not isOwnedByUser(socketDir, stat.S_IFDIR, privateDir=True):
+        logging.warning("Not using %s, it is not a private directory" % socketDir)
+        return None
+    return socketDir
+
+
+def getBridgeSocketPath():
+    socketDir = getBridgeSocketDir()
+    if socketDir is None:
+        return None
+    return os.path.join(socketDir, "segany_bridge.sock")
+
+
+def connectBridgeServer(socketPath):
+    if not hasattr(socket, "AF_UNIX") or not exists(socketPath):
+        return None
+    if not isOwnedByUser(socketPath, stat.S_IFSOCK):
+        logging.warning("Not connecting to %s, owned by another user" % socketPath)
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socketPath)
+    except OSError:
+        conn.close()
+        return None
+    return conn
+
+
+def startBridgeServer(pythonPath, scriptFilepath, socketPath):
+    logFilepath = os.path.splitext(socketPath)[0] + ".log"
+    cmd = [pythonPath, scriptFilepath, "--serve", socketPath]
+    logging.info("Starting bridge server: %s" % " ".join(cmd))
+    with open(logFilepath, "a") as logFile:
+        return subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=logFile,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
 
-    num_rows = struct.unpack(">I", packed_data[:4])[0]
-    num_cols = struct.unpack(">I", packed_data[4:8])[0]
 
-    unpacked_data = []
-    bit_position = 0
+def waitForBridgeServer(process, socketPath, timeout=BRIDGE_START_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        conn = connectBridgeServer(socketPath)
+        if conn is not None:
+            return conn
+        if process.poll() is not None:
+            logging.warning("Bridge server exited with code %s" % process.returncode)
+            return None
+        time.sleep(0.2)
+    logging.warning("Timed out waiting for the bridge server")
+    return None
+
+
+def shutdownConnection(conn):
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # Already closed
+
+
+def bridgeRun(conn, cmdArgs, onEvent=None, progress=None, onStart=None):
+    # Returns True / False for the job result or None if the server went away
+    # before delivering any event, in which case the caller should fall back.
+    # Once events were delivered a rerun would repeat them, e.g. add every
+    # streamed mask layer again, so the job fails instead. A cancelled job
+    # closes the connection, the server then stops the job between two stages.
+    reader = conn.makefile("r", encoding="utf-8")
+    delivered = False
+    try:
+        conn.sendall((json.dumps({"argv": cmdArgs[1:]}) + "\n").encode("utf-8"))
+        if onStart is not None:
+            onStart(functools.partial(shutdownConnection, conn))
+        lines = startLineReader(reader.readline, "")
+        for line in pollLines(lines, progress):
+            event = parseBridgeEvent(line)
+            if event is not None and "status" in event:
+                if event["status"] != "ok":
+                    logging.error("Bridge server job failed: %s" % event.get("message"))
+                return event["status"] == "ok"
+            if event is not None and onEvent is not None:
+                delivered = True
+                onEvent(event)
+                continue
+            print(line.rstrip("\n"))
+        if progress is not None and progress.cancelled:
+            logging.info("Segmentation cancelled, abandoning the bridge job")
+            shutdownConnection(conn)
+            return False
+    except OSError as e:
+        logging.warning("Lost connection to the bridge server: %s" % e)
+    finally:
+        reader.close()
+        conn.close()
+    if delivered:
+        logging.error("Bridge server stopped partway through the job")
+        return False
+    return None
+
+
+def runBridge(cmdArgs, useServer, onEvent=None, progress=None, onStart=None):
+    # onStart receives a callable that stops the job from another thread
+    socketPath = None
+    if useServer and hasattr(socket, "AF_UNIX"):
+        socketPath = getBridgeSocketPath()
+    if socketPath is not None:
+        conn = connectBridgeServer(socketPath)
+        if conn is None:
+            process = startBridgeServer(cmdArgs[0], cmdArgs[1], socketPath)
+            conn = waitForBridgeServer(process, socketPath)
+        if conn is not None:
+            result = bridgeRun(conn, cmdArgs, onEvent, progress, onStart)
+            if result is not None:
+                return result
+        logging.warning("Bridge server unavailable, running one-shot bridge")
+    return shellRun(cmdArgs, onEvent=onEvent, progress=progress, onStart=onStart)
+
+
+def makePixelLookup(onPixel, offPixel):
+    # The 8 pixels of every byte value of LSB-first packed mask bits
+    return [
+        b"".join(onPixel if (byte >> bit) & 1 else offPixel for bit in range(8))
+        for byte in range(256)
+    ]
 
-    for _ in range(num_rows):
-        unpacked_row = []
-        for _ in range(num_cols):
-            if bit_position == 0:
-                current_byte = packed_data[byte_index]
-                byte_index += 1
 
-            boolean_value = (current_byte >> bit_position) & 1
-            unpacked_row.append(boolean_value)
-            bit_position += 1
+def pixelColors(*pixels):
+    # Each pixel as one NumPy scalar, so indexing copies whole pixels at a time
+    dtype = {1: np.uint8, 2: np.uint16, 4: np.uint32}[len(pixels[0])]
+    return np.frombuffer(b"".join(pixels), dtype=dtype)
 
-            if bit_position == 8:
-                bit_position = 0
 
-        unpacked_data.append(unpacked_row)
+def decodeMaskBits(payload, pixelCnt, onPixel, offPixel):
+    # Decodes LSB-first packed mask bits straight to layer pixel bytes
+    if np is not None:
+        bits = np.unpackbits(
+            np.frombuffer(payload, dtype=np.uint8), count=pixelCnt, bitorder="little"
+        )
+        return pixelColors(offPixel, onPixel)[bits].tobytes()
+    lookup = makePixelLookup(onPixel, offPixel)
+    return b"".join(map(lookup.__getitem__, payload))[: pixelCnt * len(onPixel)]
+
+
+def decodeMaskRuns(payload, onPixel, offPixel):
+    # Decodes big-endian uint32 runs, alternating unset and set pixels
+    runCnt = len(payload) // CONTAINER_RUN_SIZE
+    if np is not None:
+        runs = np.frombuffer(payload, dtype=">u4", count=runCnt)
+        colors = np.resize(pixelColors(offPixel, onPixel), runCnt)
+        return np.repeat(colors, runs).tobytes()
+    runs = struct.unpack(">%dI" % runCnt, payload)
+    pixels = (offPixel, onPixel)
+    return b"".join(pixels[i & 1] * run for i, run in enumerate(runs))
+
+
+class MaskContainer:
+    def __init__(self, data, filepath="<memory>"):
+        self.data = data
+        magic, version, _, self.rows, self.cols, count = CONTAINER_HEADER.unpack_from(
+            self.data
+        )
+        if magic != CONTAINER_MAGIC or version > CONTAINER_VERSION:
+            raise ValueError("Unsupported mask container: %s" % filepath)
+        self.entries = [
+            CONTAINER_ENTRY.unpack_from(
+                self.data, CONTAINER_HEADER.size + i * CONTAINER_ENTRY.size
+            )
+            for i in range(count)
+        ]
 
-    return unpacked_data
+    def __len__(self):
+        return len(self.entries)
+
+    def bounds(self, idx):
+        return self.entries[idx][2:6]
+
+    def prompt(self, idx):
+        # Index of the box or selection component the mask was predicted for
+        return self.entries[idx][7]
+
+    def readPayload(self, idx):
+        offset, length = self.entries[idx][:2]
+        return self.data[offset : offset + length]
+
+    def readPixels(self, idx, onPixel, offPixel):
+        # Returns the pixels of the bounding box returned by bounds(idx)
+        _, _, _, _, w, h, encoding, _ = self.entries[idx]
+        payload = self.readPayload(idx)
+        if encoding == CONTAINER_ENCODING_RLE:
+            return decodeMaskRuns(payload, onPixel, offPixel)
+        return decodeMaskBits(payload, w * h, onPixel, offPixel)
+
+    def maskAt(self, px, py):
+        # Index of the first (top ranked) mask covering the pixel, or None
+        for idx in range(len(self)):
+            x, y, w, h = self.bounds(idx)
+            if x <= px < x + w and y <= py < y + h:
+                if self.readPixels(idx, b"\x01", b"\x00")[(py - y) * w + px - x]:
+                    return idx
+        return None
+
+    @classmethod
+    def open(cls, filepath):
+        with open(filepath, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(data, filepath)
+        except ValueError:
+            data.close()
+            raise
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+def readLabelMapPixels(filepath, labelPixels):
+    # Decodes the label map to layer pixel bytes, labelPixels[label] being the
+    # pixel of each label
+    with open(filepath, "rb") as f:
+        data = f.read()
+    magic, version, _, rows, cols, runCnt = LABEL_MAP_HEADER.unpack_from(data)
+    if magic != LABEL_MAP_MAGIC or version > LABEL_MAP_VERSION:
+        raise ValueError("Unsupported label map: %s" % filepath)
+    payload = data[LABEL_MAP_HEADER.size : LABEL_MAP_HEADER.size + runCnt * 6]
+    if np is not None:
+        runs = np.frombuffer(payload, dtype=[("label", ">u2"), ("length", ">u4")])
+        colors = pixelColors(*labelPixels)[runs["label"]]
+        return np.repeat(colors, runs["length"]).tobytes()
+    return b"".join(
+        labelPixels[label] * run for label, run in LABEL_MAP_RUN.iter_unpack(payload)
+    )
 
 
-def readMaskFile(filepath, formatBinary):
-    if formatBinary:
-        return unpackBoolArray(filepath)
-    else:
-        mask = []
-        with open(filepath, "r") as f:
-            lines = f.readlines()
-        for line in lines:
-            mask.append([val == "1" for val in line])
-        return mask
+def readMaskFilePixels(filepath, formatBinary, onPixel, offPixel):
+    with open(filepath, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if formatBinary:
+            num_rows, num_cols = struct.unpack_from(">II", data)
+            pixelCnt = num_rows * num_cols
+            payload = data[8 : 8 + (pixelCnt + 7) // 8]
+            return decodeMaskBits(payload, pixelCnt, onPixel, offPixel)
+        pixels = (offPixel, onPixel)
+        digits = data[:].replace(b"\n", b"")
+        return b"".join(pixels[digit == ord("1")] for digit in digits)
+    finally:
+        data.close()
 
 
-def exportSelection(image, expfile, exportCnt):
+def getSelectionBounds(image):
     procedure = Gimp.get_pdb().lookup_procedure("gimp-selection-bounds")
     config = procedure.create_config()
     config.set_property("image", image)
     result = procedure.run(config)
-    non_empty = result.index(1)
-    x1 = result.index(2)
-    y1 = result.index(3)
-    x2 = result.index(4)
-    y2 = result.index(5)
+    return [result.index(i) for i in range(1, 6)]
+
 
+def readSelectionComponents(image):
+    """
+    Reads the selection mask with a single buffer fetch and splits it into
+    4-connected components. Returns a list of components, each a list of
+    (y, xStart, xEnd) runs of selected pixels in image coordinates.
+    """
+    non_empty, x1, y1, x2, y2 = getSelectionBounds(image)
     if not non_empty:
-        return
+        return []
+    width, height = x2 - x1, y2 - y1
+    buffer = image.get_selection().get_buffer()
+    rect = Gegl.Rectangle.new(x1, y1, width, height)
+    data = buffer.get(rect, 1.0, "Y u8", Gegl.AbyssPolicy.NONE)
+
+    runs = []
+    parent = []
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    prevRow = []
+    for row in range(height):
+        currRow = []
+        j = 0
+        for match in SELECTED_RUN.finditer(data, row * width, (row + 1) * width):
+            start = x1 + match.start() - row * width
+            end = x1 + match.end() - row * width
+            idx = len(runs)
+            runs.append((y1 + row, start, end))
+            parent.append(idx)
+            # Runs of the previous row that end before this one starts can
+            # not touch this or any later run of the row
+            while j < len(prevRow) and runs[prevRow[j]][2] <= start:
+                j += 1
+            k = j
+            while k < len(prevRow) and runs[prevRow[k]][1] < end:
+                parent[find(prevRow[k])] = find(idx)
+                k += 1
+            currRow.append(idx)
+        prevRow = currRow
+
+    components = {}
+    for idx, run in enumerate(runs):
+        components.setdefault(find(idx), []).append(run)
+    kept = [
+        component
+        for component in components.values()
+        if sum(end - start for _, start, end in component)
+        >= SELECTION_MIN_COMPONENT_AREA
+    ]
+    # A selection made only of small regions is still used as is
+    return kept or list(components.values())
+
+
+def getComponentBox(component):
+    return [
+        min(start for _, start, _ in component),
+        component[0][0],
+        max(end for _, _, end in component),
+        component[-1][0] + 1,
+    ]
+
 
+def sampleComponentPoints(component, exportCnt):
+    # Picks points uniformly among the selected pixels of the component
+    lengths = [end - start for _, start, end in component]
+    ends = list(itertools.accumulate(lengths))
     coords = []
-    numPts = (x2 - x1) * (y2 - y1)
-    if exportCnt >= numPts:
-        selIdxs = range(numPts)
-    else:
-        selIdxs = random.sample(range(numPts), exportCnt)
-    for selIdx in selIdxs:
-        x = x1 + selIdx % (x2 - x1)
-        y = y1 + int(selIdx / (x2 - x1))
+    for offset in random.sample(range(ends[-1]), min(exportCnt, ends[-1])):
+        i = bisect.bisect_right(ends, offset)
+        y, start, _ = component[i]
+        coords.append((start + offset - ends[i] + lengths[i], y))
+    return coords
+
+
+def componentDistances(component):
+    """
+    Chamfer (3-4) distance to the component border on a grid of at most
+    SELECTION_GRID_SIZE cells per side. Returns (x1, y1, step, distances)
+    with distances as a list of rows, 0 outside of the component.
+    """
+    x1, y1, x2, y2 = getComponentBox(component)
+    step = max(1, -(-max(x2 - x1, y2 - y1) // SELECTION_GRID_SIZE))
+    gridW = -(-(x2 - x1) // step) + 2
+    gridH = -(-(y2 - y1) // step) + 2
+    big = 3 * (gridW + gridH)
+    # A border of unselected cells keeps the passes free of bounds checks
+    dist = [[0] * gridW for _ in range(gridH)]
+    for y, start, end in component:
+        if (y - y1) % step:
+            continue
+        row = dist[(y - y1) // step + 1]
+        for gx in range(-(-(start - x1) // step), (end - 1 - x1) // step + 1):
+            row[gx + 1] = big
+
+    for gy in range(1, gridH - 1):
+        prev, row = dist[gy - 1], dist[gy]
+        for gx in range(1, gridW - 1):
+            if row[gx]:
+                row[gx] = min(
+                    row[gx],
+                    row[gx - 1] + 3,
+                    prev[gx] + 3,
+                    prev[gx - 1] + 4,
+                    prev[gx + 1] + 4,
+                )
+    for gy in range(gridH - 2, 0, -1):
+        nxt, row = dist[gy + 1], dist[gy]
+        for gx in range(gridW - 2, 0, -1):
+            if row[gx]:
+                row[gx] = min(
+                    row[gx],
+                    row[gx + 1] + 3,
+                    nxt[gx] + 3,
+                    nxt[gx + 1] + 4,
+                    nxt[gx - 1] + 4,
+                )
+    return x1 - step, y1 - step, step, dist
+
+
+def interiorComponentPoints(component, exportCnt):
+    # Picks the deepest points of the component, each at least the largest
+    # inscribed radius away from the points picked before
+    x0, y0, step, dist = componentDistances(component)
+    cells = sorted(
+        ((d, gx, gy) for gy, row in enumerate(dist) for gx, d in enumerate(row) if d),
+        reverse=True,
+    )
+    if not cells:
+        # Thinner than a grid cell, no interior to speak of
+        return sampleComponentPoints(component, exportCnt)
+    spacing = cells[0][0] / 3
+    picked = []
+    for d, gx, gy in cells:
+        if len(picked) >= exportCnt:
+            break
+        if all((gx - px) ** 2 + (gy - py) ** 2 >= spacing**2 for px, py in picked):
+            picked.append((gx, gy))
+    return [(x0 + gx * step, y0 + gy * step) for gx, gy in picked]
 
-        procedure = Gimp.get_pdb().lookup_procedure("gimp-selection-value")
-        config = procedure.create_config()
-        config.set_property("image", image)
-        config.set_property("x", float(x))
-        config.set_property("y", float(y))
-        result = procedure.run(config)
-        value = result.index(1)
 
-        if value > 200:
-            coords.append((x, y))
+def exportSelection(components, expfile, exportCnt, placement="Uniform"):
+    # Points of each component form one prompt, separated by a blank line
+    pickPoints = (
+        interiorComponentPoints if placement == "Interior" else sampleComponentPoints
+    )
     with open(expfile, "w") as f:
-        for co in coords:
-            f.write(str(co[0]) + " " + str(co[1]) + "\n")
+        for i, component in enumerate(components):
+            if i > 0:
+                f.write("\n")
+            for co in pickPoints(component, exportCnt):
+                f.write(str(co[0]) + " " + str(co[1]) + "\n")
 
 
 def getRandomColor(layerCnt):
@@ -445,82 +1418,443 @@ def getRandomColor(layerCnt):
     return list(uniqueColors)
 
 
-def createLayers(image, maskFileNoExt, userSelColor, formatBinary, values):
-    width, height = image.get_width(), image.get_height()
+def iterContainerMasks(filepath):
+    container = MaskContainer.open(filepath)
+    try:
+        for idx in range(len(container)):
+            yield tuple(container.bounds(idx)) + (
+                container.prompt(idx),
+                functools.partial(container.readPixels, idx),
+            )
+    finally:
+        container.close()
+
+
+def iterMasks(maskFileNoExt, maskFormat, width, height, maxLayers=99999):
+    # Yields (x, y, w, h, prompt, readPixels) for every mask written by the
+    # bridge, readPixels(onPixel, offPixel) decodes the mask of the box to
+    # layer pixel bytes
+    if maskFormat == MASK_FORMAT_CONTAINER:
+        filepath = maskFileNoExt + CONTAINER_FILE_NAME
+        if exists(filepath):
+            yield from iterContainerMasks(filepath)
+        return
+    if maskFormat == MASK_FORMAT_STREAM:
+        for idx in range(maxLayers):
+            filepath = maskFileNoExt + str(idx) + STREAM_FILE_EXT
+            if not exists(filepath):
+                break
+            yield from iterContainerMasks(filepath)
+        return
+
+    formatBinary = maskFormat != "False"
+    for idx in range(maxLayers):
+        filepath = maskFileNoExt + str(idx) + ".seg"
+        if not exists(filepath):
+            break
+        readPixels = functools.partial(readMaskFilePixels, filepath, formatBinary)
+        yield 0, 0, width, height, 0, readPixels
+
+
+class MaskLayerBuilder:
+    # Adds mask layers one at a time, so layers can be built from streamed
+    # masks while the bridge is still producing the rest
+    def __init__(self, image, userSelColor, values, promptCnt=1, nameSuffix=""):
+        self.image = image
+        self.values = values
+        self.promptCnt = promptCnt
+        self.count = 0
+        self.firstLayerTime = None
+
+        self.parent = Gimp.GroupLayer.new(image)
+        self.parent.set_name(f"Segment Anything - {values.segType}{nameSuffix}")
+        image.insert_layer(self.parent, None, 0)
+        self.parent.set_opacity(50)
+
+        self.uniqueColors = getRandomColor(layerCnt=999)
+
+        if image.get_base_type() == Gimp.ImageType.GRAYA_IMAGE:
+            self.layerType = Gimp.ImageType.GRAYA_IMAGE
+            userSelColor = [100, 255]
+            self.babl_format = "YA u8"
+            pix_size = 2
+        else:
+            self.layerType = Gimp.ImageType.RGBA_IMAGE
+            self.babl_format = "RGBA u8"
+            pix_size = 4
+
+        self.userSelColor = userSelColor
+        self.transparent_pixel = bytes(pix_size)
+
+    def add(self, x, y, w, h, prompt, readPixels):
+        idx = self.count
+        print("Creating Layer..", (idx + 1))
+        segType = self.values.segType
+        if self.promptCnt > 1:
+            layerName = f"Mask - {segType} {prompt + 1} #{idx + 1}"
+        else:
+            layerName = f"Mask - {segType} #{idx + 1}"
+        # Layers cover only the mask's bounding box, so tile memory and undo
+        # data scale with the object instead of the canvas
+        isEmpty = w == 0 or h == 0
+        newlayer = Gimp.Layer.new(
+            self.image,
+            layerName,
+            max(w, 1),
+            max(h, 1),
+            self.layerType,
+            100.0,
+            Gimp.LayerMode.NORMAL,
+        )
+        self.image.insert_layer(newlayer, self.parent, 0)
+        newlayer.set_offsets(x, y)
+        newlayer.set_visible(False)
+
+        maskColor = (
+            self.userSelColor
+            if self.userSelColor is not None
+            else list(self.uniqueColors[idx % len(self.uniqueColors)]) + [255]
+        )
+
+        if isEmpty:
+            newlayer.fill(Gimp.FillType.TRANSPARENT)
+        else:
+            buffer = newlayer.get_buffer()
+            rect = Gegl.Rectangle.new(0, 0, w, h)
+            pixels = readPixels(bytes(maskColor), self.transparent_pixel)
+            buffer.set(rect, self.babl_format, pixels)
+
+        self.count += 1
+        newlayer.update(0, 0, max(w, 1), max(h, 1))
+        if self.firstLayerTime is None:
+            self.firstLayerTime = time.perf_counter()
+
+    def addFile(self, filepath):
+        for mask in iterContainerMasks(filepath):
+            self.add(*mask)
 
-    idx = 0
-    maxLayers = 99999
+    def onEvent(self, event):
+        # Builds the layer of each mask the bridge announces
+        if event.get("event") == "mask":
+            self.addFile(event["file"])
 
-    parent = Gimp.GroupLayer.new(image)
-    parent.set_name(f"Segment Anything - {values.segType}")
-    image.insert_layer(parent, None, 0)
-    parent.set_opacity(50)
 
-    uniqueColors = getRandomColor(layerCnt=999)
+def createLayers(image, maskFileNoExt, userSelColor, maskFormat, values, promptCnt=1):
+    width, height = image.get_width(), image.get_height()
+    builder = MaskLayerBuilder(image, userSelColor, values, promptCnt)
+    for mask in iterMasks(maskFileNoExt, maskFormat, width, height):
+        builder.add(*mask)
+    # Gimp.displays_flush()  # turn on only if needed
+    return builder.count
 
+
+def createLabelMap(image, maskFileNoExt, values, nameSuffix=""):
+    # One canvas sized layer colored by label instead of a layer per mask,
+    # single labels become selection channels with materializeLabel
+    width, height = image.get_width(), image.get_height()
+    containerPath = maskFileNoExt + CONTAINER_FILE_NAME
+    if not exists(containerPath):
+        return None
+    with open(containerPath, "rb") as f:
+        masks = f.read()
+    labelCnt = len(MaskContainer(masks, containerPath))
+    if labelCnt == 0:
+        return None
+
+    # One color per label, so no two labels share a color
+    uniqueColors = getRandomColor(layerCnt=labelCnt)
     if image.get_base_type() == Gimp.ImageType.GRAYA_IMAGE:
         layerType = Gimp.ImageType.GRAYA_IMAGE
-        userSelColor = [100, 255]
         babl_format = "YA u8"
-        pix_size = 2
+        labelPixels = [bytes(2)] + [bytes([color[0], 255]) for color in uniqueColors]
     else:
         layerType = Gimp.ImageType.RGBA_IMAGE
         babl_format = "RGBA u8"
-        pix_size = 4
+        labelPixels = [bytes(4)] + [bytes(color + (255,)) for color in uniqueColors]
+
+    layer = Gimp.Layer.new(
+        image,
+        f"Segment Anything - {values.segType}{LABEL_LAYER_SUFFIX}{nameSuffix}",
+        width,
+        height,
+        layerType,
+        50.0,
+        Gimp.LayerMode.NORMAL,
+    )
+    image.insert_layer(layer, None, 0)
+    buffer = layer.get_buffer()
+    rect = Gegl.Rectangle.new(0, 0, width, height)
+    pixels = readLabelMapPixels(maskFileNoExt + LABEL_MAP_FILE_NAME, labelPixels)
+    buffer.set(rect, babl_format, pixels)
+    layer.attach_parasite(
+        Gimp.Parasite.new(LABEL_MASKS_PARASITE, Gimp.PARASITE_PERSISTENT, masks)
+    )
+    layer.update(0, 0, width, height)
+    return layer
+
+
+def getLabelContainer(drawables):
+    for drawable in drawables:
+        parasite = drawable.get_parasite(LABEL_MASKS_PARASITE)
+        if parasite is not None:
+            return MaskContainer(bytes(parasite.get_data()))
+    return None
+
+
+def getSelectionLabel(image, container):
+    # Label under the center of the current selection, if any
+    isNonEmpty, x1, y1, x2, y2 = getSelectionBounds(image)
+    if not isNonEmpty:
+        return None
+    idx = container.maskAt((x1 + x2) // 2, (y1 + y2) // 2)
+    return None if idx is None else idx + 1
+
+
+def materializeLabel(image, container, label):
+    idx = label - 1
+    x, y, w, h = container.bounds(idx)
+    channel = Gimp.Channel.new(
+        image,
+        f"Segment Anything - Label {label}",
+        container.cols,
+        container.rows,
+        100.0,
+        Gegl.Color.new("black"),
+    )
+    image.insert_channel(channel, None, 0)
+    if w > 0 and h > 0:
+        buffer = channel.get_buffer()
+        rect = Gegl.Rectangle.new(x, y, w, h)
+        buffer.set(rect, "Y u8", container.readPixels(idx, b"\xff", b"\x00"))
+        channel.update(x, y, w, h)
+
+    procedure = Gimp.get_pdb().lookup_procedure("gimp-image-select-item")
+    config = procedure.create_config()
+    config.set_property("image", image)
+    config.set_property("operation", Gimp.ChannelOps.REPLACE)
+    config.set_property("item", channel)
+    procedure.run(config)
+    return channel
 
-    while idx < maxLayers:
-        filepath = maskFileNoExt + str(idx) + ".seg"
-        if exists(filepath):
-            print("Creating Layer..", (idx + 1))
-            newlayer = Gimp.Layer.new(
-                image,
-                f"Mask - {values.segType} #{idx + 1}",
-                width,
-                height,
-                layerType,
-                100.0,
-                Gimp.LayerMode.NORMAL,
-            )
-            buffer = newlayer.get_buffer()
-            image.insert_layer(newlayer, parent, 0)
-            newlayer.set_visible(False)
 
-            rect = Gegl.Rectangle.new(0, 0, width, height)
+class LabelDialog(Gtk.Dialog):
+    def __init__(self, labelCnt, label):
+        Gtk.Dialog.__init__(
+            self, title="Segment Anything Label", transient_for=None, flags=0
+        )
+        self.add_buttons(
+            Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL, Gtk.STOCK_OK, Gtk.ResponseType.OK
+        )
 
-            maskVals = readMaskFile(filepath, formatBinary)
-            maskColor = (
-                userSelColor
-                if userSelColor is not None
-                else list(uniqueColors[idx]) + [255]
-            )
+        grid = Gtk.Grid()
+        grid.set_column_spacing(10)
+        grid.set_row_spacing(10)
+        grid.set_margin_start(10)
+        grid.set_margin_end(10)
+        grid.set_margin_top(10)
+        grid.set_margin_bottom(10)
+        self.get_content_area().add(grid)
 
-            mask_color_bytes = bytes(maskColor)
-            transparent_pixel = bytes(pix_size)
-            row_byte_strings = []
-            for row in maskVals:
-                row_pixels = []
-                for p in row:
-                    if p:
-                        row_pixels.append(mask_color_bytes)
-                    else:
-                        row_pixels.append(transparent_pixel)
-                row_byte_strings.append(b"".join(row_pixels))
-            pixels = b"".join(row_byte_strings)
-
-            buffer.set(rect, babl_format, pixels)
-
-            idx += 1
-            newlayer.update(0, 0, width, height)
-        else:
-            break
-    # Gimp.displays_flush()  # turn on only if needed
+        labelLbl = Gtk.Label(label="Label:", xalign=1)
+        self.labelSpin = Gtk.SpinButton.new_with_range(1, labelCnt, 1)
+        self.labelSpin.set_value(label)
+        grid.attach(labelLbl, 0, 0, 1, 1)
+        grid.attach(self.labelSpin, 1, 0, 1, 1)
+
+        self.show_all()
+
+    def get_label(self):
+        return self.labelSpin.get_value_as_int()
+
+
+def getSharedTempDir():
+    # Files in /dev/shm never touch the disk, the bridge maps them in place
+    shmDir = "/dev/shm"
+    if os.path.isdir(shmDir) and os.access(shmDir, os.W_OK):
+        return shmDir
+    return tempfile.gettempdir()
+
+
+def exportRawImage(layer, filepath):
+    for _ in exportRawImageStrips(layer, filepath):
+        pass
+
+
+def exportRawImageStrips(layer, filepath):
+    # Yields after every strip, so the export can run in idle callbacks
+    width, height = layer.get_width(), layer.get_height()
+    channels = 3
+    buffer = layer.get_buffer()
+    header = RAW_IMAGE_HEADER.pack(
+        RAW_IMAGE_MAGIC,
+        RAW_IMAGE_VERSION,
+        channels,
+        height,
+        width,
+        RAW_IMAGE_DATA_OFFSET,
+    )
+    with open(filepath, "wb") as f:
+        f.write(header.ljust(RAW_IMAGE_DATA_OFFSET, b"\0"))
+        for y in range(0, height, RAW_IMAGE_STRIP_ROWS):
+            rows = min(RAW_IMAGE_STRIP_ROWS, height - y)
+            rect = Gegl.Rectangle.new(0, y, width, rows)
+            f.write(buffer.get(rect, 1.0, "R'G'B' u8", Gegl.AbyssPolicy.NONE))
+            yield
+
+
+def exportPngImage(image, filepath):
+    procedure = Gimp.get_pdb().lookup_procedure("file-png-export")
+    config = procedure.create_config()
+    config.set_property("run-mode", Gimp.RunMode.NONINTERACTIVE)
+    config.set_property("image", image)
+
+    gfile = Gio.File.new_for_path(filepath)
+    config.set_property("file", gfile)
+    config.set_property("interlaced", False)
+    config.set_property("compression", 9)
+    config.set_property("bkgd", False)
+    config.set_property("offs", False)
+    config.set_property("phys", False)
+    config.set_property("time", False)
+    config.set_property("save-transparent", True)
+    config.set_property("optimize-palette", False)
+    procedure.run(config)
+
+
+def makeWorkspace():
+    # Every run gets its own directory, so runs for other images, other users
+    # or batch scripts never touch each other's files
+    return tempfile.mkdtemp(prefix="segany-", dir=getSharedTempDir())
 
-    return idx
 
+def cleanup(workspace):
+    shutil.rmtree(workspace, ignore_errors=True)
+
+
+def getBridgeScriptPath():
+    currDir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(currDir, "seganybridge.py")
+
+
+def exportFlattenedStrips(image, filepath):
+    newImage = image.duplicate()
+    try:
+        visLayer = newImage.merge_visible_layers(Gimp.MergeType.CLIP_TO_IMAGE)
+        yield from exportRawImageStrips(visLayer, filepath)
+    finally:
+        newImage.delete()
+
+
+def getPrecomputeKey(values):
+    # CPU performance mode changes the embeddings, so it is part of the key
+    return (bridgeModelType(values.modelType), values.checkPtPath, values.useCpuPerf)
+
+
+class EmbeddingPrecompute:
+    """
+    Speculatively exports the image and has the bridge compute its embedding
+    with the persisted model while the options dialog is open. The embedding
+    goes to the bridge's embedding cache, keyed by the image pixels, where
+    the run after OK finds it, so only the prompts are left to decode.
+    """
+
+    def __init__(self, image, values):
+        self.modelKey = getPrecomputeKey(values)
+        self.useServer = values.useBridgeServer
+        self.pythonPath = values.pythonPath or "python"
+        self.workspace = makeWorkspace()
+        self.ipFilePath = os.path.join(self.workspace, "image" + RAW_IMAGE_EXT)
+        self.cancelled = False
+        self.stopJob = None
+        self.lock = threading.Lock()
+        self.thread = None
+        # The export reads GIMP's buffers, so it runs on the main thread in
+        # idle callbacks, a strip at a time
+        self.export = exportFlattenedStrips(image, self.ipFilePath)
+        GLib.idle_add(self.exportStep)
+
+    def exportStep(self):
+        if self.cancelled:
+            return False
+        try:
+            next(self.export)
+            return True
+        except StopIteration:
+            pass
+        except Exception as e:
+            logging.warning("Speculative image export failed: %s" % e)
+            self.discard()
+            return False
+        cmd = [
+            self.pythonPath,
+            getBridgeScriptPath(),
+            self.modelKey[0],
+            self.modelKey[1],
+            self.ipFilePath,
+            "Embed",
+            "Single",
+            os.path.join(self.workspace, "embed__"),
+            MASK_FORMAT_CONTAINER,
+        ]
+        if self.modelKey[2]:
+            cmd.append("--cpu-perf=1")
+        logging.info("Precomputing the image embedding")
+        self.thread = threading.Thread(target=self.run, args=(cmd,), daemon=True)
+        self.thread.start()
+        return False
+
+    def run(self, cmd):
+        # Acts as its own progress object, so discard() stops the bridge job
+        try:
+            runBridge(cmd, self.useServer, None, self, self.onStart)
+        finally:
+            with self.lock:
+                self.stopJob = None
+
+    def onStart(self, stopJob):
+        with self.lock:
+            self.stopJob = stopJob
+            cancelled = self.cancelled
+        if cancelled:
+            stopJob()
+
+    def poll(self, idle=False):
+        return not self.cancelled
+
+    def matches(self, values):
+        return (
+            not self.cancelled
+            and self.thread is not None
+            and self.modelKey == getPrecomputeKey(values)
+        )
 
-def cleanup(filepathPrefix):
-    for f in glob.glob(filepathPrefix + "*"):
-        os.remove(f)
+    def wait(self):
+        # Running the job next to the precompute would only compete with it
+        if not self.thread.is_alive():
+            return
+        progress = BridgeProgress("Segment Anything - Image Embedding")
+        progress.setStatus("Computing the image embedding...", None)
+        try:
+            while self.thread.is_alive() and progress.poll(idle=True):
+                time.sleep(BRIDGE_POLL_INTERVAL)
+        finally:
+            progress.close()
+        if progress.cancelled:
+            self.discard()
+
+    def discard(self):
+        if self.cancelled:
+            return
+        # Stops a running job without waiting for it, so the dialog stays
+        # responsive and the plug-in can exit right after. The bridge maps the
+        # image file, so removing the workspace under it is safe.
+        with self.lock:
+            self.cancelled = True
+            stopJob = self.stopJob
+        self.export.close()
+        if stopJob is not None:
+            stopJob()
+        cleanup(self.workspace)
 
 
 def showError(message):
@@ -537,16 +1871,28 @@ def showError(message):
 
 
 def validateOptions(image, values):
+    if values.segType == "Refine":
+        if not any(label for _, _, label in getRefineClicks(image)):
+            showError(
+                "No Clicks! For the Segmentation Type: Refine to work you need "
+                + "to add positive clicks as anchors of a path named 'Positive' "
+                + "(and negative ones in a path named 'Negative')"
+            )
+            return False
+        return True
     if values.segType in {"Selection", "Box"}:
         procedure = Gimp.get_pdb().lookup_procedure("gimp-selection-is-empty")
         config = procedure.create_config()
         config.set_property("image", image)
         result = procedure.run(config)
         isSelEmpty = result.index(1)
+        # Visible rectangular paths are box prompts of their own
+        if isSelEmpty and values.segType == "Box" and getPathBoxes(image):
+            return True
         if isSelEmpty:
             showError(
                 "No Selection! For the Segmentation Types: "
-                + "Selection to work you need "
+                + "Selection and Box to work you need "
                 + "to select an area on the image"
             )
             return False
@@ -561,13 +1907,11 @@ def configLogging(level):
     )
 
 
-def run_segmentation(image, values):
+def run_segmentation(image, values, precompute=None):
     configLogging(logging.DEBUG)
     if not validateOptions(image, values):
         return
 
-    boxPathDict = getPathDict(image)
-
     if values.checkPtPath is None:
         logging.error("Please set the Segment Anything checkpoint path.")
         return
@@ -578,20 +1922,30 @@ def run_segmentation(image, values):
     else:
         pythonPath = values.pythonPath
 
-    formatBinary = True
-    filePrefix = "__seg__"
-    filepathPrefix = os.path.join(tempfile.gettempdir(), filePrefix)
-    selFile = filepathPrefix + "sel__.txt"
-    maskFileNoExt = filepathPrefix + "mask__"
+    if precompute is not None:
+        if precompute.matches(values):
+            precompute.wait()
+        precompute.discard()
 
-    segAnyScriptName = "seganybridge.py"
+    workspace = makeWorkspace()
+    try:
+        segmentInWorkspace(image, values, pythonPath, workspace)
+    finally:
+        cleanup(workspace)
 
-    cleanup(filepathPrefix)
 
-    currDir = os.path.dirname(os.path.realpath(__file__))
-    scriptFilepath = os.path.join(currDir, segAnyScriptName)
+def segmentInWorkspace(image, values, pythonPath, workspace):
+    useLabelMap = values.outputMode == "Label Map"
+    # Layers are built from masks streamed by the bridge while it runs, the
+    # label map needs every mask first
+    maskFormat = MASK_FORMAT_LABEL_MAP if useLabelMap else MASK_FORMAT_STREAM
+    selFile = os.path.join(workspace, "sel.txt")
+    clicksFile = os.path.join(workspace, "clicks.txt")
+    maskFileNoExt = os.path.join(workspace, "mask__")
 
-    ipFilePath = filepathPrefix + next(tempfile._get_candidate_names()) + ".png"
+    scriptFilepath = getBridgeScriptPath()
+
+    ipFilePath = os.path.join(workspace, "image" + RAW_IMAGE_EXT)
 
     cmd = [
         pythonPath,
@@ -602,7 +1956,7 @@ def run_segmentation(image, values):
         values.segType,
         values.maskType,
         maskFileNoExt,
-        str(formatBinary),
+        maskFormat,
     ]
 
     if values.segType == "Auto":
@@ -620,27 +1974,24 @@ def run_segmentation(image, values):
                 [values.segRes, str(values.cropNLayers), str(values.minMaskArea)]
             )
 
-    newImage = image.duplicate()
-    visLayer = newImage.merge_visible_layers(Gimp.MergeType.CLIP_TO_IMAGE)
+    timings = RunTimings()
+    runStart, runCpuStart = time.perf_counter(), time.process_time()
 
-    procedure = Gimp.get_pdb().lookup_procedure("file-png-export")
-    config = procedure.create_config()
-    config.set_property("run-mode", Gimp.RunMode.NONINTERACTIVE)
-    config.set_property("image", newImage)
+    with timings.measure("export"):
+        newImage = image.duplicate()
+        visLayer = newImage.merge_visible_layers(Gimp.MergeType.CLIP_TO_IMAGE)
 
-    gfile = Gio.File.new_for_path(ipFilePath)
-    config.set_property("file", gfile)
-    config.set_property("interlaced", False)
-    config.set_property("compression", 9)
-    config.set_property("bkgd", False)
-    config.set_property("offs", False)
-    config.set_property("phys", False)
-    config.set_property("time", False)
-    config.set_property("save-transparent", True)
-    config.set_property("optimize-palette", False)
-    procedure.run(config)
+        try:
+            exportRawImage(visLayer, ipFilePath)
+        except Exception as e:
+            logging.warning("Raw image export failed, falling back to PNG: %s" % e)
+            if exists(ipFilePath):
+                os.remove(ipFilePath)
+            ipFilePath = os.path.join(workspace, "image.png")
+            cmd[4] = ipFilePath
+            exportPngImage(newImage, ipFilePath)
 
-    newImage.delete()
+        newImage.delete()
 
     procedure = Gimp.get_pdb().lookup_procedure("gimp-selection-save")
     config = procedure.create_config()
@@ -648,30 +1999,93 @@ def run_segmentation(image, values):
     result = procedure.run(config)
     channel = result.index(1)
 
+    # Every selection component (and rectangular path in Box mode) is sent
+    # as its own prompt, the bridge predicts them all on one image embedding
+    promptCnt = 1
     if values.segType in {"Selection"}:
-        exportSelection(image, selFile, values.selPtCnt)
+        with timings.measure("selection_export"):
+            components = readSelectionComponents(image)
+            exportSelection(components, selFile, values.selPtCnt, values.selPtPlacement)
+        promptCnt = len(components)
         cmd.append(selFile)
     elif values.segType == "Box":
-        procedure = Gimp.get_pdb().lookup_procedure("gimp-selection-bounds")
-        config = procedure.create_config()
-        config.set_property("image", image)
-        result = procedure.run(config)
-        x1 = result.index(2)
-        y1 = result.index(3)
-        x2 = result.index(4)
-        y2 = result.index(5)
+        with timings.measure("selection_export"):
+            boxes = [getComponentBox(c) for c in readSelectionComponents(image)]
+            boxes.extend(getPathBoxes(image))
+        promptCnt = len(boxes)
         cmd.append("sel_place_holder")
-        cmd.append(",".join(str(co) for co in [x1, y1, x2, y2]))
+        cmd.append(";".join(",".join(str(co) for co in box) for box in boxes))
+    elif values.segType == "Refine":
+        exportClicks(getRefineClicks(image), clicksFile)
+        cmd.append(clicksFile)
+
+    filterOptions = []
+    if values.segType == "Auto" and values.useMaskFilters:
+        filterOptions = [
+            f"--min-score={values.filterMinScore}",
+            f"--min-stability={values.filterMinStability}",
+            f"--min-area={values.filterMinArea}",
+            f"--max-area={values.filterMaxArea}",
+            f"--nms-iou={values.filterNmsIoU}",
+            f"--top-k={values.filterTopK}",
+        ]
+
+    if values.useCpuPerf:
+        cmd.append("--cpu-perf=1")
+
+    previewCmd = None
+    if values.usePreview and values.previewCheckPtPath:
+        previewCmd = list(cmd)
+        previewCmd[2] = "auto"
+        previewCmd[3] = values.previewCheckPtPath
+        previewCmd[7] = os.path.join(workspace, "preview__")
+        previewCmd.extend(filterOptions)
+        if values.segType == "Auto":
+            previewCmd.extend(PREVIEW_AUTO_OPTIONS)
+
+    if values.segType == "Auto" and values.useTiling:
+        cmd.extend(
+            [
+                f"--tile-size={values.tileSize}",
+                f"--tile-overlap={values.tileOverlap}",
+                f"--max-memory-mb={values.maxMemoryMB}",
+            ]
+        )
+    cmd.extend(filterOptions)
 
     procedure = Gimp.get_pdb().lookup_procedure("gimp-selection-none")
     config = procedure.create_config()
     config.set_property("image", image)
     procedure.run(config)
-    shellRun(cmd)
 
-    layerMaskColor = None if values.isRandomColor else values.maskColor
-    createLayers(image, maskFileNoExt, layerMaskColor, formatBinary, values)
-    cleanup(filepathPrefix)
+    # The preview pass shows a quick result from a fast model, the full pass
+    # then replaces it in place, or is cancelled if the preview looks wrong
+    previewLayer = None
+    cancelled = False
+    if previewCmd is not None:
+        previewLayer, cancelled = runSegmentationPass(
+            image, values, previewCmd, promptCnt, timings, PREVIEW_SUFFIX
+        )
+        Gimp.displays_flush()
+    if not cancelled:
+        layer, cancelled = runSegmentationPass(image, values, cmd, promptCnt, timings)
+        if not cancelled:
+            if values.segType == "Refine":
+                removeRefineLayers(image, layer)
+            if previewLayer is not None:
+                position = image.get_item_position(previewLayer)
+                image.remove_layer(previewLayer)
+                if layer is not None:
+                    image.reorder_item(layer, None, position)
+    timings.stages.append(
+        (
+            "plugin",
+            "total",
+            time.perf_counter() - runStart,
+            time.process_time() - runCpuStart,
+        )
+    )
+    timings.log()
 
     if channel is not None:
         procedure = Gimp.get_pdb().lookup_procedure("gimp-image-select-item")
@@ -681,17 +2095,78 @@ def run_segmentation(image, values):
         config.set_property("item", channel)
         procedure.run(config)
 
-    logging.debug("Finished creating segments!")
+    if cancelled:
+        logging.info("Segmentation cancelled")
+    else:
+        logging.debug("Finished creating segments!")
+
+
+def runSegmentationPass(image, values, cmd, promptCnt, timings, nameSuffix=""):
+    """
+    Runs the bridge with cmd and builds its layers. Returns the new layer
+    group (or label map layer) and whether the user cancelled, in which case
+    the partial result is removed.
+    """
+    maskFileNoExt, maskFormat = cmd[7], cmd[8]
+    layerMaskColor = None if values.isRandomColor else values.maskColor
+    builder = None
+    if maskFormat == MASK_FORMAT_STREAM:
+        builder = MaskLayerBuilder(image, layerMaskColor, values, promptCnt, nameSuffix)
+
+    progress = BridgeProgress("Segment Anything - %s%s" % (values.segType, nameSuffix))
+
+    def onEvent(event):
+        timings.onEvent(event)
+        progress.onEvent(event)
+        if builder is not None:
+            builder.onEvent(event)
+
+    try:
+        with timings.measure("bridge"):
+            runBridge(cmd, values.useBridgeServer, onEvent, progress)
+    finally:
+        progress.close()
+
+    if progress.cancelled:
+        if builder is not None:
+            image.remove_layer(builder.parent)
+        return None, True
+
+    if builder is None:
+        with timings.measure("create_layers"):
+            return createLabelMap(image, maskFileNoExt, values, nameSuffix), False
+    if builder.firstLayerTime is not None:
+        timings.stages.append(
+            (
+                "plugin",
+                "first_layer" + nameSuffix.lower(),
+                builder.firstLayerTime - timings.start,
+                0.0,
+            )
+        )
+    return builder.parent, False
 
 
 class SegAnyPlugin(Gimp.PlugIn):
     def do_query_procedures(self):
-        return ["seg-any-gimp3"]
+        return ["seg-any-gimp3", "seg-any-gimp3-label"]
 
     def do_set_i18n(self, procname):
         return False, None, None  # Returning False disables localization
 
     def do_create_procedure(self, name):
+        if name == "seg-any-gimp3-label":
+            procedure = Gimp.ImageProcedure.new(
+                self, name, Gimp.PDBProcType.PLUGIN, self.seg_any_label_run, None
+            )
+            procedure.set_sensitivity_mask(Gimp.ProcedureSensitivityMask.DRAWABLE)
+            procedure.set_menu_label("Segment Anything Label to Selection")
+            procedure.set_attribution(
+                "Shrinivas Kulkarni", "Shrinivas Kulkarni", "2024"
+            )
+            procedure.add_menu_path("<Image>/Image")
+            return procedure
+
         procedure = Gimp.ImageProcedure.new(
             self, name, Gimp.PDBProcType.PLUGIN, self.seg_any_run, None
         )
@@ -709,7 +2184,30 @@ class SegAnyPlugin(Gimp.PlugIn):
         if response == Gtk.ResponseType.OK:
             values = dialog.get_values()
             image.undo_group_start()
-            run_segmentation(image, values)
+            run_segmentation(image, values, dialog.precompute)
+            image.undo_group_end()
+
+        dialog.discard_precompute()
+        dialog.destroy()
+
+        return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
+
+    def seg_any_label_run(self, procedure, run_mode, image, drawables, config, data):
+        container = getLabelContainer(drawables)
+        if container is None:
+            showError(
+                "No Label Map! Select a layer created with the Output: "
+                + "Label Map option"
+            )
+            return procedure.new_return_values(Gimp.PDBStatusType.CANCEL, GLib.Error())
+
+        label = getSelectionLabel(image, container) or 1
+        dialog = LabelDialog(len(container), label)
+        response = dialog.run()
+
+        if response == Gtk.ResponseType.OK:
+            image.undo_group_start()
+            materializeLabel(image, container, dialog.get_label())
             image.undo_group_end()
 
         dialog.destroy()
@@ -23,11 +23,11 @@ from gimpfu import LAYER_MODE_NORMAL_LEGACY, GRAY, GRAYA_IMAGE
 import tempfile
 import subprocess
 from os.path import exists
-from array import array
+import mmap
 import random
 import os
 import sys
-import glob
+import shutil
 import struct
 import gtk
 import json
@@ -90,49 +90,31 @@ def shellRun(cmdArgs, stdoutFile=None, env_vars=None, useos=False):
     return True
 
 
-def unpackBoolArray(filepath):
-    with open(filepath, "rb") as file:
-        packed_data = bytearray(file.read())
-
-    byte_index = 8  # Skip the first 8 bytes for num_rows and num_cols
-
-    num_rows = struct.unpack(">I", packed_data[:4])[0]
-    num_cols = struct.unpack(">I", packed_data[4:8])[0]
-
-    unpacked_data = []
-    bit_position = 0
-
-    for _ in range(num_rows):
-        unpacked_row = []
-        for _ in range(num_cols):
-            if bit_position == 0:
-                current_byte = packed_data[byte_index]
-                byte_index += 1
-
-            boolean_value = (current_byte >> bit_position) & 1
-            unpacked_row.append(boolean_value)
-            bit_position += 1
-
-            if bit_position == 8:
-                bit_position = 0
-
-        unpacked_data.append(unpacked_row)
-
-    return unpacked_data
+def makePixelLookup(onPixel, offPixel):
+    # The 8 pixels of every byte value of LSB-first packed mask bits
+    return [
+        "".join(onPixel if (byte >> bit) & 1 else offPixel for bit in range(8))
+        for byte in range(256)
+    ]
 
 
-def readMaskFile(filepath, formatBinary):
-    if formatBinary:
-        return unpackBoolArray(filepath)
-    else:  # Ony for testing
-        mask = []
-        with open(filepath, "r") as f:
-            lines = f.readlines()
-        for line in lines:
-            # print(line)
-            mask.append([val == "1" for val in line])
-            # print(mask[-1])
-        return mask
+def readMaskPixels(filepath, formatBinary, onPixel, offPixel):
+    # Decodes a mask file straight to layer pixel bytes
+    with open(filepath, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if formatBinary:
+            num_rows, num_cols = struct.unpack(">II", data[:8])
+            pixelCnt = num_rows * num_cols
+            payload = bytearray(data[8 : 8 + (pixelCnt + 7) // 8])
+            lookup = makePixelLookup(onPixel, offPixel)
+            pixels = "".join(map(lookup.__getitem__, payload))
+            return pixels[: pixelCnt * len(onPixel)]
+        else:  # Ony for testing
+            digits = data[:].replace("\n", "")
+            return "".join(onPixel if digit == "1" else offPixel for digit in digits)
+    finally:
+        data.close()
 
 
 def exportSelection(image, expfile, exportCnt):
@@ -205,23 +187,16 @@ def createLayers(image, maskFileNoExt, userSelColor, formatBinary):
             rgn = newlayer.get_pixel_rgn(0, 0, width, height, True, True)
             pixSize = len(rgn[0, 0])
 
-            pixels = array("B", "\x00" * (width * height * pixSize))
-
-            maskVals = readMaskFile(filepath, formatBinary)
             maskColor = (
                 userSelColor
                 if userSelColor is not None
                 else list(uniqueColors[idx]) + [255]
             )
-            x = 0
-            for line in maskVals:
-                for y, p in enumerate(line):
-                    if p:
-                        pos = (y + width * x) * pixSize
-                        pixels[pos : pos + pixSize] = array("B", maskColor)
-                x += 1
+            onPixel = "".join(chr(val) for val in maskColor[:pixSize])
+            offPixel = "\x00" * pixSize
+            pixels = readMaskPixels(filepath, formatBinary, onPixel, offPixel)
             idx += 1
-            rgn[0:width, 0:height] = pixels.tostring()
+            rgn[0:width, 0:height] = pixels
             newlayer.flush()
             newlayer.merge_shadow(True)
             newlayer.update(0, 0, width, height)
@@ -231,9 +206,22 @@ def createLayers(image, maskFileNoExt, userSelColor, formatBinary):
     return idx
 
 
-def cleanup(filepathPrefix):
-    for f in glob.glob(filepathPrefix + "*"):
-        os.remove(f)
+def getSharedTempDir():
+    # Files in /dev/shm never touch the disk
+    shmDir = "/dev/shm"
+    if os.path.isdir(shmDir) and os.access(shmDir, os.W_OK):
+        return shmDir
+    return tempfile.gettempdir()
+
+
+def makeWorkspace():
+    # Every run gets its own directory, so concurrent runs never touch each
+    # other's files
+    return tempfile.mkdtemp(prefix="segany-", dir=getSharedTempDir())
+
+
+def cleanup(workspace):
+    shutil.rmtree(workspace, ignore_errors=True)
 
 
 def getPathDict(image):
@@ -576,20 +564,24 @@ def plugin_main(image, layer):
     else:
         pythonPath = values.pythonPath
 
+    workspace = makeWorkspace()
+    try:
+        segmentInWorkspace(image, values, boxPathDict, pythonPath, workspace)
+    finally:
+        cleanup(workspace)
+
+
+def segmentInWorkspace(image, values, boxPathDict, pythonPath, workspace):
     formatBinary = True
-    filePrefix = "__seg__"
-    filepathPrefix = os.path.join(tempfile.gettempdir(), filePrefix)
-    selFile = filepathPrefix + "sel__.txt"
-    maskFileNoExt = filepathPrefix + "mask__"
+    selFile = os.path.join(workspace, "sel.txt")
+    maskFileNoExt = os.path.join(workspace, "mask__")
 
     segAnyScriptName = "seganybridge_GIMP2_SAM1.py"
 
-    cleanup(filepathPrefix)
-
     currDir = os.path.dirname(os.path.realpath(__file__))
     scriptFilepath = os.path.join(currDir, segAnyScriptName)
 
-    ipFilePath = filepathPrefix + next(tempfile._get_candidate_names()) + ".png"
+    ipFilePath = os.path.join(workspace, "image.png")
 
     cmd = [
         pythonPath,
@@ -628,7 +620,6 @@ def plugin_main(image, layer):
 
     layerMaskColor = None if values.isRandomColor else values.maskColor
     createLayers(image, maskFileNoExt, layerMaskColor, formatBinary)
-    cleanup(filepathPrefix)
 
     if channel is not None:
         pdb.gimp_image_select_item(image, 2, channel)
@@ -0,0 +1,45 @@
+import importlib.util
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class _GiStubMeta(type):
+    def __getattr__(cls, name):
+        return _GiStub
+
+
+class _GiStub(metaclass=_GiStubMeta):
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture(scope="session")
+def plugin():
+    # The plugin's pure functions need no GIMP, only the module level GObject
+    # names are stubbed so the plugin imports outside GIMP
+    saved = {name: sys.modules.get(name) for name in ("gi", "gi.repository")}
+    gi = types.ModuleType("gi")
+    gi.require_version = lambda *args: None
+    repository = types.ModuleType("gi.repository")
+    repository.__getattr__ = lambda name: _GiStub
+    gi.repository = repository
+    sys.modules["gi"], sys.modules["gi.repository"] = gi, repository
+    try:
+        spec = importlib.util.spec_from_file_location(
+            "seganyplugin", os.path.join(ROOT, "seganyplugin.py")
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        yield module
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
@@ -0,0 +1,57 @@
+"""
+Round trip of the run-length encoded label map: the bridge writer and the
+plugin's reader, with and without numpy.
+"""
+
+import numpy as np
+import pytest
+
+import seganybridge
+
+LABEL_PIXELS = [bytes(4)] + [bytes([i, 255 - i, i // 2, 255]) for i in range(1, 6)]
+
+
+def makeCrops(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    crops = []
+    for _ in range(len(LABEL_PIXELS) - 1):
+        h, w = rng.integers(1, shape[0] + 1), rng.integers(1, shape[1] + 1)
+        y, x = rng.integers(0, shape[0] - h + 1), rng.integers(0, shape[1] - w + 1)
+        crops.append((int(x), int(y), rng.random((h, w)) < 0.6))
+    return crops
+
+
+def expectedLabels(shape, crops):
+    # The first mask covering a pixel wins, as it ranks highest
+    labels = np.zeros(shape, dtype=int)
+    for i, (x, y, crop) in enumerate(crops):
+        region = labels[y : y + crop.shape[0], x : x + crop.shape[1]]
+        region[(region == 0) & crop] = i + 1
+    return labels
+
+
+@pytest.mark.parametrize("useNumpy", [True, False])
+@pytest.mark.parametrize("shape", [(1, 1), (13, 7), (40, 64)])
+def test_label_map_round_trip(plugin, monkeypatch, tmp_path, shape, useNumpy):
+    if not useNumpy:
+        monkeypatch.setattr(plugin, "np", None)
+    crops = makeCrops(shape, seed=shape[0])
+    filepath = str(tmp_path / seganybridge.LABEL_MAP_FILE_NAME)
+    seganybridge.writeLabelMap(filepath, shape, crops)
+
+    pixels = plugin.readLabelMapPixels(filepath, LABEL_PIXELS)
+    labels = expectedLabels(shape, crops)
+    assert pixels == b"".join(LABEL_PIXELS[label] for label in labels.ravel())
+
+
+def test_empty_label_map(plugin, tmp_path):
+    filepath = str(tmp_path / seganybridge.LABEL_MAP_FILE_NAME)
+    seganybridge.writeLabelMap(filepath, (4, 5), [])
+    assert plugin.readLabelMapPixels(filepath, LABEL_PIXELS) == bytes(4) * 20
+
+
+def test_unsupported_label_map(plugin, tmp_path):
+    filepath = tmp_path / seganybridge.LABEL_MAP_FILE_NAME
+    filepath.write_bytes(b"XXXX" + bytes(seganybridge.LABEL_MAP_HEADER.size))
+    with pytest.raises(ValueError):
+        plugin.readLabelMapPixels(str(filepath), LABEL_PIXELS)
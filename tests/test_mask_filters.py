@@ -0,0 +1,77 @@
+"""
+Score, area, overlap and top-K filtering of auto segmentation masks.
+"""
+
+import numpy as np
+import pytest
+
+from seganybridge import filterMasks, suppressOverlaps
+
+
+def rectCrop(x, y, w, h):
+    return (x, y, np.ones((h, w), dtype=bool))
+
+
+def maskIoU(a, b, shape=(64, 64)):
+    masks = []
+    for x, y, crop in (a, b):
+        mask = np.zeros(shape, dtype=bool)
+        mask[y : y + crop.shape[0], x : x + crop.shape[1]] = crop
+        masks.append(mask)
+    return np.count_nonzero(masks[0] & masks[1]) / np.count_nonzero(masks[0] | masks[1])
+
+
+def test_no_filter_keeps_the_generator_order():
+    crops = [rectCrop(0, 0, 2, 2), rectCrop(5, 5, 3, 3), rectCrop(1, 1, 4, 4)]
+    scores = [(0.5, 0.9), (0.9, 0.9), (0.7, 0.9)]
+    kept = filterMasks(crops, scores)
+    assert [id(crop) for crop in kept] == [id(crop) for crop in crops]
+
+
+def test_filters_return_the_best_first():
+    crops = [rectCrop(0, 0, 2, 2), rectCrop(5, 5, 3, 3), rectCrop(1, 1, 4, 4)]
+    scores = [(0.5, 0.9), (0.9, 0.9), (0.7, 0.9)]
+    assert filterMasks(crops, scores, topK=2) == [crops[1], crops[2]]
+
+
+@pytest.mark.parametrize(
+    "filters, expected",
+    [
+        ({"minScore": 0.6}, [1, 2]),
+        ({"minStability": 0.8}, [1, 0]),
+        ({"minArea": 5}, [1, 2]),
+        ({"maxArea": 9}, [1, 0]),
+        ({"minArea": 5, "maxArea": 9}, [1]),
+    ],
+)
+def test_score_and_area_filters(filters, expected):
+    # Areas 4, 9 and 16
+    crops = [rectCrop(0, 0, 2, 2), rectCrop(5, 5, 3, 3), rectCrop(1, 1, 4, 4)]
+    scores = [(0.5, 0.9), (0.9, 0.85), (0.7, 0.7)]
+    assert filterMasks(crops, scores, **filters) == [crops[i] for i in expected]
+
+
+def test_nms_keeps_the_better_of_two_overlapping_masks():
+    crops = [rectCrop(0, 0, 10, 10), rectCrop(1, 0, 10, 10), rectCrop(30, 30, 5, 5)]
+    scores = [(0.8, 0.9), (0.95, 0.9), (0.5, 0.9)]
+    assert filterMasks(crops, scores, nmsIoU=0.5) == [crops[1], crops[2]]
+    # The overlap is below a stricter threshold
+    assert len(filterMasks(crops, scores, nmsIoU=0.9)) == 3
+
+
+def test_suppress_overlaps_matches_exact_greedy_nms():
+    rng = np.random.default_rng(0)
+    crops = []
+    for _ in range(40):
+        w, h = rng.integers(3, 20, size=2)
+        x, y = rng.integers(0, 64 - 20, size=2)
+        crops.append((int(x), int(y), rng.random((h, w)) < 0.8))
+    areas = [int(np.count_nonzero(crop)) for _, _, crop in crops]
+    order = list(rng.permutation(len(crops)))
+
+    for threshold in (0.1, 0.3, 0.5):
+        expected = []
+        for i in order:
+            if all(maskIoU(crops[i], crops[j]) < threshold for j in expected):
+                expected.append(i)
+        assert suppressOverlaps(crops, areas, order, threshold) == expected
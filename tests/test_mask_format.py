@@ -0,0 +1,95 @@
+"""
+Round trip of the packed .seg mask format: the bridge writer against the
+pre-packbits writer, and the plugin's binary and container readers.
+"""
+
+import struct
+
+import numpy as np
+import pytest
+
+import seganybridge
+
+ON_PIXEL = b"\xff\x00\x00\xff"
+OFF_PIXEL = b"\x00\x00\x00\x00"
+
+
+def legacyPackBoolArray(arr):
+    # The writer packBoolArray used before np.packbits, byte for byte
+    packed_data = bytearray()
+    num_rows = len(arr)
+    num_cols = len(arr[0])
+    packed_data.extend(
+        [num_rows >> 24, (num_rows >> 16) & 255, (num_rows >> 8) & 255, num_rows & 255]
+    )
+    packed_data.extend(
+        [num_cols >> 24, (num_cols >> 16) & 255, (num_cols >> 8) & 255, num_cols & 255]
+    )
+    current_byte = 0
+    bit_position = 0
+    for row in arr:
+        for boolean_value in row:
+            if boolean_value:
+                current_byte |= 1 << bit_position
+            bit_position += 1
+            if bit_position == 8:
+                packed_data.append(current_byte)
+                current_byte = 0
+                bit_position = 0
+    if bit_position > 0:
+        packed_data.append(current_byte)
+    return bytes(packed_data)
+
+
+def expectedPixels(mask):
+    return b"".join(ON_PIXEL if value else OFF_PIXEL for value in mask.ravel())
+
+
+@pytest.fixture(params=[(1, 1), (3, 5), (8, 8), (17, 29), (64, 3)])
+def mask(request):
+    rng = np.random.default_rng(sum(request.param))
+    return rng.random(request.param) < 0.4
+
+
+def test_pack_mask_matches_legacy_writer(mask):
+    packed = seganybridge.packMask(mask)
+    trailer = struct.pack(
+        ">4sH", seganybridge.MASK_FILE_MAGIC, seganybridge.MASK_FILE_VERSION
+    )
+    assert packed == legacyPackBoolArray(mask.tolist()) + trailer
+
+
+def test_binary_reader_round_trip(plugin, mask, tmp_path):
+    filepath = str(tmp_path / "mask.seg")
+    seganybridge.packBoolArray(filepath, mask)
+    pixels = plugin.readMaskFilePixels(filepath, True, ON_PIXEL, OFF_PIXEL)
+    assert pixels == expectedPixels(mask)
+
+
+def test_binary_reader_without_numpy(plugin, mask, tmp_path, monkeypatch):
+    monkeypatch.setattr(plugin, "np", None)
+    filepath = str(tmp_path / "mask.seg")
+    seganybridge.packBoolArray(filepath, mask)
+    pixels = plugin.readMaskFilePixels(filepath, True, ON_PIXEL, OFF_PIXEL)
+    assert pixels == expectedPixels(mask)
+
+
+def test_container_reader_round_trip(plugin, tmp_path):
+    rng = np.random.default_rng(0)
+    masks = [rng.random((40, 50)) < 0.3, np.zeros((40, 50), dtype=bool)]
+    masks[1][5:20, 10:35] = True  # Long runs, so this one is RLE encoded
+    saveFileNoExt = str(tmp_path / "mask__")
+    seganybridge.saveMasks(masks, saveFileNoExt, seganybridge.MASK_FORMAT_CONTAINER)
+
+    container = plugin.MaskContainer.open(
+        saveFileNoExt + seganybridge.CONTAINER_FILE_NAME
+    )
+    try:
+        assert len(container) == len(masks)
+        for i, mask in enumerate(masks):
+            x, y, crop = seganybridge.cropMask(mask)
+            assert tuple(container.bounds(i)) == (x, y, crop.shape[1], crop.shape[0])
+            pixels = container.readPixels(i, ON_PIXEL, OFF_PIXEL)
+            assert pixels == expectedPixels(crop)
+    finally:
+        container.close()
@@ -0,0 +1,113 @@
+"""
+Splitting the GIMP selection into connected components and sampling their
+points, on a fake selection buffer.
+"""
+
+import random
+
+import numpy as np
+import pytest
+
+SELECTED = 255
+
+
+class FakeBuffer:
+    # Gegl rectangles are stubs, so the buffer knows the selection bounds
+    def __init__(self, selection, bounds):
+        self.selection = selection
+        self.x1, self.y1, self.x2, self.y2 = bounds
+
+    def get(self, rect, scale, babl_format, abyss):
+        return self.selection[self.y1 : self.y2, self.x1 : self.x2].tobytes()
+
+
+class FakeImage:
+    def __init__(self, selection, bounds):
+        self.buffer = FakeBuffer(selection, bounds)
+
+    def get_selection(self):
+        return self
+
+    def get_buffer(self):
+        return self.buffer
+
+
+@pytest.fixture
+def readComponents(plugin, monkeypatch):
+    def read(selection):
+        ys, xs = np.nonzero(selection > plugin.SELECTION_THRESHOLD)
+        bounds = (0, 0, 0, 0)
+        if len(ys):
+            bounds = (xs.min(), ys.min(), xs.max() + 1, ys.max() + 1)
+        image = FakeImage(selection, bounds)
+        monkeypatch.setattr(
+            plugin, "getSelectionBounds", lambda _: [len(ys) > 0, *bounds]
+        )
+        components = plugin.readSelectionComponents(image)
+        return [componentMask(selection.shape, component) for component in components]
+
+    return read
+
+
+def componentMask(shape, component):
+    mask = np.zeros(shape, dtype=bool)
+    for y, start, end in component:
+        assert not mask[y, start:end].any(), "runs overlap"
+        mask[y, start:end] = True
+    return mask
+
+
+def sortedMasks(masks):
+    return sorted(masks, key=lambda mask: tuple(np.argwhere(mask)[0]))
+
+
+def test_empty_selection(readComponents):
+    assert readComponents(np.zeros((10, 10), dtype=np.uint8)) == []
+
+
+def test_components_and_specks(readComponents):
+    selection = np.zeros((40, 60), dtype=np.uint8)
+    selection[2:12, 3:13] = SELECTED  # 100 px
+    # U shape, its arms only join in the last row
+    selection[15:35, 20:24] = SELECTED
+    selection[15:35, 40:44] = SELECTED
+    selection[32:35, 20:44] = SELECTED
+    selection[2:5, 50:53] = SELECTED  # 9 px speck
+    selection[6:8, 30:40] = 150  # Below the threshold
+
+    masks = sortedMasks(readComponents(selection))
+    assert len(masks) == 2
+    expected = np.zeros_like(selection, dtype=bool)
+    expected[2:12, 3:13] = True
+    assert np.array_equal(masks[0], expected)
+    expected = np.zeros_like(selection, dtype=bool)
+    expected[15:35, 20:24] = expected[15:35, 40:44] = expected[32:35, 20:44] = True
+    assert np.array_equal(masks[1], expected)
+
+
+def test_diagonal_pixels_are_not_connected(readComponents):
+    selection = np.zeros((40, 40), dtype=np.uint8)
+    selection[0:10, 0:10] = SELECTED
+    selection[10:20, 10:20] = SELECTED
+    assert len(readComponents(selection)) == 2
+
+
+def test_only_specks_are_kept(readComponents):
+    selection = np.zeros((20, 20), dtype=np.uint8)
+    selection[1:3, 1:3] = SELECTED
+    selection[10:12, 10:13] = SELECTED
+    masks = readComponents(selection)
+    assert len(masks) == 2
+    assert sum(np.count_nonzero(mask) for mask in masks) == 4 + 6
+
+
+def test_sampled_points_are_distinct_component_pixels(plugin):
+    random.seed(0)
+    component = [(5, 10, 14), (6, 8, 20), (7, 12, 13)]
+    pixels = {(x, y) for y, start, end in component for x in range(start, end)}
+    for exportCnt in (1, 5, len(pixels), len(pixels) + 10):
+        coords = plugin.sampleComponentPoints(component, exportCnt)
+        assert len(coords) == min(exportCnt, len(pixels))
+        assert len(set(coords)) == len(coords)
+        assert set(coords) <= pixels
+    assert set(plugin.sampleComponentPoints(component, len(pixels))) == pixels
@@ -0,0 +1,86 @@
+"""
+Tile layout and the stitching of tile masks across seams.
+"""
+
+import numpy as np
+
+import seganybridge
+from seganybridge import PackedCrop, stitchTileMasks, tileOrigins
+
+
+def tilePieces(mask, rect, score=(0.9, 0.9)):
+    # The part of a full image mask inside one tile, as the tile pass finds it
+    x1, y1, x2, y2 = rect
+    x, y, crop = seganybridge.cropMask(mask[y1:y2, x1:x2])
+    return [PackedCrop(x1 + x, y1 + y, crop, score)] if crop.size else []
+
+
+def fullMask(shape, x, y, crop):
+    mask = np.zeros(shape, dtype=bool)
+    mask[y : y + crop.shape[0], x : x + crop.shape[1]] = crop
+    return mask
+
+
+def test_tile_origins_cover_the_image():
+    for length, tileSize, overlap in [(1000, 512, 128), (512, 512, 64), (300, 512, 64)]:
+        origins = tileOrigins(length, tileSize, overlap)
+        assert origins[0] == 0
+        assert origins[-1] + min(tileSize, length) == length
+        steps = np.diff(origins)
+        assert np.all(steps > 0) and np.all(steps <= tileSize - overlap)
+
+
+def test_mask_across_a_seam_is_merged():
+    shape = (60, 100)
+    mask = np.zeros(shape, dtype=bool)
+    mask[10:30, 20:80] = True
+    rects = [(0, 0, 60, 60), (40, 0, 100, 60)]
+    tiles = [
+        (rect, tilePieces(mask, rect, score))
+        for rect, score in zip(rects, [(0.8, 0.95), (0.9, 0.85)])
+    ]
+
+    crops, scores = stitchTileMasks(tiles)
+    assert len(crops) == 1
+    assert np.array_equal(fullMask(shape, *crops[0]), mask)
+    assert scores == [(0.9, 0.95)]
+
+
+def test_mask_across_three_tiles_is_one_mask():
+    shape = (40, 140)
+    mask = np.zeros(shape, dtype=bool)
+    mask[5:35, 10:130] = True
+    rects = [(0, 0, 60, 40), (40, 0, 100, 40), (80, 0, 140, 40)]
+    crops, _ = stitchTileMasks([(rect, tilePieces(mask, rect)) for rect in rects])
+    assert len(crops) == 1
+    assert np.array_equal(fullMask(shape, *crops[0]), mask)
+
+
+def test_nested_mask_in_the_seam_stays_separate():
+    # A small mask inside the seam overlaps the large one by far less than
+    # the threshold over the whole seam, so it is not taken as its continuation
+    shape = (60, 100)
+    large = np.zeros(shape, dtype=bool)
+    large[0:50, 20:80] = True
+    small = np.zeros(shape, dtype=bool)
+    small[20:25, 45:55] = True
+    rectA, rectB = (0, 0, 60, 60), (40, 0, 100, 60)
+    tiles = [
+        (rectA, tilePieces(large, rectA)),
+        (rectB, tilePieces(large, rectB) + tilePieces(small, rectB)),
+    ]
+    crops, _ = stitchTileMasks(tiles)
+    masks = sorted((fullMask(shape, *crop) for crop in crops), key=np.count_nonzero)
+    assert len(masks) == 2
+    assert np.array_equal(masks[0], small)
+    assert np.array_equal(masks[1], large)
+
+
+def test_diagonal_tiles_are_not_compared():
+    shape = (100, 100)
+    mask = np.zeros(shape, dtype=bool)
+    mask[45:55, 45:55] = True
+    rectA, rectD = (0, 0, 60, 60), (40, 40, 100, 100)
+    tiles = [(rectA, tilePieces(mask, rectA)), (rectD, tilePieces(mask, rectD))]
+    crops, _ = stitchTileMasks(tiles)
+    assert len(crops) == 2